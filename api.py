@@ -6,11 +6,17 @@ Backend available API and SIGNALS definition.
 
 STOP_REQUEST = "stop"
 PING_REQUEST = "PING"
+METRICS_REQUEST = "metrics"
+STREAM_CREDIT_REQUEST = "stream_credit"
+CANCEL_REQUEST = "cancel"
 
 API = (
     STOP_REQUEST,  # this method needs to be defined in order to support the
                    # backend stop action
     PING_REQUEST,
+    METRICS_REQUEST,  # reserved, returns the backend metrics
+    STREAM_CREDIT_REQUEST,  # reserved, grants credits to a stream
+    CANCEL_REQUEST,  # reserved, cancels a running call
     "add",
     "reset",
     "get_stored_data",
@@ -18,13 +24,123 @@ API = (
 
     'twice_01',
     'twice_02',
+
+    "count_primes",
+)
+
+# Maximum amount of threads used by the backend to run the API methods.
+POOL_SIZE = 10
+
+# Maximum amount of concurrent calls for each API method, the calls over the
+# limit wait for a running one to finish. Methods not listed here can use all
+# the threads in the pool.
+CONCURRENCY_LIMITS = {
+    "blocking_method": 2,
+}
+
+# Maximum amount of calls waiting to be sent to the backend, and the overflow
+# policy for each API method (the default is CALL_POLICY). The calls wait
+# while the backend has too many requests in flight (see
+# `BackendProxy.MAX_UNACKED`) or is unreachable. Policies:
+#   "block": the caller waits until there is room in the queue, do not use it
+#       for the methods called from the GUI thread.
+#   "drop-oldest": the oldest queued call is discarded.
+#   "drop-newest": the new call is discarded.
+#   "coalesce-latest": the new call replaces the queued call of the same
+#       method, if any.
+# The futures of the discarded calls fail with a BackendError.
+CALL_QUEUE_SIZE = 1000
+CALL_POLICY = "drop-oldest"
+CALL_POLICIES = {
+    "get_stored_data": "coalesce-latest",
+    "blocking_method": "drop-newest",
+}
+
+# Default timeout of the calls to each API method, in seconds, the `_timeout`
+# kwarg overrides it. The calls that are not done by then fail, the backend
+# drops them if they did not start and tells the running ones to stop, see
+# `base.cancellation`. Methods not listed here have no timeout.
+CALL_TIMEOUTS = {
+    "blocking_method": 60,
+}
+
+# API methods that are CPU bound, they are run in a pool of processes instead
+# of threads so they are not serialized by the GIL.
+# Note: these methods run in a different process, where `self` only provides
+# the `_signaler`.
+CPU_BOUND = (
+    "count_primes",
+)
+
+# Amount of processes used to run the CPU bound methods, None means one per
+# CPU.
+PROCESS_POOL_SIZE = None
+
+# API methods whose results can be reused, the repeated calls with the same
+# arguments are answered from memory and the signals emitted by the method
+# are sent again. {method: (time to live in secs or None, max entries)}
+# Note: calls with binary arguments are not cached. The methods that change
+# the cached data must call `Backend.invalidate_cache`.
+CACHEABLE = {
+    "get_stored_data": (60, 1),
+}
+
+# API methods whose identical calls (same arguments) are coalesced while one
+# of them is running: the later calls do not run the method again, they get
+# the result of the running one. The signals are sent only once.
+# Note: calls with binary arguments are not coalesced.
+COALESCED_CALLS = (
+    "get_stored_data",
+    "count_primes",
 )
 
+# API methods that are generators, each chunk they yield is sent, in order,
+# as the given signal, see `base.streams`. {method: signal}
+# Note: the streamed methods can not be CPU_BOUND, CACHEABLE nor coalesced,
+# and their signals must use the "block" policy.
+STREAMS = {
+    "blocking_method": "blocking_method_progress",
+}
+
+# Credits each stream starts with, i.e. the maximum amount of chunks sent and
+# not yet handled by the consumer, and how long a stream waits for a credit
+# before failing.
+STREAM_WINDOW = 8
+STREAM_TIMEOUT = 30  # secs
+
+
+# File where the backend dumps its metrics, as JSON, every METRICS_INTERVAL
+# seconds. None to disable it.
+METRICS_FILE = None
+METRICS_INTERVAL = 10  # secs
+
+# File where the backend and the frontend append the trace records of the
+# calls and the signals they emit, see `base.tracing`. None to disable the
+# tracing.
+TRACE_FILE = None
+
+
+# Transport used between the frontend and the backend, see `base.transport`:
+#   "tcp": loopback TCP sockets secured with CURVE.
+#   "ipc": unix domain sockets in IPC_DIR, secured by the filesystem
+#       permissions instead of CURVE. Both sides must run on the same host.
+TRANSPORT = "tcp"
+IPC_DIR = "zmq_sockets"
+
 
 SIGNALS = (
     "add_result",
     "reset_ok",
     "stored_data",
     "blocking_method_ok",
+    "blocking_method_progress",
     "twice_signal",
+    "count_primes_result",
 )
+
+# Maximum amount of signals waiting to be published, and the overflow policy
+# for each signal (the default is "block"), see CALL_POLICIES.
+SIGNAL_QUEUE_SIZE = 1000
+SIGNAL_POLICIES = {
+    "twice_signal": "coalesce-latest",
+}
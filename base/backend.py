@@ -1,17 +1,42 @@
 #!/usr/bin/env python
 # encoding: utf-8
-import json
+import binascii
+import collections
+import functools
+import inspect
+import os
 import threading
 import time
 
 from twisted.internet import defer, reactor, threads
+from twisted.python.failure import Failure
 
 import zmq
-from zmq.auth.thread import ThreadAuthenticator
 
 from signaler import Signaler
 
-from api import API, PING_REQUEST
+from api import API, CANCEL_REQUEST, PING_REQUEST, STOP_REQUEST
+from api import CONCURRENCY_LIMITS, POOL_SIZE
+from api import CPU_BOUND, PROCESS_POOL_SIZE
+from api import CACHEABLE, COALESCED_CALLS
+from api import METRICS_FILE, METRICS_INTERVAL, METRICS_REQUEST
+from api import STREAMS, STREAM_CREDIT_REQUEST, STREAM_TIMEOUT, STREAM_WINDOW
+from cache import ResultCache, cache_key
+from cancellation import CallCancelled, CancelToken, TOKEN_ARGUMENT
+from cancellation import accepts_token
+from executor import Executor
+from heartbeat import answer_heartbeats
+from metrics import Metrics, MetricsDumper
+from process_pool import ProcessPool
+from streams import StreamCredits
+from codec import available_codecs, choose_codec, get_codec
+from frames import extract_buffers, restore_buffers
+from protocol import ACK, ERROR, HELLO, READY, REQUEST, RESULT
+from protocol import frame_bytes, split_envelope
+from tracing import CALL_SPAN, get_trace_log
+from transport import BACKEND, HEARTBEAT, bind_address
+from transport import bind_server, connect_client, start_authenticator
+from transport import uses_curve
 from certificates import get_backend_certificates
 from utils import get_log_handler
 
@@ -23,73 +48,359 @@ class Backend(object):
     Backend server.
     Receives signals from backend_proxy and emit signals if needed.
     """
-    PORT = '5556'
-    BIND_ADDR = "tcp://127.0.0.1:%s" % PORT
+    BIND_ADDR = bind_address(BACKEND)
+    HEARTBEAT_ADDR = bind_address(HEARTBEAT)
 
-    def __init__(self):
+    # in-process channel used to wake up the worker loop, e.g. to stop it.
+    CONTROL_ADDR = "inproc://backend-control-%x"
+    CONTROL_STOP = "STOP"
+    CONTROL_REPLY = "REPLY"
+
+    # amount of request ids remembered to recognize the requests that a
+    # client sends again after reconnecting.
+    RECENT_REQUESTS = 1000
+
+    def __init__(self, codecs=None, signal_codec=None, pool_size=None,
+                 limits=None, connect_to=None, signals_connect_to=None,
+                 bind_addr=None, heartbeat_addr=None, signals_addr=None):
         """
         Backend constructor, create needed instances.
+
+        :param codecs: the names of the codecs accepted from the clients,
+                       all the available ones if None.
+        :type codecs: list of str
+        :param signal_codec: the name of the codec used to send the signals,
+                             the Signaler's default if None.
+        :type signal_codec: str
+        :param pool_size: the amount of threads used to run the API methods,
+                          api.POOL_SIZE if None.
+        :type pool_size: int
+        :param limits: the maximum concurrent calls per API method,
+                       api.CONCURRENCY_LIMITS if None.
+        :type limits: dict
+        :param connect_to: the address of a Broker to connect to as a worker,
+                           if None we bind BIND_ADDR and serve the clients
+                           directly.
+        :type connect_to: str
+        :param signals_connect_to: the address of a Broker's signals
+                                   forwarder to publish the signals through,
+                                   if None the Signaler binds its own
+                                   address.
+        :type signals_connect_to: str
+        :param bind_addr: the address to serve the clients on, BIND_ADDR if
+                          None. CURVE is only used for tcp addresses.
+        :type bind_addr: str
+        :param heartbeat_addr: the address to answer the heartbeats on,
+                               HEARTBEAT_ADDR if None.
+        :type heartbeat_addr: str
+        :param signals_addr: the address the Signaler binds, its BIND_ADDR
+                             if None.
+        :type signals_addr: str
         """
-        self._signaler = Signaler()
+        # The worker processes are forked before opening any socket.
+        self._process_pool = None
+        if CPU_BOUND:
+            self._process_pool = ProcessPool(PROCESS_POOL_SIZE)
+
+        self._signaler = self._create_signaler(signal_codec,
+                                               signals_connect_to,
+                                               signals_addr)
+        self._executor = Executor(pool_size or POOL_SIZE,
+                                  CONCURRENCY_LIMITS if limits is None
+                                  else limits)
+
+        self._cache = ResultCache(CACHEABLE)
+        # the callers waiting for a running call, {(method, key): [callers]}
+        self._in_flight = {}
+        self._streams = StreamCredits(STREAM_WINDOW)
+        # the tokens of the calls that can be cancelled and their call ids,
+        # {CancelToken: call id or None}.
+        self._cancel_tokens = {}
+        # whether each API method takes a token, {method: bool}
+        self._takes_token = {}
+
+        if codecs is None:
+            codecs = available_codecs()
+        self._codecs = codecs
 
         self._do_work = threading.Event()  # used to stop the worker thread.
         self._zmq_socket = None
+        self._heartbeat_socket = None
+        self._control_socket = None
+        self._control_waker = None
+
+        # {request_id: [envelope, whether it was answered]}, oldest first.
+        # Only used from the worker thread.
+        self._recent_requests = collections.OrderedDict()
 
         self._ongoing_defers = []
-        self._init_zmq()
+        self._init_zmq(connect_to, bind_addr or self.BIND_ADDR,
+                       heartbeat_addr or self.HEARTBEAT_ADDR)
+
+        self._metrics = Metrics()
+        self._metrics.gauge('runtime', self._runtime_stats)
+        self._metrics.gauge('cache', self._cache.stats)
+        self._metrics.gauge('coalescing', lambda: len(self._in_flight))
+        self._metrics.gauge('streams', self._streams.stats)
+
+        self._trace_log = get_trace_log()
+
+        self._metrics_dumper = None
+        if METRICS_FILE is not None:
+            self._metrics_dumper = MetricsDumper(self.metrics, METRICS_FILE,
+                                                 METRICS_INTERVAL)
+            self._metrics_dumper.start()
+
+    def _create_signaler(self, codec, connect_to, bind_addr):
+        """
+        Return the Signaler used to send the signals, see `Signaler`.
+
+        :rtype: Signaler
+        """
+        return Signaler(codec=codec, connect_to=connect_to,
+                        bind_addr=bind_addr)
 
-    def _init_zmq(self):
+    def _init_zmq(self, connect_to, bind_addr, heartbeat_addr):
         """
         Configure the zmq components and connection.
+
+        :param connect_to: the address of a Broker to connect to, None to
+                           bind `bind_addr`.
+        :type connect_to: str
+        :param bind_addr: the address to serve the clients on.
+        :type bind_addr: str
+        :param heartbeat_addr: the address to answer the heartbeats on.
+        :type heartbeat_addr: str
         """
         context = zmq.Context()
-        socket = context.socket(zmq.REP)
 
-        # Start an authenticator for this context.
-        auth = ThreadAuthenticator(context)
-        auth.start()
-        auth.allow('127.0.0.1')
+        if connect_to is None:
+            socket = context.socket(zmq.ROUTER)
 
-        # Tell authenticator to use the certificate in a directory
-        auth.configure_curve(domain='*', location=zmq.auth.CURVE_ALLOW_ANY)
-        public, secret = get_backend_certificates()
-        socket.curve_publickey = public
-        socket.curve_secretkey = secret
-        socket.curve_server = True  # must come before bind
+            if uses_curve(bind_addr) or uses_curve(heartbeat_addr):
+                # Start an authenticator for this context.
+                start_authenticator(context)
 
-        socket.bind(self.BIND_ADDR)
+            bind_server(socket, bind_addr, get_backend_certificates)
+
+            # liveness checks have their own socket, answered right away by
+            # the worker loop.
+            heartbeat = context.socket(zmq.ROUTER)
+            bind_server(heartbeat, heartbeat_addr, get_backend_certificates)
+            self._heartbeat_socket = heartbeat
+        else:
+            # we are a worker of the broker, a client of it. The requests
+            # arrive with the client envelope only, and are only sent to us
+            # once we are ready.
+            socket = context.socket(zmq.DEALER)
+            logger.debug("Connecting to broker at {0}".format(connect_to))
+            connect_client(socket, connect_to, get_backend_certificates)
+            socket.send(READY)
 
         self._zmq_socket = socket
 
+        # The worker blocks polling both the requests socket and this control
+        # pair, so it only wakes up when there is something to do.
+        control_addr = self.CONTROL_ADDR % id(self)
+        control = context.socket(zmq.PAIR)
+        control.bind(control_addr)  # must come before connect for inproc
+        waker = context.socket(zmq.PAIR)
+        waker.connect(control_addr)
+
+        self._control_socket = control
+        self._control_waker = waker
+        self._waker_lock = threading.Lock()
+
+    def _send_control(self, *frames):
+        """
+        Send a command to the worker loop.
+        This can be called from any thread.
+
+        :param frames: the command name followed by its arguments.
+        :type frames: tuple
+        """
+        with self._waker_lock:
+            self._control_waker.send_multipart(list(frames), copy=False)
+
     def _worker(self):
         """
         Receive requests and send it to process.
 
-        Note: we use a simple while since is less resource consuming than a
-        Twisted's LoopingCall.
+        Note: we block on a zmq.Poller instead of polling the socket in a
+        sleep loop, so requests are dispatched as soon as they arrive and the
+        idle backend does not wake up at all. The control socket is used to
+        interrupt the poll on `stop` and to send the replies from the worker
+        thread, since zmq sockets must not be shared between threads.
         """
+        poller = zmq.Poller()
+        poller.register(self._zmq_socket, zmq.POLLIN)
+        poller.register(self._control_socket, zmq.POLLIN)
+        if self._heartbeat_socket is not None:
+            poller.register(self._heartbeat_socket, zmq.POLLIN)
+
         while self._do_work.is_set():
-            # Wait for next request from client
+            socks = dict(poller.poll())
+
+            if socks.get(self._control_socket) == zmq.POLLIN:
+                command = self._control_socket.recv_multipart(copy=False)
+                name = frame_bytes(command[0])
+                if name == self.CONTROL_REPLY:
+                    self._forward_reply(command[1:])
+                elif name == self.CONTROL_STOP:
+                    logger.debug("Control command received: STOP")
+                    break
+
+            if socks.get(self._heartbeat_socket) == zmq.POLLIN:
+                answer_heartbeats(self._heartbeat_socket)
+
+            if socks.get(self._zmq_socket) == zmq.POLLIN:
+                self._receive_requests()
+
+        logger.debug("Backend worker stopped.")
+
+    def _receive_requests(self):
+        """
+        Acknowledge and process all the requests available in the socket.
+
+        Each request is acked as soon as it is received, so the clients can
+        keep sending requests without waiting for the previous ones. The
+        requests are processed in the reactor thread, where all the
+        bookkeeping of the running calls is done.
+
+        Note: messages are received without copying, the frames after the
+        payload are handed to the API methods as memoryviews.
+        """
+        while True:
             try:
-                request = self._zmq_socket.recv(zmq.NOBLOCK)
-                self._zmq_socket.send("OK")
-                logger.debug("Received request: '{0}'".format(request))
-                self._process_request(request)
+                frames = self._zmq_socket.recv_multipart(zmq.NOBLOCK,
+                                                         copy=False)
             except zmq.ZMQError as e:
                 if e.errno != zmq.EAGAIN:
                     raise
-            time.sleep(0.01)
+                break
+            received_at = time.time()
+
+            try:
+                envelope, body = split_envelope(frames)
+                request_id, kind = [frame_bytes(f) for f in body[:2]]
+            except ValueError:
+                logger.error("Malformed message received: {0!r}".format(
+                    frames))
+                continue
+
+            if kind == HELLO:
+                offered = frame_bytes(body[2]).split() if len(body) > 2 else []
+                codec_name = choose_codec(offered, self._codecs)
+                logger.debug("Client codec negotiated: '{0}'".format(
+                    codec_name))
+                self._zmq_socket.send_multipart(
+                    envelope + [request_id, HELLO, codec_name])
+                continue
+
+            if kind != REQUEST:
+                logger.error("Unknown message kind for #{0}: {1!r}".format(
+                    request_id, kind))
+                continue
+
+            try:
+                codec = get_codec(frame_bytes(body[2]))
+                request = frame_bytes(body[3])
+            except (IndexError, ValueError) as e:
+                logger.error("Invalid {0} message #{1}: {2!r}".format(
+                    kind, request_id, e))
+                continue
+
+            self._zmq_socket.send_multipart(envelope + [request_id, ACK])
+
+            if request_id in self._recent_requests:
+                self._repeated_request(request_id, envelope)
+                continue
+            self._remember_request(request_id, envelope)
+
+            logger.debug("Received request #{0}: '{1}'".format(
+                request_id, request))
+            reactor.callFromThread(self._process_request, request, codec,
+                                   envelope + [request_id], body[4:],
+                                   received_at)
+
+    def _remember_request(self, request_id, envelope):
+        """
+        Remember a request id, forgetting the oldest one if needed.
+
+        :param request_id: the id of the request.
+        :type request_id: str
+        :param envelope: the routing envelope of the request.
+        :type envelope: list of str
+        """
+        self._recent_requests[request_id] = [envelope, False]
+        if len(self._recent_requests) > self.RECENT_REQUESTS:
+            self._recent_requests.popitem(last=False)
+
+    def _repeated_request(self, request_id, envelope):
+        """
+        Handle a request that was already received, the client sent it again
+        after reconnecting. It is not run again, but its reply goes to the
+        new connection when it is ready.
+
+        The replies are not kept, to not pin large results in memory, so if
+        it was already answered the client is told that its result is lost.
+
+        :param request_id: the id of the request.
+        :type request_id: str
+        :param envelope: the routing envelope of the new connection.
+        :type envelope: list of str
+        """
+        logger.debug("Repeated request #{0} ignored.".format(request_id))
+        entry = self._recent_requests[request_id]
+        entry[0] = envelope
+        if entry[1]:
+            self._zmq_socket.send_multipart(envelope + [
+                request_id, ERROR,
+                "The result was sent to a previous connection."])
+
+    def _forward_reply(self, frames):
+        """
+        Send a reply sent through the control channel to the client, and
+        remember that the request was answered.
+
+        :param frames: the reply frames, see `_send_reply`.
+        :type frames: list
+        """
+        envelope, body = split_envelope(frames)
+        entry = self._recent_requests.get(frame_bytes(body[0]))
+        if entry is not None:
+            # the client may have reconnected since the request was sent.
+            envelope = entry[0]
+            entry[1] = True
+
+        self._zmq_socket.send_multipart(envelope + body, copy=False)
+
+    def _send_reply(self, reply_to, kind, *body):
+        """
+        Send a reply for a request through the worker loop.
+
+        :param reply_to: the routing envelope and the id of the request.
+        :type reply_to: list
+        :param kind: the kind of reply, see `protocol`.
+        :type kind: str
+        :param body: extra frames to send, str or buffers.
+        :type body: tuple
+        """
+        self._send_control(self.CONTROL_REPLY, *(reply_to + [kind] +
+                                                 list(body)))
 
     def _stop_reactor(self):
         """
-        Stop the Twisted reactor, but first wait a little for some threads to
-        complete their work.
+        Stop the Twisted reactor, but first cancel the running calls and
+        wait a little for their threads to complete their work.
 
         Note: this method needs to be run in a different thread so the
         time.sleep() does not block and other threads can finish.
         i.e.:
             use threads.deferToThread(this_method) instead of this_method()
         """
+        reactor.callFromThread(self._cancel_running)
+
         wait_max = 5  # seconds
         wait_step = 0.5
         wait = 0
@@ -100,10 +411,18 @@ class Backend(object):
             msg = msg.format(wait, wait_max)
             logger.debug(msg)
 
-        # after a timeout we shut down the existing threads.
-        for d in self._ongoing_defers:
+        reactor.callFromThread(self._shutdown)
+
+    def _shutdown(self):
+        """
+        Cancel the calls that did not finish yet and stop the reactor.
+        """
+        for d in list(self._ongoing_defers):
             d.cancel()
 
+        if self._process_pool is not None:
+            self._process_pool.stop()
+
         reactor.stop()
         logger.debug("Twisted reactor stopped.")
 
@@ -113,6 +432,7 @@ class Backend(object):
         """
         self._signaler.start()
         self._do_work.set()
+        reactor.callWhenRunning(self._executor.start)
         threads.deferToThread(self._worker)
         reactor.run()
 
@@ -122,80 +442,647 @@ class Backend(object):
         """
         logger.debug("STOP received.")
         self._signaler.stop()
+        if self._metrics_dumper is not None:
+            self._metrics_dumper.stop()
         self._do_work.clear()
+        self._send_control(self.CONTROL_STOP)
         threads.deferToThread(self._stop_reactor)
 
-    def _process_request(self, request_json):
+    def metrics(self):
+        """
+        Return the backend and signaler metrics: calls, errors and latency
+        histograms per API method, running calls, thread pool usage, queue
+        depths, etc.
+        This is also the reserved 'metrics' API method.
+
+        :rtype: dict
+        """
+        return {
+            'backend': self._metrics.snapshot(),
+            'signaler': self._signaler.metrics(),
+        }
+
+    def _runtime_stats(self):
+        """
+        Return the amount of running calls and the thread pool usage.
+
+        :rtype: dict
+        """
+        return {
+            'ongoing_calls': len(self._ongoing_defers),
+            'executor': self._executor.stats(),
+        }
+
+    def _process_request(self, request_data, codec, reply_to=None,
+                         buffers=None, received_at=None):
         """
         Process a request and call the according method with the given
         parameters.
 
-        :param request_json: a json specification of a request.
-        :type request_json: str
+        :param request_data: a serialized specification of a request.
+        :type request_data: str
+        :param codec: the codec used to serialize the request.
+        :type codec: object
+        :param reply_to: the routing envelope and the id of the request, used
+                         to send back the result if the request asks for it.
+        :type reply_to: list
+        :param buffers: the binary arguments received as separate frames.
+        :type buffers: list of zmq.Frame
+        :param received_at: when the request was received, as given by
+                            time.time().
+        :type received_at: float
         """
-        if request_json == PING_REQUEST:
+        dispatched_at = time.time()
+        if request_data == PING_REQUEST:
             # do not process request if it's just a ping
             return
 
         try:
-            # request = zmq.utils.jsonapi.loads(request_json)
-            # We use stdlib's json to ensure that we get unicode strings
-            request = json.loads(request_json)
+            request = codec.loads(request_data)
             api_method = request['api_method']
-            kwargs = request['arguments'] or None
+            kwargs = restore_buffers(request['arguments'], buffers) or None
+            wants_reply = request.get('reply', False)
         except Exception as e:
-            msg = "Malformed JSON data in Backend request '{0}'. Exc: {1!r}"
-            msg = msg.format(request_json, e)
-            msg = msg.format(request_json)
+            msg = "Malformed {0} data in Backend request '{1}'. Exc: {2!r}"
+            msg = msg.format(codec.name, request_data, e)
             logger.critical(msg)
             raise
 
+        # the request id names the call, to cancel it, when it gets a reply,
+        # or to give credits to its stream.
+        call_id = reply_to[-1] if reply_to else None
+        if not wants_reply:
+            reply_to = None
+
+        trace = None
+        if self._trace_log is not None and request.get('trace'):
+            # the hops are stamped by the thread running the call, the
+            # record is written once it finishes.
+            trace = (request['trace'], {'received': received_at,
+                                        'dispatched': dispatched_at})
+
+        # binary arguments can not tell identical calls apart.
+        arguments = None if buffers else request['arguments']
+        self._process_call(api_method, kwargs, arguments, reply_to, codec,
+                           trace, request.get('deadline'), call_id)
+
+    def _process_call(self, api_method, kwargs, arguments, reply_to=None,
+                      codec=None, trace=None, deadline=None, call_id=None):
+        """
+        Run an API method call, or answer it from the cache or from an
+        identical running call.
+
+        :param api_method: the method name.
+        :type api_method: str
+        :param kwargs: the arguments for the method, None if there are none.
+        :type kwargs: dict
+        :param arguments: the arguments used to recognize identical calls,
+                          None if they can not be used for it.
+        :type arguments: dict
+        :param reply_to: where to send the method's result, None if no reply
+                         is needed.
+        :type reply_to: list
+        :param codec: the codec used to serialize the result.
+        :type codec: object
+        :param trace: the trace id of the call and the hops stamped so far,
+                      None if the call is not traced.
+        :type trace: tuple(str, dict)
+        :param deadline: when the call expires, as given by time.time(), None
+                         if it does not.
+        :type deadline: float
+        :param call_id: the id of the call, i.e. its request id, used to
+                        cancel it and to name its stream, None if it has
+                        none.
+        :type call_id: str
+        """
         if api_method not in API:
             logger.error("Invalid API call '{0}'".format(api_method))
+            if reply_to is not None:
+                self._send_reply(reply_to, ERROR,
+                                 "Invalid API call '{0}'".format(api_method))
+            return
+
+        if api_method == STOP_REQUEST:
+            # stop right away, it must not wait behind the queued calls.
+            self.stop()
             return
 
-        self._run_in_thread(api_method, kwargs)
+        if api_method == METRICS_REQUEST:
+            # answer right away too, it is not a call to measure.
+            self._done_action(self.metrics(), None, reply_to, codec)
+            return
+
+        if api_method == STREAM_CREDIT_REQUEST:
+            # the stream is waiting for it, it must not queue behind it.
+            self._streams.grant(**(kwargs or {}))
+            self._done_action(None, None, reply_to, codec)
+            return
+
+        if api_method == CANCEL_REQUEST:
+            # the call to cancel may be running, do it right away.
+            self._cancel_call(**(kwargs or {}))
+            self._done_action(None, None, reply_to, codec)
+            return
+
+        if deadline is not None and deadline <= time.time():
+            logger.debug("Dropping expired call '{0}'.".format(api_method))
+            self._metrics.increment('expired.' + api_method)
+            self._trace_finished(trace, finished=False)
+            if reply_to is not None:
+                self._send_reply(reply_to, ERROR,
+                                 "Call deadline exceeded before it started.")
+            return
+
+        self._metrics.increment('calls.' + api_method)
+
+        key = None
+        if api_method in self._cache or api_method in COALESCED_CALLS:
+            if arguments is not None:
+                key = cache_key(arguments)
+
+        if key is not None and api_method in self._cache:
+            cached = self._cache.get(api_method, key)
+            if cached is not None:
+                logger.debug("Answering '{0}' from cache.".format(api_method))
+                self._replay_cached(cached, reply_to, codec, trace)
+                return
+
+        if key is not None and api_method in COALESCED_CALLS:
+            waiting = self._in_flight.get((api_method, key))
+            if waiting is not None:
+                logger.debug("Coalescing '{0}' with the running call."
+                             .format(api_method))
+                self._metrics.increment('coalesced.' + api_method)
+                waiting.append((reply_to, codec))
+                self._trace_finished(trace, finished=False)
+                return
+            self._in_flight[(api_method, key)] = []
+            # other callers may join the call, one of them can not stop it.
+            deadline = call_id = None
+
+        self._run_in_thread(api_method, kwargs, reply_to, codec, key, trace,
+                            deadline, call_id)
+
+    def _replay_cached(self, cached, reply_to, codec, trace=None):
+        """
+        Send again the signals of a cached call and its result if needed.
+        The signals are sent from a thread, the reactor must not wait for
+        room in the signals queue.
+
+        :param cached: the call result and the signals it sent.
+        :type cached: tuple(object, list)
+        :param reply_to: where to send the result, None if no reply is needed.
+        :type reply_to: list
+        :param codec: the codec used to serialize the result.
+        :type codec: object
+        :param trace: the trace of the call, None if it is not traced.
+        :type trace: tuple(str, dict)
+        """
+        result, signals = cached
+        if not signals:
+            self._trace_finished(trace)
+            self._done_action(result, None, reply_to, codec)
+            return
+
+        d = threads.deferToThread(self._replay_signals, signals,
+                                  trace and trace[0])
+        d.addCallback(self._replayed, result, trace)
+        d.addCallbacks(self._done_action, self._failed_action,
+                       callbackArgs=(d, reply_to, codec),
+                       errbackArgs=(d, reply_to))
+        self._ongoing_defers.append(d)
+
+    def _replay_signals(self, signals, trace_id=None):
+        """
+        Send the recorded signals of a cached call.
+        This is run in a thread, it may wait for room in the signals queue.
+
+        :param signals: the signals and their data.
+        :type signals: list of tuple(str, object)
+        :param trace_id: the trace id the signals belong to, None if the call
+                         is not traced.
+        :type trace_id: str
+        """
+        with self._signaler.tracing(trace_id):
+            for signal, data in signals:
+                self._signaler.signal(signal, data)
+
+    def _replayed(self, _, result, trace):
+        """
+        Finish the trace of a call answered from the cache once its signals
+        were sent.
+
+        :return: the cached result.
+        :rtype: object
+        """
+        self._trace_finished(trace)
+        return result
+
+    def invalidate_cache(self, *methods):
+        """
+        Discard the cached results of the given API methods, or all of them
+        if none is given.
+        This can be called from the API methods.
+
+        :param methods: the API method names.
+        :type methods: tuple of str
+        """
+        self._cache.invalidate(*methods)
+
+    def cache_stats(self):
+        """
+        Return the amount of cached results and the hits and misses for each
+        cacheable API method.
+
+        :rtype: dict
+        """
+        return self._cache.stats()
 
-    def _run_in_thread(self, api_method, kwargs):
+    def _run_in_thread(self, api_method, kwargs, reply_to=None, codec=None,
+                       key=None, trace=None, deadline=None, call_id=None):
         """
         Run the method name in a thread with the given arguments.
+        The call may wait in the executor if the method has reached its
+        concurrency limit, it is dropped if it is cancelled or expires
+        meanwhile. CPU bound methods are run in the process pool, they can
+        not be cancelled once they are submitted.
 
         :param api_method: the callable name to run in a thread.
         :type api_method: str
         :param kwargs: the arguments dict that will be sent to the callable.
         :type kwargs: tuple
+        :param reply_to: where to send the method's result, None if no reply
+                         is needed.
+        :type reply_to: list
+        :param codec: the codec used to serialize the result.
+        :type codec: object
+        :param key: the key of the call arguments, see `cache_key`, None if
+                    the call is neither cached nor coalesced.
+        :type key: str
+        :param trace: the trace id of the call and the hops stamped so far,
+                      None if the call is not traced.
+        :type trace: tuple(str, dict)
+        :param deadline: when the call expires, None if it does not.
+        :type deadline: float
+        :param call_id: the id of the call, i.e. its request id, used to
+                        cancel it and to name its stream, None if it has
+                        none.
+        :type call_id: str
         """
-        func = getattr(self, api_method)
+        started = time.time()
+        token = None
+        cached = key is not None and api_method in self._cache
+        signals = None
+        if cached:
+            # the signals are recorded to send them again on cache hits.
+            signals = []
+            generation = self._cache.generation(api_method)
+
+        if api_method in CPU_BOUND:
+            logger.debug("Running method: '{0}' with args: '{1}' in a "
+                         "process".format(api_method, kwargs))
+            d = self._process_pool.submit(self._api_class, api_method,
+                                          kwargs or {}, self._signaler,
+                                          record=signals,
+                                          trace=trace and trace[0])
+        else:
+            func = getattr(self, api_method)
+            # only the calls that get a reply can be cancelled.
+            token, kwargs = self._with_token(
+                api_method, kwargs, deadline,
+                call_id if reply_to is not None else None)
 
-        method = func
-        if kwargs is not None:
-            method = lambda: func(**kwargs)
+            method = func
+            if kwargs is not None:
+                method = lambda: func(**kwargs)
+            if api_method in STREAMS:
+                method = functools.partial(self._streamed, method,
+                                           STREAMS[api_method], token,
+                                           call_id)
+            if signals is not None:
+                method = functools.partial(self._recorded, method, signals)
+            if trace is not None:
+                method = functools.partial(self._traced, method, trace)
+            if token is not None:
+                method = functools.partial(self._guarded, method, token)
 
-        logger.debug("Running method: '{0}' "
-                     "with args: '{1}' in a thread".format(api_method, kwargs))
+            logger.debug("Running method: '{0}' with args: '{1}' in a "
+                         "thread".format(api_method, kwargs))
 
-        # run the action in a thread and keep track of it
-        d = threads.deferToThread(method)
-        d.addCallback(self._done_action, d)
-        d.addErrback(self._done_action, d)
+            # run the action in a thread and keep track of it
+            d = self._executor.submit(api_method, method)
+
+        d.addBoth(self._observe_call, api_method, started)
+        if token is not None:
+            d.addBoth(self._forget_token, token)
+        if trace is not None:
+            d.addBoth(self._trace_call, trace)
+        if cached:
+            d.addCallback(self._cache_result, api_method, key, signals,
+                          generation)
+        if (api_method, key) in self._in_flight:
+            d.addBoth(self._fan_out, api_method, key)
+        d.addCallbacks(self._done_action, self._failed_action,
+                       callbackArgs=(d, reply_to, codec),
+                       errbackArgs=(d, reply_to))
         self._ongoing_defers.append(d)
 
-    def _done_action(self, failure, d):
+    def _observe_call(self, outcome, api_method, started):
+        """
+        Measure a finished call.
+
+        :return: the outcome, unchanged.
+        :rtype: object or twisted.python.failure.Failure
+        """
+        self._call_finished(api_method, started,
+                            failed=isinstance(outcome, Failure))
+        return outcome
+
+    def _call_finished(self, api_method, started, failed=False):
+        """
+        Add the latency of a finished call to the metrics.
+
+        :param api_method: the method name.
+        :type api_method: str
+        :param started: when the call started, as given by time.time().
+        :type started: float
+        :param failed: whether the call failed.
+        :type failed: bool
+        """
+        self._metrics.observe('latency.' + api_method, time.time() - started)
+        if failed:
+            self._metrics.increment('errors.' + api_method)
+
+    def _traced(self, method, trace):
+        """
+        Run a traced method, stamping when it starts. The signals it sends
+        belong to its trace.
+        This is run in the executor thread.
+        """
+        trace[1]['started'] = time.time()
+        with self._signaler.tracing(trace[0]):
+            return method()
+
+    def _trace_call(self, outcome, trace):
+        """
+        Write the trace of a finished call.
+
+        :return: the outcome, unchanged.
+        :rtype: object or twisted.python.failure.Failure
+        """
+        self._trace_finished(trace)
+        return outcome
+
+    def _trace_finished(self, trace, finished=True):
+        """
+        Stamp the end of a call and write its hops to the trace log.
+
+        :param trace: the trace of the call, None if it is not traced.
+        :type trace: tuple(str, dict)
+        :param finished: whether the call finished, False if it is handed
+                         to a running call.
+        :type finished: bool
+        """
+        if trace is None:
+            return
+
+        trace_id, hops = trace
+        if finished:
+            hops['finished'] = time.time()
+        self._trace_log.write(trace_id, CALL_SPAN, hops)
+
+    @property
+    def _api_class(self):
+        """
+        The class implementing the API methods, it is sent to the process
+        pool so it must be importable by its name.
+
+        :rtype: type
+        """
+        return type(self)
+
+    def _with_token(self, api_method, kwargs, deadline, call_id):
+        """
+        Create the cancel token of a call, if it needs one, and add it to the
+        arguments if the method takes it, see `cancellation`.
+
+        :param api_method: the method name.
+        :type api_method: str
+        :param kwargs: the arguments for the method, None if there are none.
+        :type kwargs: dict
+        :param deadline: when the call expires, None if it does not.
+        :type deadline: float
+        :param call_id: the id used to cancel the call, None if it can not be
+                        cancelled.
+        :type call_id: str
+
+        :return: the token, None if the call does not need it, and the
+                 arguments for the method.
+        :rtype: tuple(CancelToken, dict)
+        """
+        takes_token = self._takes_token.get(api_method)
+        if takes_token is None:
+            takes_token = accepts_token(getattr(self, api_method))
+            self._takes_token[api_method] = takes_token
+
+        # the streams need one to stop waiting for credits, see `_streamed`.
+        if (deadline is None and call_id is None and not takes_token and
+                api_method not in STREAMS):
+            return None, kwargs
+
+        token = CancelToken(deadline)
+        self._cancel_tokens[token] = call_id
+        if takes_token:
+            kwargs = dict(kwargs or {})
+            kwargs[TOKEN_ARGUMENT] = token
+        return token, kwargs
+
+    def _forget_token(self, outcome, token):
+        """
+        Forget the cancel token of a finished call.
+
+        :return: the outcome, unchanged.
+        :rtype: object or twisted.python.failure.Failure
+        """
+        self._cancel_tokens.pop(token, None)
+        return outcome
+
+    def _cancel_call(self, call):
+        """
+        Cancel a running or waiting call.
+        This is the reserved 'cancel' API method, hence the argument name.
+
+        :param call: the id of the call, i.e. its request id.
+        :type call: str
+        """
+        for token, call_id in self._cancel_tokens.items():
+            if call_id == call:
+                logger.debug("Cancelling call #{0}.".format(call))
+                self._metrics.increment('cancelled')
+                token.cancel()
+                self._streams.interrupt()
+                return
+
+    def _cancel_running(self):
+        """
+        Cancel all the running and waiting calls, e.g. on stop.
+        """
+        for token in list(self._cancel_tokens):
+            token.cancel()
+        self._streams.interrupt()
+
+    def _guarded(self, method, token):
+        """
+        Run a method unless its call was cancelled, or its deadline passed,
+        while it waited for a thread.
+        This is run in the executor thread.
+        """
+        token.raise_if_cancelled()
+        return method()
+
+    def _streamed(self, method, signal, token=None, stream_id=None):
         """
-        Remove the defer from the ongoing list.
+        Run a generator method sending each chunk it yields as `signal`,
+        once the consumer has granted a credit for it, see `base.streams`.
+        This is run in the executor thread, which waits for the credits.
+        The stream stops if its call is cancelled.
+
+        The stream is named after its call, so behind a Broker the credits
+        reach this worker, or gets a random id if the call has none.
+
+        :return: the stream id and the amount of chunks sent, or what the
+                 method returned if it is not a generator.
+        :rtype: dict or object
+
+        :raise Exception: if the method fails or no credit is granted within
+                          STREAM_TIMEOUT, the stream is ended with the error.
+        """
+        chunks = method()
+        if not inspect.isgenerator(chunks):
+            return chunks
+
+        if stream_id is None:
+            stream_id = binascii.hexlify(os.urandom(8))
+        self._streams.open(stream_id)
+        seq = 0
+        try:
+            for chunk in chunks:
+                if not self._streams.acquire(stream_id, STREAM_TIMEOUT,
+                                             token):
+                    raise Exception("Stream '{0}' stalled, no credit was "
+                                    "granted in {1} secs".format(
+                                        stream_id, STREAM_TIMEOUT))
+                self._signaler.signal(signal, {'stream': stream_id,
+                                               'seq': seq, 'chunk': chunk})
+                seq += 1
+        except Exception as e:
+            self._signaler.signal(signal, {'stream': stream_id, 'seq': seq,
+                                           'end': True, 'error': str(e)})
+            raise
+        finally:
+            self._streams.close(stream_id)
+            chunks.close()
+
+        self._signaler.signal(signal, {'stream': stream_id, 'seq': seq,
+                                       'end': True})
+        return {'stream': stream_id, 'chunks': seq}
+
+    def _recorded(self, method, signals):
+        """
+        Run a method adding the signals it sends to `signals`.
+        This is run in the executor thread.
+        """
+        with self._signaler.record(signals):
+            return method()
+
+    def _cache_result(self, result, api_method, key, signals, generation):
+        """
+        Store the result of a call and the signals it sent in the cache.
+
+        :return: the result, unchanged.
+        :rtype: object
+        """
+        self._cache.put(api_method, key, (result, signals), generation)
+        return result
+
+    def _fan_out(self, outcome, api_method, key):
+        """
+        Send the result, or the error, of a finished call to the callers
+        whose identical calls were coalesced with it.
+
+        :param outcome: the call result or failure.
+        :type outcome: object or twisted.python.failure.Failure
+        :param api_method: the method name.
+        :type api_method: str
+        :param key: the key of the call arguments.
+        :type key: str
+
+        :return: the outcome, unchanged.
+        :rtype: object or twisted.python.failure.Failure
+        """
+        waiting = self._in_flight.pop((api_method, key), [])
+        for reply_to, codec in waiting:
+            if reply_to is None:
+                continue
+            if isinstance(outcome, Failure):
+                self._send_reply(reply_to, ERROR, outcome.getErrorMessage())
+            else:
+                self._done_action(outcome, None, reply_to, codec)
+        return outcome
+
+    def _done_action(self, result, d, reply_to, codec):
+        """
+        Send back the result if needed and remove the defer from the ongoing
+        list.
+
+        :param result: the value returned by the API method.
+        :type result: object
+        :param d: defer to remove
+        :type d: twisted.internet.defer.Deferred
+        :param reply_to: where to send the result, None if no reply is needed.
+        :type reply_to: list
+        :param codec: the codec used to serialize the result.
+        :type codec: object
+        """
+        if reply_to is not None:
+            result, buffers = extract_buffers(result)
+            try:
+                result_data = codec.dumps(result)
+            except Exception as e:
+                msg = "Error serializing result into {0}: {1!r}".format(
+                    codec.name, e)
+                logger.error(msg)
+                self._send_reply(reply_to, ERROR, msg)
+            else:
+                self._send_reply(reply_to, RESULT, codec.name, result_data,
+                                 *buffers)
+
+        if d in self._ongoing_defers:
+            self._ongoing_defers.remove(d)
+
+    def _failed_action(self, failure, d, reply_to):
+        """
+        Log the failure, send back the error if needed and remove the defer
+        from the ongoing list.
 
         :param failure: the failure that triggered the errback.
-                        None if no error.
         :type failure: twisted.python.failure.Failure
         :param d: defer to remove
         :type d: twisted.internet.defer.Deferred
+        :param reply_to: where to send the error, None if no reply is needed.
+        :type reply_to: list
         """
-        if failure is not None:
-            if failure.check(defer.CancelledError):
-                logger.debug("A defer was cancelled.")
-            else:
-                logger.error("There was a failure - {0!r}".format(failure))
-                logger.error(failure.getTraceback())
+        if failure.check(defer.CancelledError):
+            logger.debug("A defer was cancelled.")
+        elif failure.check(CallCancelled):
+            logger.debug("A call was cancelled: {0}".format(
+                failure.getErrorMessage()))
+        else:
+            logger.error("There was a failure - {0!r}".format(failure))
+            logger.error(failure.getTraceback())
+
+        if reply_to is not None:
+            self._send_reply(reply_to, ERROR, failure.getErrorMessage())
 
         if d in self._ongoing_defers:
             self._ongoing_defers.remove(d)
@@ -1,13 +1,31 @@
 #!/usr/bin/env python
 # encoding: utf-8
+import binascii
+import collections
 import functools
+import heapq
+import itertools
+import os
 import Queue
 import threading
 import time
 
 import zmq
 
-from api import API, STOP_REQUEST, PING_REQUEST
+from api import API, CANCEL_REQUEST, STOP_REQUEST, STREAM_CREDIT_REQUEST
+from api import CALL_POLICIES, CALL_POLICY, CALL_QUEUE_SIZE, COALESCED_CALLS
+from api import CALL_TIMEOUTS
+from cache import cache_key
+from codec import DEFAULT_CODEC, get_codec
+from frames import extract_buffers, restore_buffers
+from future import BackendError, Future
+from heartbeat import HeartbeatMonitor
+from metrics import Metrics
+from queues import BoundedQueue
+from protocol import ACK, ERROR, HELLO, REQUEST, RESULT, frame_bytes
+from protocol import follow_request
+from tracing import CALL_SPAN, get_trace_log, new_trace_id
+from transport import BACKEND, HEARTBEAT, connect_address, connect_client
 from certificates import get_backend_certificates
 from utils import get_log_handler
 
@@ -19,87 +37,523 @@ class BackendProxy(object):
     The BackendProxy handles calls from the GUI and forwards (through ZMQ)
     to the backend.
     """
-    PORT = '5556'
-    SERVER = "tcp://localhost:%s" % PORT
+    SERVER = connect_address(BACKEND)
 
-    POLL_TIMEOUT = 4000  # ms
-    POLL_TRIES = 3
+    # in-process channel used to wake up the worker loop when a call is made.
+    CONTROL_ADDR = "inproc://backend-proxy-control-%x"
+    CONTROL_RECONNECT = "RECONNECT"
 
+    # time to wait for a request to be acknowledged before retrying it, and
+    # how many times it is sent before giving up on it.
+    REQUEST_TIMEOUT = 4  # secs
+    REQUEST_RETRIES = 3
+
+    # time to wait before reconnecting after a timeout, doubled after each
+    # consecutive timeout up to RECONNECT_BACKOFF_MAX.
+    RECONNECT_BACKOFF = 0.05  # secs
+    RECONNECT_BACKOFF_MAX = 5  # secs
+
+    # the most requests sent and not yet acknowledged, and sent and waiting
+    # for their result. The calls over them wait in the calls queue, where
+    # its overflow policies apply.
+    MAX_UNACKED = 100
+    MAX_UNANSWERED = 100
+
+    # reserved methods sent right away, ahead of the queued calls.
+    URGENT_CALLS = (CANCEL_REQUEST, STREAM_CREDIT_REQUEST)
+
+    # the argument of these reserved methods naming the call they are about,
+    # their requests follow it so behind a Broker they reach its worker.
+    FOLLOWING_CALLS = {STREAM_CREDIT_REQUEST: 'stream', CANCEL_REQUEST: 'call'}
+
+    # the backend liveness is checked on its own heartbeat channel.
+    HEARTBEAT_SERVER = connect_address(HEARTBEAT)
     PING_INTERVAL = 2  # secs
+    PING_TIMEOUT = 2  # secs
 
-    def __init__(self):
+    def __init__(self, codecs=None, server=None, heartbeat_server=None):
+        """
+        Connect to the backend and start the worker thread.
+
+        :param codecs: the names of the codecs to offer to the backend, in
+                       order of preference. Only the default one if None.
+        :type codecs: list of str
+        :param server: the address of the backend, SERVER if None. CURVE is
+                       only used for tcp addresses.
+        :type server: str
+        :param heartbeat_server: the address of the backend's heartbeat
+                                 socket, HEARTBEAT_SERVER if None.
+        :type heartbeat_server: str
+        """
+        self._server = server or self.SERVER
         self._socket = None
+        self._poller = None
 
         # initialize ZMQ stuff:
         context = zmq.Context()
-        logger.debug("Connecting to server...")
-        socket = context.socket(zmq.REQ)
-
-        # public, secret = zmq.curve_keypair()
-        client_keys = zmq.curve_keypair()
-        socket.curve_publickey = client_keys[0]
-        socket.curve_secretkey = client_keys[1]
+        self._context = context
+        self._connect()
+
+        # The worker loop polls both the backend socket and this control
+        # pair, the callers use the waker to notify about queued calls.
+        control_addr = self.CONTROL_ADDR % id(self)
+        control = context.socket(zmq.PAIR)
+        control.bind(control_addr)  # must come before connect for inproc
+        waker = context.socket(zmq.PAIR)
+        waker.connect(control_addr)
+        self._control_socket = control
+        self._control_waker = waker
+        self._waker_lock = threading.Lock()
+
+        self._heartbeat = HeartbeatMonitor(
+            context, heartbeat_server or self.HEARTBEAT_SERVER,
+            get_backend_certificates, self.PING_INTERVAL, self.PING_TIMEOUT,
+            on_back_online=self._backend_back_online)
+        self._heartbeat.start()
+
+        # the default codec is used until the backend chooses one.
+        if codecs is None:
+            codecs = [DEFAULT_CODEC]
+        for name in codecs:
+            get_codec(name)  # fail early on unknown codecs
+        self._offered_codecs = codecs
+        self._codec = get_codec(DEFAULT_CODEC)
+
+        # requests sent and not yet acknowledged, in the order they were
+        # sent, {request_id: [sent_time, tries, request]}. The request is
+        # kept to resend it after reconnecting, it is None for the hellos.
+        self._pending = collections.OrderedDict()
+        # requests waiting for a result, {request_id: Future}
+        self._futures = {}
+        # requests sent that wait for a result, in the order they were
+        # sent, {request_id: (sent_time, request)}. They are sent again
+        # after reconnecting, since the result would go to the old
+        # connection. Only used from the worker thread.
+        self._unanswered = collections.OrderedDict()
+        # deadlines of the requests sent, as a heap of (deadline, request_id)
+        # tuples. Only used from the worker thread.
+        self._deadlines = []
+        # the coalesced calls in flight, {(method, key): (Future, callers)}
+        # where callers is the set of futures of the callers still waiting.
+        self._in_flight = {}
+        # deadlines of the callers of the coalesced calls, as a heap of
+        # (deadline, caller, key, Future) tuples.
+        self._caller_deadlines = []
+        self._in_flight_lock = threading.Lock()
+
+        # the ids are unique across proxies, so the backend can recognize
+        # the requests that are sent again after a reconnection.
+        self._session = binascii.hexlify(os.urandom(4))
+        self._request_ids = itertools.count()
+
+        # when to reconnect, None if no reconnection is scheduled.
+        self._reconnect_at = None
+        self._backoff = self.RECONNECT_BACKOFF
+
+        self._call_queue = BoundedQueue(CALL_QUEUE_SIZE, policy=CALL_POLICY,
+                                        policies=CALL_POLICIES,
+                                        on_drop=self._call_dropped)
+        # the urgent calls, see URGENT_CALLS, and the stop call once it is
+        # made, the queued calls are sent before it no matter the limits.
+        self._urgent_calls = collections.deque()
+        self._stop_request = None
+
+        self._metrics = Metrics()
+        self._metrics.gauge('call_queue', self._call_queue.stats)
+        self._metrics.gauge('unacked', lambda: len(self._pending))
+        self._metrics.gauge('waiting_results', lambda: len(self._futures))
+
+        self._trace_log = get_trace_log()
 
-        # The client must know the server's public key to make a CURVE
-        # connection.
-        public, _ = get_backend_certificates()
-        socket.curve_serverkey = public
+        self._worker_caller = threading.Thread(target=self._worker)
+        self._worker_caller.start()
 
-        socket.setsockopt(zmq.RCVTIMEO, 1000)
+    def _connect(self):
+        """
+        Create the socket used to talk to the backend and connect it.
+        A new CURVE keypair is used on each connection.
+        """
+        logger.debug("Connecting to server...")
+        socket = self._context.socket(zmq.DEALER)
         socket.setsockopt(zmq.LINGER, 0)  # Terminate early
-        socket.connect(self.SERVER)
+        connect_client(socket, self._server, get_backend_certificates)
         self._socket = socket
 
-        self._ping_at = 0
-        self.online = False
+    def _reconnect(self):
+        """
+        Replace the socket with a new one and send again, in the same
+        order, the requests that were not acknowledged and the ones still
+        waiting for a result.
 
-        self._call_queue = Queue.Queue()
-        self._worker_caller = threading.Thread(target=self._worker)
-        self._worker_caller.start()
+        Note: the messages queued in the old socket, or lost with a backend
+        that went away, are discarded along with it. The backend ignores the
+        requests it already received and acks them again.
+        """
+        logger.warning("Reconnecting to backend, {0} requests to resend."
+                       .format(len(self._pending) + len(self._unanswered)))
+        self._metrics.increment('reconnections')
+        self._reconnect_at = None
+
+        self._poller.unregister(self._socket)
+        self._socket.close()
+        self._connect()
+        self._poller.register(self._socket, zmq.POLLIN)
+
+        # the hello is sent first, the stale ones are not sent again.
+        pending = [entry for entry in self._pending.values()
+                   if entry[2] is not None]
+        for request_id, (sent_at, request) in self._unanswered.items():
+            future = self._futures.get(request_id)
+            if future is None or future.done():
+                del self._unanswered[request_id]  # cancelled or expired
+            elif request_id not in self._pending:
+                pending.append([sent_at, 1, request])
+        pending.sort(key=lambda entry: entry[0])
+
+        self._pending.clear()
+        self._send_hello()
+        for _, tries, request in pending:
+            self._send_request(*request, tries=tries + 1)
+
+    def _schedule_reconnect(self):
+        """
+        Schedule a reconnection after the current backoff time, and double
+        it for the next one.
+        """
+        logger.debug("Reconnecting in {0} secs.".format(self._backoff))
+        self._reconnect_at = time.time() + self._backoff
+        self._backoff = min(self._backoff * 2, self.RECONNECT_BACKOFF_MAX)
+
+    def _backend_back_online(self):
+        """
+        Reconnect right away when the heartbeat finds the backend again, the
+        requests sent while it was away were lost.
+        This is run in the heartbeat thread.
+        """
+        self._wake_up(self.CONTROL_RECONNECT)
+
+    def _next_timeout(self):
+        """
+        Return how long the worker loop can wait for the sockets, until the
+        scheduled reconnection, the oldest request times out or the next
+        deadline.
+
+        :return: the timeout in milliseconds, None to wait forever.
+        :rtype: float
+        """
+        wake_at = None
+        if self._reconnect_at is not None:
+            wake_at = self._reconnect_at
+        elif self._pending:
+            sent_at = next(self._pending.itervalues())[0]
+            wake_at = sent_at + self.REQUEST_TIMEOUT
+
+        deadlines = [self._deadlines[0][0]] if self._deadlines else []
+        with self._in_flight_lock:
+            if self._caller_deadlines:
+                deadlines.append(self._caller_deadlines[0][0])
+        if deadlines:
+            deadline = min(deadlines)
+            wake_at = deadline if wake_at is None else min(wake_at, deadline)
+
+        if wake_at is None:
+            return None
+        return max(0, wake_at - time.time()) * 1000
 
     def _worker(self):
         """
-        Worker loop that processes the Queue of pending requests to do.
+        Worker loop that processes the Queue of pending requests to do and
+        the replies from the backend.
+
+        Note: the loop blocks polling the sockets until a call is queued, a
+        reply arrives or a request times out. Requests are sent without
+        waiting for the previous ones to be acknowledged, up to MAX_UNACKED
+        of them, see `_send_queued`.
+        """
+        self._poller = poller = zmq.Poller()
+        poller.register(self._socket, zmq.POLLIN)
+        poller.register(self._control_socket, zmq.POLLIN)
+
+        self._send_hello()
+
+        running = True
+        while running:
+            socks = dict(poller.poll(self._next_timeout()))
+
+            if socks.get(self._control_socket) == zmq.POLLIN:
+                command = self._control_socket.recv()
+                if (command == self.CONTROL_RECONNECT and
+                        (self._pending or self._unanswered)):
+                    self._reconnect()
+
+            if socks.get(self._socket) == zmq.POLLIN:
+                self._receive_replies()
+
+            if self._reconnect_at is None:
+                self._check_timeouts()
+            elif self._reconnect_at <= time.time():
+                self._reconnect()
+            self._check_deadlines()
+
+            # the new calls, or the replies that made room for the queued
+            # ones.
+            running = self._send_queued()
+
+        self._heartbeat.stop()
+        logger.debug("BackendProxy worker stopped.")
+
+    def _send_queued(self):
+        """
+        Send the urgent requests, and the queued ones while the requests in
+        flight are under MAX_UNACKED and MAX_UNANSWERED.
+
+        :return: False if the worker should stop, True otherwise.
+        :rtype: bool
         """
+        while self._urgent_calls:
+            request = self._urgent_calls.popleft()
+            if not self._abandoned(request):
+                self._send_request(*request)
+
+        # the stop call is read before the queue, so the calls queued
+        # before it are sent.
+        stop_request = self._stop_request
         while True:
+            if (stop_request is None and
+                    (len(self._pending) >= self.MAX_UNACKED or
+                     len(self._unanswered) >= self.MAX_UNANSWERED)):
+                return True
+
             try:
                 request = self._call_queue.get(block=False)
-                # break the loop after sending the 'stop' action to the
-                # backend.
-                if request == STOP_REQUEST:
-                    break
-
-                self._send_request(request)
             except Queue.Empty:
-                pass
-            time.sleep(0.01)
-            self._ping()
+                break
 
-        logger.debug("BackendProxy worker stopped.")
+            if self._abandoned(request):
+                continue
+            self._send_request(*request)
+
+        if stop_request is None:
+            return True
+
+        # break the loop after sending the 'stop' action to the backend.
+        self._send_request(*stop_request)
+        return False
+
+    def _abandoned(self, request):
+        """
+        Return whether a queued request is not worth sending, because it was
+        cancelled or its deadline passed while it was queued. Its future, if
+        any, fails.
+
+        :param request: the queued request, see `_send_request`.
+        :type request: tuple
+        :rtype: bool
+        """
+        request_id, deadline = request[0], request[5]
+        future = self._futures.get(request_id)
+        if future is not None and future.done():
+            del self._futures[request_id]  # cancelled
+            return True
+
+        if deadline is not None and deadline <= time.time():
+            self._metrics.increment('expired')
+            future = self._futures.pop(request_id, None)
+            if future is not None:
+                future.set_exception(BackendError(
+                    "Call deadline exceeded before it was sent."))
+            return True
+
+        return False
+
+    def _send_hello(self):
+        """
+        Offer our codecs to the backend, the reply tells which one to use.
+        """
+        request_id = self._new_request_id()
+        codecs = ' '.join(self._offered_codecs)
+        logger.debug("Offering codecs: '{0}'".format(codecs))
+        self._socket.send_multipart(['', request_id, HELLO, codecs])
+        self._pending[request_id] = [time.time(), 1, None]
 
-    def _reset_ping(self):
+    def _receive_replies(self):
         """
-        Reset the ping timeout counter.
-        This is called for every ping and request.
+        Process all the replies available in the socket.
+
+        Note: replies are received without copying, binary results are
+        handed to the futures as memoryviews of the received frames.
         """
-        self._ping_at = time.time() + self.PING_INTERVAL
+        while True:
+            try:
+                frames = self._socket.recv_multipart(zmq.NOBLOCK, copy=False)
+            except zmq.ZMQError as e:
+                if e.errno != zmq.EAGAIN:
+                    raise
+                break
+
+            try:
+                _, request_id, kind = [frame_bytes(f) for f in frames[:3]]
+            except ValueError:
+                logger.error("Malformed reply received: {0!r}".format(frames))
+                continue
+
+            self._process_reply(request_id, kind, frames[3:])
 
-    def _ping(self):
+    def _process_reply(self, request_id, kind, body):
         """
-        Heartbeat helper.
-        Sends a PING request just to know that the server is alive.
+        Process a reply from the backend.
+
+        :param request_id: the id of the request that is being replied.
+        :type request_id: str
+        :param kind: the kind of reply, see `protocol`.
+        :type kind: str
+        :param body: the remaining frames of the reply.
+        :type body: list of zmq.Frame
         """
-        if time.time() > self._ping_at:
-            self._send_request(PING_REQUEST)
-            self._reset_ping()
+        if kind in (ACK, HELLO):
+            # the backend is reachable again.
+            self._backoff = self.RECONNECT_BACKOFF
+
+        if kind == ACK:
+            entry = self._pending.pop(request_id, None)
+            if entry is not None:
+                self._metrics.observe('ack', time.time() - entry[0])
+            logger.debug("Request #{0} acknowledged.".format(request_id))
+        elif kind == HELLO:
+            self._pending.pop(request_id, None)
+            codec_name = frame_bytes(body[0])
+            logger.debug("Using codec: '{0}'".format(codec_name))
+            self._codec = get_codec(codec_name)
+        elif kind in (RESULT, ERROR):
+            self._resolve_future(request_id, kind, body)
+        else:
+            logger.error("Unknown reply kind for #{0}: {1!r}".format(
+                request_id, kind))
+
+    def _resolve_future(self, request_id, kind, body):
+        """
+        Resolve the future of a request with the result or the error sent by
+        the backend.
+
+        :param request_id: the id of the request that is being replied.
+        :type request_id: str
+        :param kind: RESULT or ERROR.
+        :type kind: str
+        :param body: the remaining frames of the reply.
+        :type body: list of zmq.Frame
+        """
+        self._unanswered.pop(request_id, None)
+        future = self._futures.pop(request_id, None)
+        if future is None:
+            logger.debug("Result for #{0} discarded, no one is waiting for "
+                         "it.".format(request_id))
+            return
+
+        if kind == ERROR:
+            future.set_exception(BackendError(frame_bytes(body[0])))
+            return
+
+        codec = get_codec(frame_bytes(body[0]))
+        try:
+            result = codec.loads(frame_bytes(body[1]))
+            result = restore_buffers(result, body[2:])
+        except Exception as e:
+            msg = "Malformed {0} data in result for #{1}. Exc: {2!r}"
+            msg = msg.format(codec.name, request_id, e)
+            future.set_exception(BackendError(msg))
+        else:
+            future.set_result(result)
+
+    def _check_timeouts(self):
+        """
+        Reconnect if a request was not acknowledged in time, and give up on
+        the requests that were already sent REQUEST_RETRIES times.
+        """
+        expired_at = time.time() - self.REQUEST_TIMEOUT
+        expired = []
+        for request_id, (sent_at, tries, _) in self._pending.iteritems():
+            if sent_at >= expired_at:
+                break  # the rest were sent later
+            expired.append((request_id, tries))
+
+        if not expired:
+            return
+
+        lost = [request_id for request_id, tries in expired
+                if tries >= self.REQUEST_RETRIES]
+        for request_id in lost:
+            del self._pending[request_id]
+            self._unanswered.pop(request_id, None)
+            future = self._futures.pop(request_id, None)
+            if future is not None:
+                future.set_exception(
+                    BackendError("Timeout error contacting backend."))
+
+        if lost:
+            msg = "Timeout error contacting backend, {0} requests lost."
+            logger.critical(msg.format(len(lost)))
+            self._metrics.increment('timeouts', len(lost))
+
+        self._schedule_reconnect()
+
+    def _check_deadlines(self):
+        """
+        Fail the futures of the requests whose deadline passed, the backend
+        drops or stops the calls on its own, and of the callers of coalesced
+        calls whose deadline passed, they leave their calls.
+        """
+        now = time.time()
+        while self._deadlines and self._deadlines[0][0] <= now:
+            _, request_id = heapq.heappop(self._deadlines)
+            self._unanswered.pop(request_id, None)
+            future = self._futures.pop(request_id, None)
+            if future is not None and not future.done():
+                self._metrics.increment('expired')
+                future.set_exception(BackendError("Call deadline exceeded."))
+
+        expired = []
+        with self._in_flight_lock:
+            while (self._caller_deadlines and
+                   self._caller_deadlines[0][0] <= now):
+                expired.append(heapq.heappop(self._caller_deadlines)[1:])
+        for caller, key, future in expired:
+            if not caller.done():
+                self._metrics.increment('expired')
+                caller.set_exception(BackendError("Call deadline exceeded."))
+                self._leave_call(key, future, caller)
+
+    @property
+    def online(self):
+        """
+        Whether the backend answered the last heartbeat.
+
+        :rtype: bool
+        """
+        return self._heartbeat.online
 
     def _api_call(self, *args, **kwargs):
         """
         Call the `api_method` method in backend (through zmq).
 
         :param kwargs: named arguments to forward to the backend api method.
+                       Binary values (bytearray, memoryview, buffer) are sent
+                       as separate frames without being copied.
         :type kwargs: dict
 
+        :return: if the reserved kwarg '_future' is True, a future that
+                 resolves with the value returned by the api method,
+                 None otherwise. For the methods in COALESCED_CALLS, an
+                 identical call in flight is joined instead of sending a new
+                 request. Cancelling the future cancels the call, see
+                 `cancellation`, or leaves it if it was joined: it is only
+                 cancelled once all its callers left.
+        :rtype: Future or None
+
+        The reserved kwarg '_timeout' sets the time, in seconds, the call has
+        to be done by, the default is given by CALL_TIMEOUTS. The future
+        fails if it is not done in time, the callers of a joined call have a
+        deadline each.
+
         Note: is mandatory to have the kwarg 'api_method' defined.
         """
         if args:
@@ -110,67 +564,347 @@ class BackendProxy(object):
         if api_method is None:
             raise Exception("Missing argument, no method name specified.")
 
+        wants_future = kwargs.pop('_future', False)
+        timeout = kwargs.pop('_timeout', CALL_TIMEOUTS.get(api_method))
+        arguments, buffers = extract_buffers(kwargs)
+
         request = {
             'api_method': api_method,
-            'arguments': kwargs,
+            'arguments': arguments,
         }
+        if wants_future:
+            request['reply'] = True
+
+        key = None
+        if wants_future:
+            key = self._coalescing_key(api_method, arguments, buffers)
+
+        deadline = None
+        if timeout is not None:
+            deadline = time.time() + timeout
+            if key is None:
+                request['deadline'] = deadline
+
+        trace = None
+        if self._trace_log is not None:
+            trace = (new_trace_id(), api_method, time.time())
+            request['trace'] = trace[0]
 
+        codec = self._codec
         try:
-            request_json = zmq.utils.jsonapi.dumps(request)
+            request_data = codec.dumps(request)
         except Exception as e:
-            msg = ("Error serializing request into JSON.\n"
-                   "Exception: {0} Data: {1}")
-            msg = msg.format(e, request)
+            msg = ("Error serializing request into {0}.\n"
+                   "Exception: {1} Data: {2}")
+            msg = msg.format(codec.name, e, request)
             logger.critical(msg)
             raise
 
+        self._metrics.increment('calls.' + api_method)
+
+        request_id = self._new_request_id(
+            kwargs.get(self.FOLLOWING_CALLS.get(api_method)))
+        future = caller = None
+        if wants_future:
+            canceller = functools.partial(self._cancel_call, request_id)
+            future, caller, in_flight = self._new_future(key, canceller,
+                                                         deadline)
+            if in_flight:
+                self._metrics.increment('coalesced.' + api_method)
+                if deadline is not None:
+                    self._wake_up()  # to watch the deadline of the caller
+                return caller
+            future.add_done_callback(functools.partial(
+                self._observe_result, api_method, time.time()))
+            if trace is not None:
+                future.add_done_callback(functools.partial(
+                    self._trace_result, trace[0]))
+
+        if future is not None:
+            self._futures[request_id] = future
+
         # queue the call in order to handle the request in a thread safe way.
-        self._call_queue.put(request_json)
+        # A coalesced call has no deadline of its own, its callers do.
+        request = (request_id, codec.name, request_data, buffers, trace,
+                   request.get('deadline'))
+        if api_method in self.URGENT_CALLS:
+            self._urgent_calls.append(request)
+        elif api_method == STOP_REQUEST:
+            # kept out of the queue, its overflow policy can not drop it.
+            self._stop_request = request
+        else:
+            self._call_queue.put(request, key=api_method)
 
-        if api_method == STOP_REQUEST:
-            self._call_queue.put(STOP_REQUEST)
+        self._wake_up()
 
-    def _send_request(self, request):
+        return caller
+
+    def _coalescing_key(self, api_method, arguments, buffers):
         """
-        Send the given request to the server.
-        This is used from a thread safe loop in order to avoid sending a
-        request without receiving a response from a previous one.
+        Return the key that identical calls of a method share if they are
+        coalesced.
+
+        :param api_method: the method name.
+        :type api_method: str
+        :param arguments: the call arguments.
+        :type arguments: dict
+        :param buffers: the binary arguments.
+        :type buffers: list
+
+        :return: the method name and the key of the call arguments, None if
+                 the call is not coalesced.
+        :rtype: tuple
+        """
+        if api_method not in COALESCED_CALLS or buffers:
+            return None
+        key = cache_key(arguments)
+        if key is None:
+            return None
+        return api_method, key
+
+    def _new_future(self, key, canceller=None, deadline=None):
+        """
+        Return a new future for a call, or join an identical call in flight
+        if the method calls are coalesced.
+
+        Each caller of a coalesced call gets its own future, resolved along
+        with the future of the call, so it can leave the call, cancelling
+        its future or when its deadline passes, without failing the others.
+
+        :param key: the key of a coalesced call, see `_coalescing_key`, None
+                    if the call is not coalesced.
+        :type key: tuple
+        :param canceller: called when the future of the call is cancelled.
+        :type canceller: callable
+        :param deadline: when the caller gives up on a coalesced call, None
+                         if it does not.
+        :type deadline: float
+
+        :return: the future of the call, the future of the caller and whether
+                 the call was in flight.
+        :rtype: tuple(Future, Future, bool)
+        """
+        if key is None:
+            future = Future(canceller)
+            return future, future, False
+
+        with self._in_flight_lock:
+            entry = self._in_flight.get(key)
+            in_flight = entry is not None
+            if not in_flight:
+                entry = self._in_flight[key] = (Future(canceller), set())
+            future, callers = entry
+
+            caller = Future(functools.partial(self._leave_call, key, future))
+            callers.add(caller)
+            if deadline is not None:
+                heapq.heappush(self._caller_deadlines,
+                               (deadline, caller, key, future))
+
+        if not in_flight:
+            future.add_done_callback(functools.partial(self._call_landed,
+                                                       key))
+        future.add_done_callback(functools.partial(self._chain_result,
+                                                   caller))
+        return future, caller, in_flight
+
+    def _chain_result(self, caller, future):
+        """
+        Resolve the future of a caller of a coalesced call along with the
+        future of the call, unless it is already done.
 
-        :param request: the request to send.
-        :type request: str
+        :param caller: the future of the caller.
+        :type caller: Future
+        :param future: the resolved future of the call.
+        :type future: Future
         """
-        logger.debug("Sending request to backend: {0}".format(request))
-        self._socket.send(request)
+        if future.exception() is not None:
+            caller.set_exception(future.exception())
+        else:
+            caller.set_result(future.result())
 
-        poll = zmq.Poller()
-        poll.register(self._socket, zmq.POLLIN)
+    def _leave_call(self, key, future, caller):
+        """
+        Remove a caller from a coalesced call, and cancel the call if no
+        caller is left.
+        This is run in the thread that cancels the future of the caller, or
+        in the worker thread once its deadline passes.
+
+        :param key: the method name and the key of the call arguments.
+        :type key: tuple
+        :param future: the future of the call.
+        :type future: Future
+        :param caller: the future of the caller that leaves.
+        :type caller: Future
+        """
+        with self._in_flight_lock:
+            entry = self._in_flight.get(key)
+            if entry is None or entry[0] is not future:
+                return  # the call already landed
+            entry[1].discard(caller)
+            if entry[1]:
+                return
+            del self._in_flight[key]
+
+        future.cancel()
+
+    def _call_landed(self, key, future):
+        """
+        Forget a coalesced call once its future is resolved.
 
-        reply = None
-        tries = 0
+        :param key: the method name and the key of the call arguments.
+        :type key: tuple
+        :param future: the resolved future.
+        :type future: Future
+        """
+        with self._in_flight_lock:
+            entry = self._in_flight.get(key)
+            if entry is not None and entry[0] is future:
+                del self._in_flight[key]
 
-        while True:
-            socks = dict(poll.poll(self.POLL_TIMEOUT))
-            if socks.get(self._socket) == zmq.POLLIN:
-                reply = self._socket.recv()
-                break
+    def _observe_result(self, api_method, started, future):
+        """
+        Add the round trip time of a call to the metrics.
+
+        :param api_method: the method name.
+        :type api_method: str
+        :param started: when the call was made, as given by time.time().
+        :type started: float
+        :param future: the resolved future.
+        :type future: Future
+        """
+        self._metrics.observe('latency.' + api_method, time.time() - started)
+        if future.exception() is not None:
+            self._metrics.increment('errors.' + api_method)
 
-            tries += 1
-            if tries < self.POLL_TRIES:
-                logger.warning('Retrying receive... {0}/{1}'.format(
-                    tries, self.POLL_TRIES))
-            else:
-                break
+    def _trace_result(self, trace_id, future):
+        """
+        Stamp the arrival of the result of a traced call.
 
-        if reply is None:
-            msg = "Timeout error contacting backend."
-            logger.critical(msg)
-            self.online = False
-        else:
-            msg = "Received reply for '{0}' -> '{1}'".format(request, reply)
-            logger.debug(msg)
-            self.online = True
-            # request received, no ping needed for other interval.
-            self._reset_ping()
+        :param trace_id: the trace id of the call.
+        :type trace_id: str
+        :param future: the resolved future.
+        :type future: Future
+        """
+        self._trace_log.write(trace_id, CALL_SPAN, {'result': time.time()})
+
+    def _cancel_call(self, request_id, future):
+        """
+        Ask the backend to stop a call whose future was cancelled. If the
+        call was not sent yet, it is not sent at all.
+        This is run in the thread that cancels the future.
+
+        :param request_id: the id of the cancelled request.
+        :type request_id: str
+        :param future: the cancelled future.
+        :type future: Future
+        """
+        self._metrics.increment('cancelled')
+        self._api_call(api_method=CANCEL_REQUEST, call=request_id)
+
+    def _call_dropped(self, request, policy):
+        """
+        Fail the future of a call discarded by the queue overflow policy.
+
+        :param request: the discarded request.
+        :type request: tuple
+        :param policy: the overflow policy applied.
+        :type policy: str
+        """
+        future = self._futures.pop(request[0], None)
+        if future is not None:
+            future.set_exception(BackendError(
+                "Call discarded by the '{0}' policy.".format(policy)))
+
+    def proxy_metrics(self):
+        """
+        Return the proxy metrics: calls, errors and round trip latency
+        histograms per API method, ack latency, queue depth, reconnections,
+        etc. The backend ones are returned by the 'metrics' API method.
+
+        :rtype: dict
+        """
+        return self._metrics.snapshot()
+
+    def queue_stats(self):
+        """
+        Return the size of the calls queue and how many calls were dropped or
+        coalesced for each API method.
+
+        :rtype: dict
+        """
+        return self._call_queue.stats()
+
+    def _new_request_id(self, follows=None):
+        """
+        Return a new id to tag a request.
+        This can be called from any thread.
+
+        :param follows: the id of the request this one follows, see
+                        `protocol.follow_request`, None if it follows none.
+        :type follows: str
+        :rtype: str
+        """
+        request_id = "{0}-{1}".format(self._session, next(self._request_ids))
+        if follows is not None:
+            request_id = follow_request(request_id, follows)
+        return request_id
+
+    def _wake_up(self, command=''):
+        """
+        Notify the worker loop that there are queued calls.
+        This can be called from any thread.
+
+        :param command: a control command for the worker loop, if any.
+        :type command: str
+        """
+        with self._waker_lock:
+            self._control_waker.send(command)
+
+    def _send_request(self, request_id, codec_name, request, buffers=(),
+                      trace=None, deadline=None, tries=1):
+        """
+        Send the given request to the server.
+        The request is tagged with an id and tracked until the backend
+        acknowledges it, there is no need to wait for a reply before sending
+        the next request.
+
+        :param request_id: the id of the request.
+        :type request_id: str
+        :param codec_name: the name of the codec used for the request.
+        :type codec_name: str
+        :param request: the request to send.
+        :type request: str
+        :param buffers: binary arguments to send as separate frames.
+        :type buffers: list
+        :param trace: the trace id of the request, the method name and when
+                      the call was made, None if the call is not traced.
+        :type trace: tuple(str, str, float)
+        :param deadline: when the call expires, as given by time.time(), None
+                         if it does not.
+        :type deadline: float
+        :param tries: how many times the request was sent, including this.
+        :type tries: int
+        """
+        logger.debug("Sending request #{0} to backend: {1}".format(
+            request_id, request))
+        self._socket.send_multipart(
+            ['', request_id, REQUEST, codec_name, request] + list(buffers),
+            copy=False)
+        sent_at = time.time()
+        entry = (request_id, codec_name, request, buffers, trace, deadline)
+        self._pending[request_id] = [sent_at, tries, entry]
+        if request_id in self._futures:
+            if request_id not in self._unanswered:
+                self._unanswered[request_id] = (sent_at, entry)
+            if deadline is not None and tries == 1:
+                heapq.heappush(self._deadlines, (deadline, request_id))
+
+        if trace is not None:
+            trace_id, api_method, called_at = trace
+            self._trace_log.write(trace_id, CALL_SPAN,
+                                  {'call': called_at, 'sent': sent_at},
+                                  name=api_method)
 
     def __getattribute__(self, name):
         """
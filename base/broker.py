@@ -0,0 +1,293 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Load balancing broker, used to run several Backend processes behind the
+single endpoint the BackendProxy connects to.
+"""
+import collections
+import signal
+import threading
+
+import zmq
+
+from heartbeat import answer_heartbeats
+from certificates import get_backend_certificates
+from certificates import get_frontend_certificates
+from protocol import READY, followed_request, frame_bytes, split_envelope
+from transport import BACKEND, HEARTBEAT, SIGNALS, SIGNALS_WORKERS, WORKERS
+from transport import bind_address, bind_server, start_authenticator
+from transport import uses_curve
+from utils import get_log_handler
+
+logger = get_log_handler(__name__)
+
+
+class Broker(object):
+    """
+    Forwards the BackendProxy requests to a set of Backend workers and their
+    replies back, and the signals published by the workers to the
+    subscribers.
+
+    The frontend is a ROUTER socket bound where a single Backend would be, the
+    backend is a ROUTER socket the workers connect to and announce themselves
+    on with a READY message. Each new request is handed to the next worker in
+    turn, and the broker remembers which worker got it: a request sent again
+    goes to the same worker, and so do the requests that follow it (see
+    `protocol.follow_request`), like the credits of a stream, whose id is the
+    id of the request that started it, or the cancel of a call. Replies carry
+    the routing envelope, so they find their way back to the right client.
+
+    The signals are forwarded from a XSUB socket the workers' Signalers
+    connect to, to a XPUB socket bound where a single Signaler would be. The
+    subscriptions travel the other way, so the workers only publish what
+    someone is listening to.
+
+    The heartbeats from the BackendProxy are answered by the broker itself.
+
+    Note: the Backend workers ack the requests as they arrive and queue the
+    work in their executors, so the round-robin dispatch is all the load
+    balancing we need.
+    """
+    BIND_ADDR = bind_address(BACKEND)
+    WORKERS_ADDR = bind_address(WORKERS)
+    HEARTBEAT_ADDR = bind_address(HEARTBEAT)
+    SIGNALS_ADDR = bind_address(SIGNALS)
+    SIGNALS_WORKERS_ADDR = bind_address(SIGNALS_WORKERS)
+
+    # in-process channel used to wake up the forwarding loop to stop it.
+    CONTROL_ADDR = "inproc://broker-control-%x"
+
+    # how many requests to remember the worker of, the oldest are forgotten.
+    ROUTED_REQUESTS = 10000
+
+    def __init__(self):
+        """
+        Broker constructor, bind all the sockets.
+        """
+        context = zmq.Context()
+
+        addresses = (self.BIND_ADDR, self.WORKERS_ADDR, self.HEARTBEAT_ADDR,
+                     self.SIGNALS_ADDR, self.SIGNALS_WORKERS_ADDR)
+        if any(uses_curve(address) for address in addresses):
+            # Start an authenticator for this context.
+            start_authenticator(context)
+
+        frontend = context.socket(zmq.ROUTER)
+        backend = context.socket(zmq.ROUTER)
+        heartbeat = context.socket(zmq.ROUTER)
+        bind_server(frontend, self.BIND_ADDR, get_backend_certificates)
+        bind_server(backend, self.WORKERS_ADDR, get_backend_certificates)
+        bind_server(heartbeat, self.HEARTBEAT_ADDR, get_backend_certificates)
+
+        self._frontend = frontend
+        self._backend = backend
+        self._heartbeat = heartbeat
+
+        # the identities of the workers, in the order they announced
+        # themselves, and the worker that got each request.
+        self._workers = []
+        self._turn = 0
+        self._routes = collections.OrderedDict()
+        # requests received before any worker was ready.
+        self._waiting = collections.deque()
+
+        signals_frontend = context.socket(zmq.XPUB)
+        signals_backend = context.socket(zmq.XSUB)
+        bind_server(signals_frontend, self.SIGNALS_ADDR,
+                    get_frontend_certificates)
+        bind_server(signals_backend, self.SIGNALS_WORKERS_ADDR,
+                    get_frontend_certificates)
+
+        self._signals_frontend = signals_frontend
+        self._signals_backend = signals_backend
+
+        control_addr = self.CONTROL_ADDR % id(self)
+        control = context.socket(zmq.PAIR)
+        control.bind(control_addr)  # must come before connect for inproc
+        waker = context.socket(zmq.PAIR)
+        waker.connect(control_addr)
+        self._control_socket = control
+        self._control_waker = waker
+        self._waker_lock = threading.Lock()
+
+    def run(self):
+        """
+        Run the forwarding loop.
+        """
+        poller = zmq.Poller()
+        poller.register(self._frontend, zmq.POLLIN)
+        poller.register(self._backend, zmq.POLLIN)
+        poller.register(self._signals_frontend, zmq.POLLIN)
+        poller.register(self._signals_backend, zmq.POLLIN)
+        poller.register(self._heartbeat, zmq.POLLIN)
+        poller.register(self._control_socket, zmq.POLLIN)
+
+        # each signals socket is forwarded to its counterpart.
+        routes = {
+            self._signals_frontend: self._signals_backend,
+            self._signals_backend: self._signals_frontend,
+        }
+
+        logger.debug("Broker running.")
+        while True:
+            socks = dict(poller.poll())
+
+            if socks.get(self._control_socket) == zmq.POLLIN:
+                break
+
+            if socks.get(self._heartbeat) == zmq.POLLIN:
+                answer_heartbeats(self._heartbeat)
+
+            if socks.get(self._frontend) == zmq.POLLIN:
+                self._dispatch_requests()
+
+            if socks.get(self._backend) == zmq.POLLIN:
+                self._forward_replies()
+
+            for source, destination in routes.items():
+                if socks.get(source) == zmq.POLLIN:
+                    self._forward(source, destination)
+
+        logger.debug("Broker stopped.")
+
+    def stop(self):
+        """
+        Stop the forwarding loop.
+        This can be called from any thread.
+        """
+        with self._waker_lock:
+            self._control_waker.send('')
+
+    def _dispatch_requests(self):
+        """
+        Hand all the requests available in the frontend to their workers.
+        """
+        while True:
+            try:
+                frames = self._frontend.recv_multipart(zmq.NOBLOCK,
+                                                       copy=False)
+            except zmq.ZMQError as e:
+                if e.errno != zmq.EAGAIN:
+                    raise
+                break
+
+            if not self._workers:
+                self._waiting.append(frames)
+                continue
+            self._dispatch(frames)
+
+    def _dispatch(self, frames):
+        """
+        Send a request to the worker that got the request it follows, or the
+        earlier copy of it, or else to the next worker in turn.
+
+        :param frames: the request, as received by the frontend.
+        :type frames: list of zmq.Frame
+        """
+        try:
+            _, body = split_envelope(frames)
+            request_id = frame_bytes(body[0])
+        except (ValueError, IndexError):
+            logger.error("Malformed request received: {0!r}".format(frames))
+            return
+
+        routed = followed_request(request_id) or request_id
+        worker = self._routes.pop(routed, None)
+        if worker is None:
+            worker = self._workers[self._turn % len(self._workers)]
+            self._turn += 1
+
+        # the most recently used routes are the last ones to be forgotten.
+        self._routes[routed] = worker
+        if len(self._routes) > self.ROUTED_REQUESTS:
+            self._routes.popitem(last=False)
+
+        self._backend.send_multipart([worker] + frames, copy=False)
+
+    def _forward_replies(self):
+        """
+        Forward all the replies available in the backend to their clients,
+        and register the workers that announce themselves.
+        """
+        while True:
+            try:
+                frames = self._backend.recv_multipart(zmq.NOBLOCK,
+                                                      copy=False)
+            except zmq.ZMQError as e:
+                if e.errno != zmq.EAGAIN:
+                    raise
+                break
+
+            worker = frame_bytes(frames[0])
+            if len(frames) == 2 and frame_bytes(frames[1]) == READY:
+                self._worker_ready(worker)
+                continue
+            self._frontend.send_multipart(frames[1:], copy=False)
+
+    def _worker_ready(self, worker):
+        """
+        Start handing requests to a worker, and the ones that waited for
+        one.
+
+        :param worker: the identity of the worker.
+        :type worker: str
+        """
+        if worker not in self._workers:
+            logger.debug("Worker {0!r} ready.".format(worker))
+            self._workers.append(worker)
+
+        while self._waiting:
+            self._dispatch(self._waiting.popleft())
+
+    def _forward(self, source, destination):
+        """
+        Forward all the messages available in `source` to `destination`.
+
+        :param source: the socket to read from.
+        :type source: zmq.Socket
+        :param destination: the socket to write to.
+        :type destination: zmq.Socket
+        """
+        while True:
+            try:
+                frames = source.recv_multipart(zmq.NOBLOCK, copy=False)
+            except zmq.ZMQError as e:
+                if e.errno != zmq.EAGAIN:
+                    raise
+                break
+
+            destination.send_multipart(frames, copy=False)
+
+
+def run_broker(workers=()):
+    """
+    Run a Broker until any of the given worker processes finishes, then stop
+    the remaining workers too.
+
+    The BackendProxy stop request reaches only one worker, this way the whole
+    backend side goes down along with it.
+
+    :param workers: the worker processes, already started.
+    :type workers: list of multiprocessing.Process
+    """
+    # Ensure that the application quits using CTRL-C
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+
+    broker = Broker()
+    finished = threading.Event()
+
+    def watch(worker):
+        worker.join()
+        if not finished.is_set():
+            finished.set()
+            for other in workers:
+                if other.is_alive():
+                    other.terminate()
+            broker.stop()
+
+    for worker in workers:
+        watcher = threading.Thread(target=watch, args=(worker,))
+        watcher.daemon = True
+        watcher.start()
+
+    broker.run()
@@ -0,0 +1,160 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Cache for the results of the idempotent API methods, so the repeated calls
+with the same arguments are answered from memory.
+"""
+import collections
+import json
+import threading
+import time
+
+from utils import get_log_handler
+
+logger = get_log_handler(__name__)
+
+
+def cache_key(arguments):
+    """
+    Return a key identifying the arguments of a call, the same for equal
+    arguments no matter the order of the kwargs.
+
+    :param arguments: the call arguments, as decoded from the request.
+    :type arguments: dict
+
+    :return: the key, None if the arguments can not be used as a key.
+    :rtype: str
+    """
+    try:
+        return json.dumps(arguments, sort_keys=True, separators=(',', ':'))
+    except (TypeError, ValueError):
+        return None
+
+
+class ResultCache(object):
+    """
+    Thread safe cache of method results.
+
+    Each method has its own time to live and maximum size, the least
+    recently used entries are evicted first. The counters of hits and misses
+    are kept per method.
+    """
+    def __init__(self, settings):
+        """
+        :param settings: the cacheable methods,
+                         {method: (ttl in secs or None, max entries)}.
+        :type settings: dict
+        """
+        self._settings = settings
+        self._entries = collections.defaultdict(collections.OrderedDict)
+        # bumped on each invalidation, so a result computed before it is not
+        # stored afterwards.
+        self._generations = collections.Counter()
+        self._lock = threading.Lock()
+
+        self.hits = collections.Counter()
+        self.misses = collections.Counter()
+
+    def __contains__(self, method):
+        """
+        Whether the method results are cached.
+
+        :rtype: bool
+        """
+        return method in self._settings
+
+    def get(self, method, key):
+        """
+        Return the cached value for a call, counting the hit or miss.
+
+        :param method: the method name.
+        :type method: str
+        :param key: the key of the call arguments, see `cache_key`.
+        :type key: str
+
+        :return: the cached value, None if there is none.
+        :rtype: object
+        """
+        with self._lock:
+            entries = self._entries[method]
+            entry = entries.pop(key, None)
+            if entry is not None and entry[0] is not None \
+                    and entry[0] < time.time():
+                entry = None  # expired
+
+            if entry is None:
+                self.misses[method] += 1
+                return None
+
+            entries[key] = entry  # most recently used
+            self.hits[method] += 1
+            return entry[1]
+
+    def generation(self, method):
+        """
+        Return the current generation of a method's entries, to be given to
+        `put` along with the result.
+
+        :param method: the method name.
+        :type method: str
+        :rtype: int
+        """
+        with self._lock:
+            return self._generations[method]
+
+    def put(self, method, key, value, generation):
+        """
+        Store the value for a call, unless the method entries were
+        invalidated since `generation`.
+
+        :param method: the method name.
+        :type method: str
+        :param key: the key of the call arguments, see `cache_key`.
+        :type key: str
+        :param value: the value to store.
+        :type value: object
+        :param generation: the generation when the call started.
+        :type generation: int
+        """
+        ttl, maxsize = self._settings[method]
+        expires_at = None if ttl is None else time.time() + ttl
+
+        with self._lock:
+            if generation != self._generations[method]:
+                return
+
+            entries = self._entries[method]
+            entries.pop(key, None)
+            entries[key] = (expires_at, value)
+            while len(entries) > maxsize:
+                entries.popitem(last=False)
+
+    def invalidate(self, *methods):
+        """
+        Discard the cached results of the given methods, or all of them if
+        none is given.
+
+        :param methods: the method names.
+        :type methods: tuple of str
+        """
+        with self._lock:
+            for method in methods or self._settings.keys():
+                self._entries.pop(method, None)
+                self._generations[method] += 1
+
+        logger.debug("Cache invalidated for: {0}".format(
+            ', '.join(methods) or 'all'))
+
+    def stats(self):
+        """
+        Return the amount of entries and the hits and misses counters.
+
+        :rtype: dict
+        """
+        with self._lock:
+            return {
+                'size': dict((method, len(entries))
+                             for method, entries in self._entries.items()),
+                'hits': dict(self.hits),
+                'misses': dict(self.misses),
+            }
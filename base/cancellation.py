@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Deadlines and cooperative cancellation of the API calls.
+
+A call made with a timeout (the `_timeout` kwarg or `api.CALL_TIMEOUTS`)
+carries its deadline to the backend, which drops it if the deadline passed
+before it started. The calls that ask for a future can be cancelled with
+`Future.cancel()`, the backend is asked to stop them. Behind a Broker, the
+cancel follows the request of the call, so it reaches the worker running it.
+
+The running methods find out through a CancelToken, it is passed to the API
+methods that have a `cancel_token` argument:
+
+    def long_method(self, items, cancel_token):
+        for item in items:
+            cancel_token.raise_if_cancelled()
+            process(item)
+
+The token is cancelled when the call is cancelled, when its deadline passes
+or when the backend stops. The methods that do not check it run to the end
+and their results are discarded.
+
+Note: the deadlines are absolute times, as given by time.time(), so the
+clocks of the frontend and the backend must agree.
+"""
+import inspect
+import threading
+import time
+
+try:
+    getargspec = inspect.getfullargspec
+except AttributeError:  # python 2
+    getargspec = inspect.getargspec
+
+# the argument of the API methods that receives the token.
+TOKEN_ARGUMENT = 'cancel_token'
+
+
+class CallCancelled(Exception):
+    """
+    The call was cancelled or its deadline passed.
+    """
+
+
+def accepts_token(method):
+    """
+    Return whether an API method takes a CancelToken.
+
+    :param method: the API method.
+    :type method: callable
+    :rtype: bool
+    """
+    try:
+        return TOKEN_ARGUMENT in getargspec(method).args
+    except TypeError:  # not a python function
+        return False
+
+
+class CancelToken(object):
+    """
+    Tells a running call whether it should stop. Thread safe.
+    """
+    def __init__(self, deadline=None):
+        """
+        :param deadline: when the call expires, as given by time.time(), None
+                         if it does not.
+        :type deadline: float
+        """
+        self._deadline = deadline
+        self._cancelled = threading.Event()
+
+    @property
+    def cancelled(self):
+        """
+        Whether the call was cancelled or its deadline passed.
+
+        :rtype: bool
+        """
+        return self._cancelled.is_set() or self.expired
+
+    @property
+    def expired(self):
+        """
+        Whether the deadline of the call passed.
+
+        :rtype: bool
+        """
+        return self._deadline is not None and time.time() >= self._deadline
+
+    def cancel(self):
+        """
+        Cancel the call.
+        This can be called from any thread.
+        """
+        self._cancelled.set()
+
+    def remaining(self):
+        """
+        Return the time left until the deadline.
+
+        :return: the seconds left, None if there is no deadline.
+        :rtype: float
+        """
+        if self._deadline is None:
+            return None
+        return max(0, self._deadline - time.time())
+
+    def wait(self, timeout):
+        """
+        Sleep for `timeout` seconds, or until the call is cancelled or
+        expires. Use it instead of time.sleep() in the API methods.
+
+        :param timeout: the time to sleep, in seconds.
+        :type timeout: float
+
+        :return: whether the call was cancelled or expired.
+        :rtype: bool
+        """
+        remaining = self.remaining()
+        if remaining is not None:
+            timeout = min(timeout, remaining)
+        self._cancelled.wait(timeout)
+        return self.cancelled
+
+    def raise_if_cancelled(self):
+        """
+        :raise CallCancelled: if the call was cancelled or its deadline
+                              passed.
+        """
+        if self._cancelled.is_set():
+            raise CallCancelled("Call cancelled.")
+        if self.expired:
+            raise CallCancelled("Call deadline exceeded.")
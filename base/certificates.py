@@ -33,6 +33,7 @@ def generate_certificates():
 def get_frontend_certificates():
     """
     Return the frontend's public and secret certificates.
+    These are the keys of the signals publisher, the Signaler.
     """
     frontend_secret_file = os.path.join(KEYS_DIR, "frontend.key_secret")
     public, secret = zmq.auth.load_certificate(frontend_secret_file)
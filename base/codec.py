@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Serialization codecs used for requests, results and signals.
+
+JSON is always available and is the default. A compact binary codec based on
+msgpack is available if the `msgpack` package is installed. Other codecs can
+be plugged in with `register_codec`.
+"""
+import json
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+DEFAULT_CODEC = 'json'
+
+
+class JSONCodec(object):
+    """
+    JSON codec, strings are always decoded as unicode.
+    """
+    name = 'json'
+
+    def dumps(self, obj):
+        return json.dumps(obj)
+
+    def loads(self, data):
+        # We use stdlib's json to ensure that we get unicode strings
+        return json.loads(data)
+
+
+class MsgpackCodec(object):
+    """
+    msgpack codec, text is decoded as unicode and raw bytes are kept as is.
+    """
+    name = 'msgpack'
+
+    def dumps(self, obj):
+        return msgpack.packb(obj, use_bin_type=True)
+
+    def loads(self, data):
+        return msgpack.unpackb(data, raw=False)
+
+
+_CODECS = {}
+
+
+def register_codec(codec):
+    """
+    Make a codec available to be used by its name.
+
+    :param codec: an object with a `name` attribute and `dumps`/`loads`
+                  methods.
+    :type codec: object
+    """
+    _CODECS[codec.name] = codec
+
+
+def get_codec(name):
+    """
+    Return the codec registered with the given name.
+
+    :param name: the codec name.
+    :type name: str
+
+    :raise ValueError: if there is no such codec available.
+    """
+    try:
+        return _CODECS[name]
+    except KeyError:
+        raise ValueError("Codec not available: '{0}'".format(name))
+
+
+def available_codecs():
+    """
+    Return the names of the registered codecs.
+
+    :rtype: list of str
+    """
+    return list(_CODECS)
+
+
+def choose_codec(offered, accepted):
+    """
+    Choose the codec to use from the ones offered by a client, in its order
+    of preference.
+
+    :param offered: the codec names offered by the client.
+    :type offered: list of str
+    :param accepted: the codec names accepted by the server.
+    :type accepted: list of str
+
+    :return: the chosen codec name, the default one if there is no match.
+    :rtype: str
+    """
+    for name in offered:
+        if name in accepted and name in _CODECS:
+            return name
+
+    return DEFAULT_CODEC
+
+
+register_codec(JSONCodec())
+if msgpack is not None:
+    register_codec(MsgpackCodec())
@@ -0,0 +1,440 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+In-process direct mode, the Backend runs in the same process as the frontend
+and there are no sockets in between.
+
+The calls are handed to the backend's executor and the signals to the
+subscribers as they are, without serializing nor copying them. The Backend
+subclasses do not need any change to use it:
+
+    backend = with_direct(DemoBackend)()
+    backend.start()  # runs the reactor in a thread
+    backend_proxy = DirectBackendProxy(backend)
+    signaler_qt = DemoSignalerQt(signaler=backend.signaler)
+
+Note: since nothing is copied, the callers must not change the arguments of
+a call after making it, and the signal data or results received are the
+objects the backend produced.
+
+Note: the process pool of the CPU_BOUND methods forks this process when the
+backend is created, so it must be created before the Qt application and any
+other thread, see `with_direct`.
+"""
+import functools
+import itertools
+import sys
+import threading
+import time
+
+from twisted.internet import reactor, threads
+
+from api import CALL_TIMEOUTS, CPU_BOUND
+from backend_proxy import BackendProxy
+from future import BackendError, Future
+from metrics import Metrics
+from signaler import Signaler
+from tracing import CALL_SPAN, get_trace_log, new_trace_id
+from utils import get_log_handler
+
+logger = get_log_handler(__name__)
+
+
+def with_direct(backend_class):
+    """
+    Return a subclass of `backend_class` that runs in direct mode.
+
+    If there are CPU_BOUND methods the backend must be created before the Qt
+    application and before starting any thread: its process pool forks the
+    current process, and a fork only copies the thread that makes it, which
+    leaves the locks held by the other threads locked in the workers.
+    Creating it later raises an Exception.
+
+    :param backend_class: a Backend subclass.
+    :type backend_class: type
+    :rtype: type
+    """
+    # the subclass can not be pickled, the process pool gets the real one.
+    return type(backend_class.__name__, (DirectEngine, backend_class),
+                {'_api_class': backend_class})
+
+
+def _check_can_fork():
+    """
+    Raise an Exception if forking the current process is not safe, that is
+    if there is a Qt application or more threads than the current one.
+    """
+    qt_core = sys.modules.get('PySide.QtCore')
+    if qt_core is not None and qt_core.QCoreApplication.instance() is not None:
+        raise Exception("The direct backend must be created before the "
+                        "Qt application, its process pool forks.")
+    if threading.active_count() > 1:
+        raise Exception("The direct backend must be created before "
+                        "starting any thread, its process pool forks.")
+
+
+class DirectEngine(object):
+    """
+    Backend mixin that serves the calls of a DirectBackendProxy instead of a
+    socket, it must come before the Backend class in the bases.
+
+    The Twisted reactor runs in a thread of the current process, see
+    `start`.
+    """
+    def __init__(self, *args, **kwargs):
+        if CPU_BOUND:
+            _check_can_fork()
+        super(DirectEngine, self).__init__(*args, **kwargs)
+
+    def _create_signaler(self, codec, connect_to, bind_addr):
+        """
+        Return a Signaler that hands the signals to in-process receivers.
+
+        :rtype: DirectSignaler
+        """
+        return DirectSignaler()
+
+    def _init_zmq(self, connect_to, bind_addr, heartbeat_addr):
+        """
+        There are no sockets in direct mode.
+        """
+
+    @property
+    def signaler(self):
+        """
+        The signaler to subscribe the in-process receivers to.
+
+        :rtype: DirectSignaler
+        """
+        return self._signaler
+
+    @property
+    def online(self):
+        """
+        Whether the backend is running.
+
+        :rtype: bool
+        """
+        return self._do_work.is_set()
+
+    def start(self):
+        """
+        Run the backend in a daemon thread.
+        """
+        thread = threading.Thread(target=self.run)
+        thread.daemon = True
+        thread.start()
+
+    def run(self):
+        """
+        Run the reactor to handle the calls, the signal handlers are left to
+        the frontend.
+        """
+        self._signaler.start()
+        self._do_work.set()
+        reactor.callWhenRunning(self._executor.start)
+        reactor.run(installSignalHandlers=False)
+
+    def stop(self):
+        """
+        Stop the backend.
+        This can be called from any thread.
+        """
+        logger.debug("STOP received.")
+        self._signaler.stop()
+        if self._metrics_dumper is not None:
+            self._metrics_dumper.stop()
+        self._do_work.clear()
+        reactor.callFromThread(threads.deferToThread, self._stop_reactor)
+
+    def call_directly(self, api_method, kwargs, future=None, trace_id=None,
+                      deadline=None, call_id=None):
+        """
+        Make an API call.
+        This can be called from any thread.
+
+        :param api_method: the method name.
+        :type api_method: str
+        :param kwargs: the arguments for the method.
+        :type kwargs: dict
+        :param future: the future to resolve with the method result, None if
+                       no result is needed.
+        :type future: Future
+        :param trace_id: the trace id of the call, None if it is not traced.
+        :type trace_id: str
+        :param deadline: when the call expires, as given by time.time(), None
+                         if it does not.
+        :type deadline: float
+        :param call_id: the id used to cancel the call, see `cancel_directly`,
+                        None if it can not be cancelled.
+        :type call_id: str
+        """
+        trace = None
+        if trace_id is not None and self._trace_log is not None:
+            trace = (trace_id, {})
+        reactor.callFromThread(self._dispatch_call, api_method, kwargs,
+                               future, trace, deadline, call_id)
+
+    def cancel_directly(self, call_id):
+        """
+        Cancel a call made with `call_directly`.
+        This can be called from any thread.
+
+        :param call_id: the id of the call.
+        :type call_id: str
+        """
+        reactor.callFromThread(self._cancel_call, call_id)
+
+    def _dispatch_call(self, api_method, kwargs, future, trace, deadline,
+                       call_id):
+        """
+        Process a direct call in the reactor thread, see `call_directly`.
+        """
+        if trace is not None:
+            trace[1]['dispatched'] = time.time()
+        if future is not None and deadline is not None:
+            # the future fails at the deadline, as with the BackendProxy.
+            reactor.callLater(max(0, deadline - time.time()),
+                              future.set_exception,
+                              BackendError("Call deadline exceeded."))
+        self._process_call(api_method, kwargs or None, kwargs, future, None,
+                           trace, deadline, call_id)
+
+    def _done_action(self, result, d, reply_to, codec):
+        """
+        Resolve the future of the call, if any, with the result as it is and
+        remove the defer from the ongoing list.
+        """
+        if reply_to is not None:
+            reply_to.set_result(result)
+        super(DirectEngine, self)._done_action(result, d, None, codec)
+
+    def _send_reply(self, reply_to, kind, *body):
+        """
+        Fail the future of a call, the results are handed over by
+        `_done_action` so only the errors get here.
+        """
+        reply_to.set_exception(BackendError(body[0]))
+
+
+class DirectSignaler(Signaler):
+    """
+    Signaler that hands the signals to DirectReceivers in the same process,
+    the signal data is passed as is.
+    """
+    def __init__(self):
+        self._receivers = []
+        self._receivers_lock = threading.Lock()
+        Signaler.__init__(self)
+
+    def _create_socket(self, connect_to, bind_addr):
+        """
+        There is no socket in direct mode.
+        """
+        return None
+
+    def _serialize(self, signal, data, trace):
+        """
+        The signals are not serialized, the data is kept as is.
+        """
+        return data, ()
+
+    def subscribe(self, receiver):
+        """
+        Start handing the signals to a receiver.
+        This can be called from any thread.
+
+        :param receiver: the receiver.
+        :type receiver: DirectReceiver
+        """
+        with self._receivers_lock:
+            self._receivers.append(receiver)
+
+    def unsubscribe(self, receiver):
+        """
+        Stop handing the signals to a receiver.
+        This can be called from any thread.
+
+        :param receiver: the receiver.
+        :type receiver: DirectReceiver
+        """
+        with self._receivers_lock:
+            if receiver in self._receivers:
+                self._receivers.remove(receiver)
+
+    def _publish(self, signal, request):
+        """
+        Hand a batch of signals to the receivers subscribed to them.
+        This is run in the Signaler worker thread.
+
+        :param signal: the name of the signals.
+        :type signal: str
+        :param request: the signals to send, see `_send_request`.
+        :type request: list of tuple
+        """
+        with self._receivers_lock:
+            receivers = list(self._receivers)
+
+        for receiver in receivers:
+            for _, data, _, _, trace in request:
+                receiver.deliver(signal, data, trace)
+
+
+class DirectReceiver(object):
+    """
+    Stand-in for the SignalReceiver that gets the signals from a
+    DirectSignaler in the same process.
+    """
+    def __init__(self, signaler, callback, signals=None, with_trace=False):
+        """
+        :param signaler: the signaler to subscribe to.
+        :type signaler: DirectSignaler
+        :param callback: the callable to run for each signal received, see
+                         `SignalReceiver`. It is run in the Signaler worker
+                         thread.
+        :type callback: callable
+        :param signals: the names of the signals to receive, all of them if
+                        None.
+        :type signals: list of str
+        :param with_trace: whether to pass the trace of the signal to the
+                           callback too, see `SignalReceiver`.
+        :type with_trace: bool
+        """
+        self._signaler = signaler
+        self._callback = callback
+        self._signals = None if signals is None else frozenset(signals)
+        self._with_trace = with_trace
+        self._trace_log = get_trace_log()
+
+    def start(self):
+        """
+        Start receiving the signals.
+        """
+        self._signaler.subscribe(self)
+
+    def stop(self):
+        """
+        Stop receiving the signals.
+        """
+        self._signaler.unsubscribe(self)
+
+    def deliver(self, signal, data, trace=None):
+        """
+        Run the callback for a signal, if we are interested in it.
+
+        :param signal: the signal name.
+        :type signal: str
+        :param data: the data sent along the signal.
+        :type data: object
+        :param trace: the trace id and span of the signal, None if it is not
+                      traced.
+        :type trace: dict
+        """
+        if self._signals is not None and signal not in self._signals:
+            return
+
+        if trace is not None and self._trace_log is not None:
+            self._trace_log.write(trace['id'], trace['span'],
+                                  {'delivered': time.time()})
+        else:
+            trace = None
+
+        if self._with_trace:
+            self._callback(signal, data, trace)
+        else:
+            self._callback(signal, data)
+
+
+class DirectBackendProxy(BackendProxy):
+    """
+    Stand-in for the BackendProxy that calls a backend running in direct mode
+    in the same process, see `with_direct`.
+
+    The calls are handed to the backend's reactor right away, there is no
+    calls queue so CALL_POLICIES do not apply. The backend's concurrency
+    limits do.
+    """
+    def __init__(self, backend):
+        """
+        :param backend: the backend to call.
+        :type backend: DirectEngine
+        """
+        self._backend = backend
+        self._trace_log = get_trace_log()
+        self._metrics = Metrics()
+        self._call_ids = itertools.count()
+
+    @property
+    def online(self):
+        """
+        Whether the backend is running.
+
+        :rtype: bool
+        """
+        return self._backend.online
+
+    def _api_call(self, *args, **kwargs):
+        """
+        Call the `api_method` method in the backend, see
+        `BackendProxy._api_call`. The arguments are handed over as they are.
+
+        :return: if the reserved kwarg '_future' is True, a future that
+                 resolves with the value returned by the api method,
+                 None otherwise. Cancelling the future cancels the call.
+        :rtype: Future or None
+        """
+        if args:
+            # Use a custom message to be more clear about using kwargs *only*
+            raise Exception("All arguments need to be kwargs!")
+
+        api_method = kwargs.pop('api_method', None)
+        if api_method is None:
+            raise Exception("Missing argument, no method name specified.")
+
+        wants_future = kwargs.pop('_future', False)
+        timeout = kwargs.pop('_timeout', CALL_TIMEOUTS.get(api_method))
+        self._metrics.increment('calls.' + api_method)
+
+        deadline = None
+        if timeout is not None:
+            deadline = time.time() + timeout
+
+        future = call_id = None
+        if wants_future:
+            call_id = "{0:x}-{1}".format(id(self), next(self._call_ids))
+            future = Future(functools.partial(self._cancel_call, call_id))
+            future.add_done_callback(functools.partial(
+                self._observe_result, api_method, time.time()))
+
+        trace_id = None
+        if self._trace_log is not None:
+            trace_id = new_trace_id()
+            self._trace_log.write(trace_id, CALL_SPAN, {'call': time.time()},
+                                  name=api_method)
+            if future is not None:
+                future.add_done_callback(functools.partial(
+                    self._trace_result, trace_id))
+
+        self._backend.call_directly(api_method, kwargs, future, trace_id,
+                                    deadline, call_id)
+        return future
+
+    def _cancel_call(self, call_id, future):
+        """
+        Ask the backend to stop a call whose future was cancelled.
+
+        :param call_id: the id of the cancelled call.
+        :type call_id: str
+        :param future: the cancelled future.
+        :type future: Future
+        """
+        self._metrics.increment('cancelled')
+        self._backend.cancel_directly(call_id)
+
+    def queue_stats(self):
+        """
+        There is no calls queue in direct mode.
+
+        :rtype: dict
+        """
+        return {'size': 0, 'maxsize': 0, 'dropped': {}, 'coalesced': {}}
@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Thread pool used by the Backend to run the API methods.
+"""
+import collections
+
+from twisted.internet import defer, reactor, threads
+from twisted.python.threadpool import ThreadPool
+
+from utils import get_log_handler
+
+logger = get_log_handler(__name__)
+
+
+class Executor(object):
+    """
+    Run callables in a bounded thread pool, limiting how many calls of each
+    API method can run at the same time.
+
+    Calls over the limit of their method wait in a per method queue, so a
+    flood of slow calls can not take all the threads and the other methods
+    keep running.
+
+    Note: `submit` needs to be called from the reactor thread, the returned
+    deferreds are fired in the reactor thread too.
+    """
+    def __init__(self, pool_size, limits=None):
+        """
+        :param pool_size: the maximum amount of threads to use.
+        :type pool_size: int
+        :param limits: the maximum amount of concurrent calls per method,
+                       methods not listed can use all the threads.
+        :type limits: dict
+        """
+        self._pool = ThreadPool(minthreads=0, maxthreads=pool_size,
+                                name="BackendExecutor")
+        self._limits = limits or {}
+        self._running = collections.defaultdict(int)
+        self._waiting = collections.defaultdict(collections.deque)
+
+    def start(self):
+        """
+        Start the thread pool, it is stopped along with the reactor.
+        """
+        self._pool.start()
+        reactor.addSystemEventTrigger('during', 'shutdown', self._pool.stop)
+
+    def submit(self, name, func, *args, **kwargs):
+        """
+        Run `func(*args, **kwargs)` in the pool as soon as the limit for
+        `name` allows it.
+
+        :param name: the API method name, used to apply the limits.
+        :type name: str
+        :param func: the callable to run.
+        :type func: callable
+
+        :return: a deferred that fires with the result of the call, if it is
+                 cancelled before the call starts the call is discarded.
+        :rtype: twisted.internet.defer.Deferred
+        """
+        call = (func, args, kwargs)
+        d = defer.Deferred(
+            canceller=lambda d: self._discard(name, d, call))
+
+        if self._can_run(name):
+            self._run(name, d, call)
+        else:
+            logger.debug("Limit reached for '{0}', call queued.".format(name))
+            self._waiting[name].append((d, call))
+
+        return d
+
+    def stats(self):
+        """
+        Return the pool usage and the amount of running and waiting calls of
+        each method.
+
+        :rtype: dict
+        """
+        return {
+            'max_threads': self._pool.max,
+            'threads': len(self._pool.threads),
+            'busy': len(self._pool.working),
+            'running': dict((name, count)
+                            for name, count in self._running.items()
+                            if count),
+            'waiting': dict((name, len(calls))
+                            for name, calls in self._waiting.items()
+                            if calls),
+        }
+
+    def _can_run(self, name):
+        """
+        Return whether a new call of `name` can start now.
+
+        :rtype: bool
+        """
+        limit = self._limits.get(name)
+        return limit is None or self._running[name] < limit
+
+    def _run(self, name, d, call):
+        """
+        Run the call in the pool and fire `d` with its result.
+        """
+        func, args, kwargs = call
+        self._running[name] += 1
+        running = threads.deferToThreadPool(reactor, self._pool,
+                                            func, *args, **kwargs)
+        running.addBoth(self._finished, name)
+        running.chainDeferred(d)
+
+    def _finished(self, result, name):
+        """
+        Update the running count for `name` and start its next waiting call.
+        """
+        self._running[name] -= 1
+
+        waiting = self._waiting[name]
+        if waiting and self._can_run(name):
+            d, call = waiting.popleft()
+            self._run(name, d, call)
+
+        return result
+
+    def _discard(self, name, d, call):
+        """
+        Remove a cancelled call from the waiting queue if it did not start.
+        """
+        try:
+            self._waiting[name].remove((d, call))
+        except ValueError:
+            pass  # it is already running
@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Helpers to send binary payloads as separate ZMQ frames.
+
+Binary objects (bytearray, memoryview, buffer) found in the data are replaced
+by a placeholder and sent as extra frames with `copy=False`, so they are not
+serialized nor copied by the codecs. The receiving side gets them back as
+memoryviews of the received frames.
+
+Note: plain `str` objects are not considered binary since on Python 2 they
+are used for text too.
+"""
+
+FRAME_KEY = '__frame__'
+
+BINARY_TYPES = (bytearray, memoryview)
+try:
+    BINARY_TYPES += (buffer,)
+except NameError:
+    # Python 3, `bytes` is not text
+    BINARY_TYPES += (bytes,)
+
+
+def extract_buffers(data):
+    """
+    Replace the binary objects in `data` with placeholders.
+
+    :param data: the data to process, containing dicts, lists and tuples.
+    :type data: object
+
+    :return: the data with placeholders and the extracted binary objects.
+    :rtype: tuple(object, list)
+    """
+    buffers = []
+    data = _extract(data, buffers)
+    return data, buffers
+
+
+def _extract(data, buffers):
+    if isinstance(data, BINARY_TYPES):
+        buffers.append(data)
+        return {FRAME_KEY: len(buffers) - 1}
+
+    if isinstance(data, dict):
+        return dict((key, _extract(value, buffers))
+                    for key, value in data.iteritems())
+
+    if isinstance(data, (list, tuple)):
+        return [_extract(value, buffers) for value in data]
+
+    return data
+
+
+def restore_buffers(data, frames):
+    """
+    Replace the placeholders in `data` with memoryviews of the frames.
+
+    :param data: the decoded data.
+    :type data: object
+    :param frames: the received frames (zmq.Frame) or buffers.
+    :type frames: list
+
+    :return: the data with the binary objects restored.
+    :rtype: object
+    """
+    if not frames:
+        return data
+
+    buffers = [getattr(frame, 'buffer', frame) for frame in frames]
+    return _restore(data, buffers)
+
+
+def _restore(data, buffers):
+    if isinstance(data, dict):
+        if len(data) == 1 and FRAME_KEY in data:
+            return buffers[data[FRAME_KEY]]
+        return dict((key, _restore(value, buffers))
+                    for key, value in data.iteritems())
+
+    if isinstance(data, list):
+        return [_restore(value, buffers) for value in data]
+
+    return data
@@ -0,0 +1,162 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Minimal thread safe future used to deliver the result of backend calls.
+"""
+import threading
+
+from utils import get_log_handler
+
+logger = get_log_handler(__name__)
+
+
+class BackendError(Exception):
+    """
+    The backend could not complete a call.
+    """
+
+
+class CancelledError(BackendError):
+    """
+    The call was cancelled by the caller.
+    """
+
+
+class Future(object):
+    """
+    Placeholder for the result of a call that may not have finished yet.
+
+    The interface mimics `concurrent.futures.Future`.
+
+    Note: the done callbacks are run in the thread that resolves the future
+    (e.g. the BackendProxy worker thread), GUI code needs to forward the
+    result to the GUI thread before touching any widget.
+    """
+    def __init__(self, canceller=None):
+        """
+        :param canceller: called with the future when it is cancelled, e.g.
+                          to tell the backend to stop the call.
+        :type canceller: callable
+        """
+        self._canceller = canceller
+        self._done = threading.Event()
+        self._lock = threading.Lock()
+        self._result = None
+        self._exception = None
+        self._callbacks = []
+
+    def done(self):
+        """
+        Return True if the future has a result or an exception.
+
+        :rtype: bool
+        """
+        return self._done.is_set()
+
+    def cancelled(self):
+        """
+        Return True if the future was cancelled.
+
+        :rtype: bool
+        """
+        return self.done() and isinstance(self._exception, CancelledError)
+
+    def cancel(self):
+        """
+        Cancel the call, the future fails right away with a CancelledError.
+        Unlike `concurrent.futures.Future`, a running call can be cancelled
+        too, the backend is asked to stop it (see `cancellation`).
+
+        :return: False if the future was already done, True otherwise.
+        :rtype: bool
+        """
+        if not self._resolve(None, CancelledError("Call cancelled.")):
+            return False
+
+        if self._canceller is not None:
+            try:
+                self._canceller(self)
+            except Exception as e:
+                logger.error("Error cancelling the call: {0!r}".format(e))
+        return True
+
+    def result(self, timeout=None):
+        """
+        Wait for the result and return it.
+
+        :param timeout: maximum time to wait in seconds, None to wait forever.
+        :type timeout: float
+
+        :raise BackendError: if the result is not available in time.
+        """
+        if not self._done.wait(timeout):
+            raise BackendError("Timeout waiting for the result.")
+
+        if self._exception is not None:
+            raise self._exception
+
+        return self._result
+
+    def exception(self, timeout=None):
+        """
+        Wait for the result and return the exception raised by the call, None
+        if the call succeeded.
+
+        :param timeout: maximum time to wait in seconds, None to wait forever.
+        :type timeout: float
+        """
+        if not self._done.wait(timeout):
+            raise BackendError("Timeout waiting for the result.")
+
+        return self._exception
+
+    def add_done_callback(self, callback):
+        """
+        Call `callback(future)` once the future is done, right away if it
+        already is.
+
+        :param callback: the callable to run.
+        :type callback: callable
+        """
+        with self._lock:
+            if not self._done.is_set():
+                self._callbacks.append(callback)
+                return
+
+        callback(self)
+
+    def set_result(self, result):
+        """
+        Resolve the future with the given result.
+        """
+        self._resolve(result, None)
+
+    def set_exception(self, exception):
+        """
+        Resolve the future with the given exception.
+        """
+        self._resolve(None, exception)
+
+    def _resolve(self, result, exception):
+        """
+        Store the outcome of the call, wake up the waiters and run the done
+        callbacks.
+
+        :return: False if the future was already done, True otherwise.
+        :rtype: bool
+        """
+        with self._lock:
+            if self._done.is_set():
+                return False
+
+            self._result = result
+            self._exception = exception
+            self._done.set()
+            callbacks, self._callbacks = self._callbacks, []
+
+        for callback in callbacks:
+            try:
+                callback(self)
+            except Exception as e:
+                logger.error("Error running future callback: {0!r}".format(e))
+        return True
@@ -0,0 +1,165 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Out-of-band heartbeat, used to know if the backend is alive without going
+through the requests channel.
+
+The server side binds a ROUTER socket and answers each PING with a PONG, the
+client side runs a HeartbeatMonitor thread with its own DEALER socket.
+"""
+import threading
+import time
+
+import zmq
+
+from api import PING_REQUEST
+from protocol import PONG, frame_bytes, split_envelope
+from transport import connect_client
+from utils import get_log_handler
+
+logger = get_log_handler(__name__)
+
+
+def answer_heartbeats(socket):
+    """
+    Answer all the pings available in a heartbeat ROUTER socket.
+
+    :param socket: the heartbeat socket.
+    :type socket: zmq.Socket
+    """
+    while True:
+        try:
+            frames = socket.recv_multipart(zmq.NOBLOCK)
+        except zmq.ZMQError as e:
+            if e.errno != zmq.EAGAIN:
+                raise
+            break
+
+        try:
+            envelope, body = split_envelope(frames)
+        except ValueError:
+            continue
+
+        if body and frame_bytes(body[0]) == PING_REQUEST:
+            socket.send_multipart(envelope + [PONG])
+
+
+class HeartbeatMonitor(object):
+    """
+    Pings the server periodically and keeps track of whether it is alive.
+
+    The monitor has its own socket and thread, so it never delays nor takes
+    the place of a real request.
+    """
+    def __init__(self, context, server, server_keys, interval, timeout,
+                 on_back_online=None):
+        """
+        :param context: the zmq context to create the socket in.
+        :type context: zmq.Context
+        :param server: the address of the heartbeat socket to ping.
+        :type server: str
+        :param server_keys: returns the server's CURVE keys, only used if
+                            the address is a tcp one.
+        :type server_keys: callable
+        :param interval: the time between pings, in seconds.
+        :type interval: float
+        :param timeout: the time to wait for a pong, in seconds.
+        :type timeout: float
+        :param on_back_online: called, from the monitor thread, when the
+                               server answers again after being offline.
+        :type on_back_online: callable
+        """
+        self._context = context
+        self._server = server
+        self._server_keys = server_keys
+        self._interval = interval
+        self._timeout = timeout
+        self._on_back_online = on_back_online
+
+        self.online = False
+
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+
+    def start(self):
+        """
+        Start pinging the server.
+        """
+        self._thread.start()
+
+    def stop(self):
+        """
+        Stop pinging the server.
+        """
+        self._stopped.set()
+
+    def _create_socket(self):
+        """
+        Create the socket used to ping the server.
+
+        :rtype: zmq.Socket
+        """
+        socket = self._context.socket(zmq.DEALER)
+        socket.setsockopt(zmq.LINGER, 0)  # Terminate early
+        connect_client(socket, self._server, self._server_keys)
+        return socket
+
+    def _run(self):
+        """
+        Ping loop.
+        """
+        socket = self._create_socket()
+        poller = zmq.Poller()
+        poller.register(socket, zmq.POLLIN)
+
+        was_online = False
+        while not self._stopped.is_set():
+            next_ping = time.time() + self._interval
+            socket.send_multipart(['', PING_REQUEST])
+
+            alive = self._wait_pong(socket, poller)
+            if alive != self.online:
+                logger.debug("Backend is {0}.".format(
+                    "online" if alive else "offline"))
+                if alive and was_online and self._on_back_online:
+                    self._on_back_online()
+            self.online = alive
+            was_online = was_online or alive
+
+            if not alive:
+                # drop the pings queued for the missing server.
+                poller.unregister(socket)
+                socket.close()
+                socket = self._create_socket()
+                poller.register(socket, zmq.POLLIN)
+
+            self._stopped.wait(max(0, next_ping - time.time()))
+
+        socket.close()
+        logger.debug("Heartbeat monitor stopped.")
+
+    def _wait_pong(self, socket, poller):
+        """
+        Wait for a pong from the server.
+
+        :return: whether a pong arrived in time.
+        :rtype: bool
+        """
+        deadline = time.time() + self._timeout
+        while True:
+            timeout = deadline - time.time()
+            if timeout <= 0:
+                return False
+
+            if not dict(poller.poll(timeout * 1000)):
+                return False
+
+            # late pongs from previous pings count too, the server is alive.
+            while True:
+                try:
+                    socket.recv_multipart(zmq.NOBLOCK)
+                except zmq.ZMQError as e:
+                    if e.errno != zmq.EAGAIN:
+                        raise
+                    return True
@@ -0,0 +1,201 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Runtime metrics: counters, latency histograms and gauges, kept by the
+Backend, the BackendProxy and the Signaler.
+"""
+import bisect
+import collections
+import json
+import os
+import threading
+import time
+
+from utils import get_log_handler
+
+logger = get_log_handler(__name__)
+
+# upper bounds of the latency histogram buckets.
+BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000)  # ms
+
+
+class Histogram(object):
+    """
+    Latency histogram with fixed buckets.
+
+    Note: it is not thread safe, the Metrics lock protects it.
+    """
+    def __init__(self, buckets=BUCKETS):
+        """
+        :param buckets: the upper bounds of the buckets, sorted.
+        :type buckets: tuple of float
+        """
+        self._buckets = buckets
+        self._counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.total = 0.0
+
+    def observe(self, value):
+        """
+        Add a value to the histogram.
+
+        :param value: the value, in the buckets unit.
+        :type value: float
+        """
+        self._counts[bisect.bisect_left(self._buckets, value)] += 1
+        self.count += 1
+        self.total += value
+
+    def snapshot(self):
+        """
+        Return the amount of values, their sum and the cumulative count of
+        each bucket, as [upper bound, count] pairs.
+
+        :rtype: dict
+        """
+        buckets = []
+        cumulative = 0
+        for bound, count in zip(self._buckets + ('+Inf',), self._counts):
+            cumulative += count
+            buckets.append([bound, cumulative])
+
+        return {
+            'count': self.count,
+            'sum': self.total,
+            'buckets': buckets,
+        }
+
+
+class Metrics(object):
+    """
+    Thread safe registry of counters, latency histograms and gauges.
+
+    The gauges are callables registered once and read when a snapshot is
+    taken, e.g. the depth of a queue.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = collections.Counter()
+        self._histograms = collections.defaultdict(Histogram)
+        self._gauges = {}
+
+    def increment(self, name, amount=1):
+        """
+        Increment a counter.
+
+        :param name: the counter name.
+        :type name: str
+        :param amount: the amount to add.
+        :type amount: int
+        """
+        with self._lock:
+            self._counters[name] += amount
+
+    def observe(self, name, seconds):
+        """
+        Add a latency to a histogram.
+
+        :param name: the histogram name.
+        :type name: str
+        :param seconds: the latency, in seconds.
+        :type seconds: float
+        """
+        with self._lock:
+            self._histograms[name].observe(seconds * 1000)
+
+    def gauge(self, name, func):
+        """
+        Register a gauge.
+
+        :param name: the gauge name.
+        :type name: str
+        :param func: returns the current value, it must be serializable.
+        :type func: callable
+        """
+        self._gauges[name] = func
+
+    def snapshot(self):
+        """
+        Return the current value of all the metrics.
+
+        :rtype: dict
+        """
+        with self._lock:
+            counters = dict(self._counters)
+            histograms = dict((name, histogram.snapshot())
+                              for name, histogram in self._histograms.items())
+
+        gauges = {}
+        for name, func in self._gauges.items():
+            try:
+                gauges[name] = func()
+            except Exception as e:
+                logger.error("Cannot read gauge '{0}': {1!r}".format(name, e))
+
+        return {
+            'counters': counters,
+            'histograms': histograms,
+            'gauges': gauges,
+        }
+
+
+def dump_metrics(metrics, path):
+    """
+    Write a metrics snapshot to a file as JSON. The file is replaced at once,
+    so a scraper never reads a partial file.
+
+    :param metrics: the snapshot to write.
+    :type metrics: dict
+    :param path: the file path.
+    :type path: str
+    """
+    metrics = dict(metrics, time=time.time())
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(metrics, f, sort_keys=True)
+    os.rename(tmp_path, path)
+
+
+class MetricsDumper(object):
+    """
+    Dumps a metrics snapshot to a file periodically, in its own thread.
+    """
+    def __init__(self, snapshot, path, interval):
+        """
+        :param snapshot: returns the metrics to dump.
+        :type snapshot: callable
+        :param path: the file path.
+        :type path: str
+        :param interval: the time between dumps, in seconds.
+        :type interval: float
+        """
+        self._snapshot = snapshot
+        self._path = path
+        self._interval = interval
+
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+
+    def start(self):
+        """
+        Start dumping the metrics.
+        """
+        self._thread.start()
+
+    def stop(self):
+        """
+        Stop dumping the metrics.
+        """
+        self._stopped.set()
+
+    def _run(self):
+        """
+        Dump loop.
+        """
+        while not self._stopped.wait(self._interval):
+            try:
+                dump_metrics(self._snapshot(), self._path)
+            except Exception as e:
+                logger.error("Cannot dump metrics to '{0}': {1!r}".format(
+                    self._path, e))
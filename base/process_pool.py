@@ -0,0 +1,316 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Process pool used by the Backend to run the CPU bound API methods, so they
+are not serialized by the GIL.
+"""
+import functools
+import itertools
+import multiprocessing
+import threading
+import time
+import traceback
+
+from twisted.internet import defer, reactor, threads
+
+from api import SIGNALS
+from frames import extract_buffers, restore_buffers
+from utils import get_log_handler
+
+logger = get_log_handler(__name__)
+
+
+def _to_bytes(buf):
+    """
+    Return the content of a binary object as a str.
+    """
+    if isinstance(buf, memoryview):
+        return buf.tobytes()
+    return bytes(buf)
+
+
+class SignalCollector(object):
+    """
+    Signaler stand-in used in the worker processes.
+    Collects the signals emitted by a method so the Backend can send them
+    through its own Signaler once the method finishes.
+    """
+    def __init__(self):
+        self.signals = []
+
+    def __getattribute__(self, name):
+        """
+        Mimic Signaler's attribute access, so the API methods can do:
+            self._signaler.signal(self._signaler.some_signal)
+
+        :param name: the attribute name that is requested.
+        :type name: str
+        """
+        if name in SIGNALS:
+            return name
+        else:
+            return object.__getattribute__(self, name)
+
+    def signal(self, signal, data=None):
+        """
+        Store a signal to be sent later.
+
+        :param signal: the signal to send.
+        :type signal: str
+        :param data: the data to send along the signal.
+        :type data: object
+        """
+        if signal not in SIGNALS:
+            raise Exception("Unknown signal: '{0}'".format(signal))
+        self.signals.append((signal, data))
+
+
+class ProcessContext(object):
+    """
+    Backend stand-in used as `self` for the methods run in the worker
+    processes, only the signaler is available there.
+    """
+    def __init__(self):
+        self._signaler = SignalCollector()
+
+
+def _run_method(backend_class, api_method, kwargs, buffers):
+    """
+    Run an API method in a worker process.
+
+    :return: whether the method succeeded, its result (or the formatted
+             traceback) and the signals it emitted.
+    :rtype: tuple(bool, object, list)
+    """
+    context = ProcessContext()
+    func = getattr(backend_class, api_method).__func__
+    try:
+        result = func(context, **restore_buffers(kwargs, buffers))
+    except Exception:
+        return False, traceback.format_exc(), context._signaler.signals
+
+    return True, result, context._signaler.signals
+
+
+class ProcessPool(object):
+    """
+    Run API methods in a pool of worker processes.
+
+    Every call gets an outcome: the pool only reports the successful ones,
+    so the calls that fail before or after running the method (e.g. the
+    arguments or the result can not be pickled), the ones running on a
+    worker that dies and the ones still running on stop are failed here.
+
+    Note: the pool must be created before starting any thread or opening
+    any socket, since the workers are forked when it starts.
+    """
+    # how often the calls in the pool are checked for failures.
+    CHECK_INTERVAL = 0.1  # secs
+
+    def __init__(self, size=None):
+        """
+        :param size: the amount of worker processes, the number of CPUs if
+                     None.
+        :type size: int
+        """
+        self._pool = multiprocessing.Pool(size)
+
+        # calls in the pool, {key: [ApplyResult or None, callback]}
+        self._calls = {}
+        self._keys = itertools.count()
+        self._changed = threading.Condition()
+        self._stopped = False
+        self._workers = self._worker_pids()
+
+        watcher = threading.Thread(target=self._watch)
+        watcher.daemon = True
+        watcher.start()
+
+    def stop(self):
+        """
+        Stop the worker processes, the running calls fail.
+        """
+        with self._changed:
+            self._stopped = True
+            calls, self._calls = self._calls, {}
+            self._changed.notify_all()
+
+        self._pool.terminate()
+        self._pool.join()
+        for _, callback in calls.values():
+            callback((False, "The process pool was stopped.", []))
+
+    def submit(self, backend_class, api_method, kwargs, signaler,
+               record=None, trace=None):
+        """
+        Run `backend_class.api_method` in a worker process.
+        The signals emitted by the method are sent through `signaler` once
+        the call finishes.
+
+        :param backend_class: the Backend subclass implementing the method.
+        :type backend_class: type
+        :param api_method: the method name.
+        :type api_method: str
+        :param kwargs: the arguments for the method.
+        :type kwargs: dict
+        :param signaler: the signaler used to send the collected signals.
+        :type signaler: Signaler
+        :param record: a list to add the sent signals to, see
+                       `Signaler.record`.
+        :type record: list
+        :param trace: the trace id the sent signals belong to, see
+                      `Signaler.tracing`.
+        :type trace: str
+
+        :return: a deferred that fires, in the reactor thread, with the
+                 method result.
+        :rtype: twisted.internet.defer.Deferred
+        """
+        d = defer.Deferred()
+
+        def done(outcome):
+            reactor.callFromThread(self._finished, d, outcome, signaler,
+                                   record, trace)
+
+        # memoryviews can not be pickled, send the binary data as str.
+        kwargs, buffers = extract_buffers(kwargs)
+        buffers = [_to_bytes(buf) for buf in buffers]
+
+        # registered first, the call may finish before apply_async returns.
+        key = next(self._keys)
+        with self._changed:
+            self._calls[key] = [None, done]
+
+        result = self._pool.apply_async(
+            _run_method, (backend_class, api_method, kwargs, buffers),
+            callback=functools.partial(self._succeeded, key))
+
+        with self._changed:
+            if key in self._calls:
+                self._calls[key][0] = result
+                self._changed.notify()
+        return d
+
+    def _succeeded(self, key, outcome):
+        """
+        Hand the outcome of a call to its callback.
+        This is run in a thread of the pool.
+        """
+        callback = self._take(key)
+        if callback is not None:
+            callback(outcome)
+
+    def _take(self, key):
+        """
+        Forget a call, so it gets only one outcome.
+
+        :return: the callback of the call, None if it already got one.
+        :rtype: callable
+        """
+        with self._changed:
+            entry = self._calls.pop(key, None)
+        return entry and entry[1]
+
+    def _worker_pids(self):
+        """
+        Return the pids of the worker processes.
+
+        :rtype: set
+        """
+        return set(worker.pid for worker in self._pool._pool)
+
+    def _watch(self):
+        """
+        Fail the calls the pool does not report: the ones that failed
+        outside the method and, when a worker dies, the ones that were
+        running since they can not be told apart.
+        This is run in its own thread.
+        """
+        while True:
+            with self._changed:
+                while not self._calls and not self._stopped:
+                    self._changed.wait()
+                if self._stopped:
+                    return
+
+                workers = self._worker_pids()
+                worker_died = bool(self._workers - workers)
+                self._workers = workers
+
+                failed = []
+                for key, (result, _) in self._calls.items():
+                    if result is None:
+                        continue
+                    if result.ready():
+                        if not result.successful():
+                            failed.append((key, self._error(result)))
+                    elif worker_died:
+                        failed.append((key, "A worker process died."))
+
+            for key, error in failed:
+                callback = self._take(key)
+                if callback is not None:
+                    logger.error("Process pool call failed: {0}".format(
+                        error))
+                    callback((False, error, []))
+
+            time.sleep(self.CHECK_INTERVAL)
+
+    def _error(self, result):
+        """
+        Return the error of a failed call.
+
+        :param result: the failed call.
+        :type result: multiprocessing.pool.ApplyResult
+        :rtype: str
+        """
+        try:
+            result.get(0)
+        except Exception as e:
+            return "The call failed in the process pool: {0!r}".format(e)
+        return "The call failed in the process pool."
+
+    def _finished(self, d, outcome, signaler, record, trace):
+        """
+        Send the signals emitted by a call and fire its deferred.
+        The signals are sent from a thread, the reactor must not wait for
+        room in the signals queue.
+        """
+        ok, result, signals = outcome
+        if not signals:
+            self._fire(None, d, ok, result)
+            return
+
+        sent = threads.deferToThread(self._send_signals, signals, signaler,
+                                     record, trace)
+        sent.addErrback(self._signals_failed)
+        sent.addCallback(self._fire, d, ok, result)
+
+    def _send_signals(self, signals, signaler, record, trace):
+        """
+        Send the signals emitted by a call.
+        This is run in a thread, it may wait for room in the signals queue.
+        """
+        with signaler.record(record), signaler.tracing(trace):
+            for signal, data in signals:
+                signaler.signal(signal, data)
+
+    def _signals_failed(self, failure):
+        """
+        Log the failure to send the signals of a call, the call outcome is
+        still delivered.
+        """
+        logger.error("Error sending the signals of a process pool call: "
+                     "{0}".format(failure.getErrorMessage()))
+
+    def _fire(self, _, d, ok, result):
+        """
+        Fire the deferred of a call with its outcome.
+        """
+        if d.called:
+            return  # the call was cancelled
+
+        if ok:
+            d.callback(result)
+        else:
+            d.errback(Exception(result))
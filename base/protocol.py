@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Wire protocol helpers for the BackendProxy <-> Backend channel.
+
+Requests travel from a DEALER socket to a ROUTER socket, so many of them can
+be in flight at once. Every message carries the id of the request it belongs
+to and its kind:
+
+    request: ['', request_id, REQUEST, codec_name, payload, buffers...]
+    hello:   ['', request_id, HELLO, 'codec_1 codec_2 ...']
+    reply:   ['', request_id, kind, ...]
+
+Binary arguments and results travel as extra frames after the payload, see
+`frames`. Messages are received with `copy=False`, so the frames are
+`zmq.Frame` objects and `frame_bytes` is used to read the small ones.
+
+The ROUTER side prepends the routing envelope (one or more identity frames)
+to the received frames and uses it to send the reply back.
+
+On connection, the client sends a HELLO with the codecs it supports in order
+of preference and the server answers with a HELLO reply naming the chosen
+one. Until then the client uses the default codec. Since every request names
+its codec, the server does not need to keep any per client state.
+
+Every request is acknowledged with an ACK reply as soon as it is received.
+Requests that ask for a reply get a RESULT reply ([codec_name, value]) or an
+ERROR reply ([message]) once the API method finishes. RESULT replies can
+carry extra frames too.
+
+A request that is not acknowledged in time is sent again, with the same id,
+over a new connection. The request ids are unique across clients, the server
+remembers the recent ones and does not run a repeated request again, it acks
+it and sends its reply, when available, to the new connection.
+
+Behind a Broker, the workers announce themselves with a READY message:
+
+    ready:   [READY]
+
+and a request can name an earlier request it follows, see `follow_request`,
+to reach the worker that got that one, e.g. the credits of a stream or the
+cancel of a call.
+"""
+
+# request kinds
+REQUEST = "REQUEST"
+HELLO = "HELLO"
+
+# reply kinds
+ACK = "ACK"
+RESULT = "RESULT"
+ERROR = "ERROR"
+
+# heartbeat channel reply, see `heartbeat`
+PONG = "PONG"
+
+# sent by the workers to the Broker, see `broker`
+READY = "READY"
+
+# separates the id of a request from the id of the request it follows.
+FOLLOWS = ">"
+
+
+def frame_bytes(frame):
+    """
+    Return the content of a frame as a str.
+
+    :param frame: a received frame.
+    :type frame: zmq.Frame or str
+    :rtype: str
+    """
+    return getattr(frame, 'bytes', frame)
+
+
+def split_envelope(frames):
+    """
+    Split a multipart message received on a ROUTER socket into its routing
+    envelope and the message body.
+
+    :param frames: the received frames.
+    :type frames: list
+
+    :return: the envelope (including the empty delimiter) as str and the
+             body frames as received.
+    :rtype: tuple(list, list)
+
+    :raise ValueError: if there is no empty delimiter frame.
+    """
+    for delimiter, frame in enumerate(frames):
+        if len(frame) == 0:
+            break
+    else:
+        raise ValueError("Missing envelope delimiter.")
+
+    envelope = [frame_bytes(frame) for frame in frames[:delimiter + 1]]
+    return envelope, frames[delimiter + 1:]
+
+
+def follow_request(request_id, followed):
+    """
+    Return the id of a request that follows an earlier one, so the Broker
+    sends it to the worker that got the earlier request.
+
+    :param request_id: the id of the new request.
+    :type request_id: str
+    :param followed: the id of the earlier request.
+    :type followed: str
+    :rtype: str
+    """
+    return "{0}{1}{2}".format(request_id, FOLLOWS, followed)
+
+
+def followed_request(request_id):
+    """
+    Return the id of the request a request follows, see `follow_request`.
+
+    :param request_id: the id of a request.
+    :type request_id: str
+
+    :return: the id of the earlier request, None if it follows none.
+    :rtype: str
+    """
+    _, _, followed = request_id.partition(FOLLOWS)
+    return followed or None
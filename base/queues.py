@@ -0,0 +1,166 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Bounded queue with overflow policies, used for the calls waiting to be sent
+to the backend and for the signals waiting to be published.
+"""
+import collections
+import Queue
+import threading
+
+from utils import get_log_handler
+
+logger = get_log_handler(__name__)
+
+# Overflow policies
+BLOCK = 'block'  # wait until there is room in the queue
+DROP_OLDEST = 'drop-oldest'  # discard the oldest queued item
+DROP_NEWEST = 'drop-newest'  # discard the item being queued
+# replace the queued item with the same key, if any, keeping its position.
+# This applies even if the queue is not full, if there is no such item the
+# oldest one is discarded when the queue is full.
+COALESCE_LATEST = 'coalesce-latest'
+
+POLICIES = (BLOCK, DROP_OLDEST, DROP_NEWEST, COALESCE_LATEST)
+
+
+class BoundedQueue(object):
+    """
+    Thread safe FIFO queue with a maximum size.
+
+    Each item is queued with a key (e.g. the API method or signal name) used
+    to choose the overflow policy and to count the dropped and coalesced
+    items.
+    """
+    def __init__(self, maxsize, policy=BLOCK, policies=None, on_drop=None):
+        """
+        :param maxsize: the maximum amount of queued items.
+        :type maxsize: int
+        :param policy: the default overflow policy.
+        :type policy: str
+        :param policies: the overflow policy for each key, if not default.
+        :type policies: dict
+        :param on_drop: callable run with the item and the policy applied
+                        each time an item is discarded or replaced.
+        :type on_drop: callable
+        """
+        policies = policies or {}
+        for p in [policy] + list(policies.values()):
+            if p not in POLICIES:
+                raise ValueError("Unknown overflow policy: '{0}'".format(p))
+
+        self.maxsize = maxsize
+        self._policy = policy
+        self._policies = policies
+        self._on_drop = on_drop
+
+        self._items = collections.deque()
+        self._lock = threading.Lock()
+        self._not_empty = threading.Condition(self._lock)
+        self._not_full = threading.Condition(self._lock)
+
+        self.dropped = collections.Counter()
+        self.coalesced = collections.Counter()
+
+    def put(self, item, key=None, force=False):
+        """
+        Queue an item, applying the overflow policy for `key` if needed.
+
+        :param item: the item to queue.
+        :type item: object
+        :param key: the key of the item.
+        :type key: str
+        :param force: queue the item even if the queue is full, used for
+                      control items that must never be lost.
+        :type force: bool
+
+        :return: whether the item was queued (or replaced a queued one).
+        :rtype: bool
+        """
+        policy = self._policies.get(key, self._policy)
+        discarded = []
+        queued = True
+
+        with self._lock:
+            replaced = False
+            if policy == COALESCE_LATEST and not force:
+                for index, (queued_key, queued_item) in enumerate(self._items):
+                    if queued_key == key:
+                        self._items[index] = (key, item)
+                        self.coalesced[key] += 1
+                        discarded.append(queued_item)
+                        replaced = True
+                        break
+
+            if not replaced:
+                if len(self._items) >= self.maxsize and not force:
+                    if policy == BLOCK:
+                        while len(self._items) >= self.maxsize:
+                            self._not_full.wait()
+                    elif policy == DROP_NEWEST:
+                        self.dropped[key] += 1
+                        discarded.append(item)
+                        queued = False
+                    else:
+                        old_key, old_item = self._items.popleft()
+                        self.dropped[old_key] += 1
+                        discarded.append(old_item)
+
+                if queued:
+                    self._items.append((key, item))
+                    self._not_empty.notify()
+
+        if discarded:
+            logger.warning("Queue overflow, '{0}' applied for '{1}'".format(
+                policy, key))
+            if self._on_drop is not None:
+                self._on_drop(discarded[0], policy)
+
+        return queued
+
+    def get(self, block=True, timeout=None):
+        """
+        Remove and return the oldest item.
+
+        :param block: whether to wait for an item if the queue is empty.
+        :type block: bool
+        :param timeout: maximum time to wait in seconds, None to wait forever.
+        :type timeout: float
+
+        :raise Queue.Empty: if there is no item available.
+        """
+        with self._lock:
+            if block and timeout is None:
+                while not self._items:
+                    self._not_empty.wait()
+            elif block and not self._items:
+                self._not_empty.wait(timeout)
+
+            if not self._items:
+                raise Queue.Empty
+
+            _, item = self._items.popleft()
+            self._not_full.notify()
+            return item
+
+    def qsize(self):
+        """
+        Return the amount of queued items.
+
+        :rtype: int
+        """
+        return len(self._items)
+
+    def stats(self):
+        """
+        Return the queue size and the dropped and coalesced counters.
+
+        :rtype: dict
+        """
+        with self._lock:
+            return {
+                'size': len(self._items),
+                'maxsize': self.maxsize,
+                'dropped': dict(self.dropped),
+                'coalesced': dict(self.coalesced),
+            }
@@ -0,0 +1,187 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Qt-free subscriber for the signals published by the backend's Signaler.
+"""
+import threading
+import time
+
+import zmq
+
+from api import SIGNALS
+from codec import get_codec
+from frames import restore_buffers
+from protocol import frame_bytes
+from tracing import get_trace_log
+from transport import SIGNALS as SIGNALS_ENDPOINT
+from transport import connect_address, connect_client
+from certificates import get_frontend_certificates
+from utils import get_log_handler
+
+logger = get_log_handler(__name__)
+
+
+class SignalReceiver(object):
+    """
+    Signals subscriber.
+    Receives the signals published by the backend and hands them to a
+    callback. Only the given signals are subscribed to, the rest are filtered
+    out by ZMQ before reaching us.
+
+    Any number of receivers can be connected to the same backend.
+    """
+    SERVER = connect_address(SIGNALS_ENDPOINT)
+
+    # in-process channel used to wake up the worker loop when it has to stop.
+    CONTROL_ADDR = "inproc://signal-receiver-control-%x"
+
+    def __init__(self, callback, signals=None, with_trace=False,
+                 server=None):
+        """
+        :param callback: the callable to run for each signal received, with
+                         the signal name and data as parameters. It is run in
+                         the receiver thread.
+        :type callback: callable
+        :param signals: the names of the signals to subscribe to, all the
+                        SIGNALS if None.
+        :type signals: list of str
+        :param with_trace: whether to pass the trace of the signal to the
+                           callback too, as a third parameter, so it can
+                           stamp the later hops. See the `tracing` module.
+        :type with_trace: bool
+        :param server: the address of the signals publisher, SERVER if None.
+                       CURVE is only used for tcp addresses.
+        :type server: str
+        """
+        if signals is None:
+            signals = SIGNALS
+        self._signals = frozenset(signals)
+        self._callback = callback
+        self._with_trace = with_trace
+        self._server = server or self.SERVER
+        self._trace_log = get_trace_log()
+
+        self._worker_thread = threading.Thread(target=self._run)
+        self._do_work = threading.Event()
+
+        # The worker loop polls both the signals socket and this control
+        # pair, `stop` uses the waker to notify it.
+        context = zmq.Context()
+        self._context = context
+        control_addr = self.CONTROL_ADDR % id(self)
+        control = context.socket(zmq.PAIR)
+        control.bind(control_addr)  # must come before connect for inproc
+        waker = context.socket(zmq.PAIR)
+        waker.connect(control_addr)
+        self._control_socket = control
+        self._control_waker = waker
+        self._waker_lock = threading.Lock()
+
+    def start(self):
+        """
+        Start the worker thread for the receiver.
+        """
+        self._do_work.set()
+        self._worker_thread.start()
+
+    def stop(self):
+        """
+        Stop the receiver blocking loop.
+        This can be called from any thread.
+        """
+        self._do_work.clear()
+        with self._waker_lock:
+            self._control_waker.send('')
+
+    def _run(self):
+        """
+        Start a loop to process the signals published by the backend.
+        """
+        logger.debug("Running SignalReceiver loop")
+        socket = self._context.socket(zmq.SUB)
+
+        for signal in self._signals:
+            socket.setsockopt(zmq.SUBSCRIBE, signal)
+
+        socket.setsockopt(zmq.LINGER, 0)  # Terminate early
+        connect_client(socket, self._server, get_frontend_certificates)
+
+        poller = zmq.Poller()
+        poller.register(socket, zmq.POLLIN)
+        poller.register(self._control_socket, zmq.POLLIN)
+
+        # blocks until a signal arrives or `stop` wakes it up.
+        while self._do_work.is_set():
+            socks = dict(poller.poll())
+            if socks.get(self._control_socket) == zmq.POLLIN:
+                self._control_socket.recv()
+            if socks.get(socket) != zmq.POLLIN:
+                continue
+
+            # each message is a batch of signals, see Signaler._send_request
+            frames = socket.recv_multipart(copy=False)
+            self._process_batch(frames)
+
+        socket.close()
+        logger.debug("SignalReceiver thread stopped.")
+
+    def _process_batch(self, frames):
+        """
+        Split a batch of signals and process each of them in order.
+
+        :param frames: the received frames.
+        :type frames: list of zmq.Frame
+        """
+        try:
+            topic = frame_bytes(frames[0])
+            codec = get_codec(frame_bytes(frames[1]))
+            counts = [int(c) for c in frame_bytes(frames[2]).split()]
+        except (IndexError, ValueError) as e:
+            logger.error("Cannot decode signals: {0!r}".format(e))
+            return
+
+        # subscriptions match by prefix, filter out the longer names.
+        if topic not in self._signals:
+            return
+
+        logger.debug("Received {0} '{1}' signals.".format(len(counts), topic))
+        index = 3
+        for count in counts:
+            request = frame_bytes(frames[index])
+            buffers = frames[index + 1:index + 1 + count]
+            index += 1 + count
+            self._process_request(request, codec, buffers)
+
+    def _process_request(self, request_data, codec, buffers=None):
+        """
+        Decode a signal and run the callback for it.
+
+        :param request_data: a serialized specification of a signal.
+        :type request_data: str
+        :param codec: the codec used to serialize the signal.
+        :type codec: object
+        :param buffers: the binary data received as separate frames, they
+                        are handed to the callback as memoryviews.
+        :type buffers: list of zmq.Frame
+        """
+        try:
+            request = codec.loads(request_data)
+            signal = request['signal']
+            data = restore_buffers(request['data'], buffers)
+            trace = request.get('trace')
+        except Exception as e:
+            msg = "Malformed {0} data in Signaler request '{1}'. Exc: {2!r}"
+            msg = msg.format(codec.name, request_data, e)
+            logger.critical(msg)
+            return
+
+        if trace is not None and self._trace_log is not None:
+            self._trace_log.write(trace['id'], trace['span'],
+                                  {'delivered': time.time()})
+        else:
+            trace = None
+
+        if self._with_trace:
+            self._callback(signal, data, trace)
+        else:
+            self._callback(signal, data)
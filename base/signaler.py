@@ -1,12 +1,22 @@
 #!/usr/bin/env python
 # encoding: utf-8
+import contextlib
+import itertools
 import Queue
 import threading
 import time
 
 import zmq
 
-from api import SIGNALS
+from api import SIGNALS, SIGNAL_POLICIES, SIGNAL_QUEUE_SIZE
+from codec import DEFAULT_CODEC, get_codec
+from frames import extract_buffers
+from metrics import Metrics
+from queues import BoundedQueue
+from tracing import get_trace_log
+from transport import SIGNALS as SIGNALS_ENDPOINT
+from transport import bind_address, bind_server, connect_client
+from transport import start_authenticator, uses_curve
 from certificates import get_frontend_certificates
 from utils import get_log_handler
 logger = get_log_handler(__name__)
@@ -14,43 +24,75 @@ logger = get_log_handler(__name__)
 
 class Signaler(object):
     """
-    Signaler client.
-    Receives signals from the backend and sends to the signaling server.
+    Signaler publisher.
+    Receives signals from the backend and publishes them to any number of
+    subscribers (SignalerQt or SignalReceiver).
     """
-    PORT = "5667"
-    SERVER = "tcp://localhost:%s" % PORT
+    BIND_ADDR = bind_address(SIGNALS_ENDPOINT)
 
-    POLL_TIMEOUT = 4000  # ms
-    POLL_TRIES = 3
-
-    def __init__(self):
+    def __init__(self, codec=None, connect_to=None, bind_addr=None):
         """
-        Initialize the ZMQ socket to talk to the signaling server.
+        Initialize the ZMQ socket to publish the signals.
+
+        :param codec: the name of the codec used to serialize the signals,
+                      the default one if None.
+        :type codec: str
+        :param connect_to: the address of a Broker's signals forwarder to
+                           publish through, if None we bind `bind_addr` and
+                           the subscribers connect to us.
+        :type connect_to: str
+        :param bind_addr: the address to publish the signals on, BIND_ADDR
+                          if None. CURVE is only used for tcp addresses.
+        :type bind_addr: str
         """
-        context = zmq.Context()
-        logger.debug("Connecting to signaling server...")
-        socket = context.socket(zmq.REQ)
+        self._codec = get_codec(codec or DEFAULT_CODEC)
+        self._socket = self._create_socket(connect_to,
+                                           bind_addr or self.BIND_ADDR)
 
-        # public, secret = zmq.curve_keypair()
-        client_keys = zmq.curve_keypair()
-        socket.curve_publickey = client_keys[0]
-        socket.curve_secretkey = client_keys[1]
+        self._signal_queue = BoundedQueue(SIGNAL_QUEUE_SIZE,
+                                          policies=SIGNAL_POLICIES)
 
-        # The client must know the server's public key to make a CURVE
-        # connection.
-        public, _ = get_frontend_certificates()
-        socket.curve_serverkey = public
+        # the signals sent by each thread are added here while recording.
+        self._recording = threading.local()
 
-        socket.setsockopt(zmq.RCVTIMEO, 1000)
-        socket.setsockopt(zmq.LINGER, 0)  # Terminate early
-        socket.connect(self.SERVER)
-        self._socket = socket
+        # the trace the signals sent by each thread belong to, and the
+        # counter used to name their spans.
+        self._tracing = threading.local()
+        self._trace_log = get_trace_log()
+        self._spans = itertools.count()
 
-        self._signal_queue = Queue.Queue()
+        self._metrics = Metrics()
+        self._metrics.gauge('signal_queue', self._signal_queue.stats)
 
         self._do_work = threading.Event()  # used to stop the worker thread.
         self._worker_signaler = threading.Thread(target=self._worker)
 
+    def _create_socket(self, connect_to, bind_addr):
+        """
+        Create the socket used to publish the signals.
+
+        :param connect_to: the address of a Broker's signals forwarder to
+                           connect to, None to bind `bind_addr`.
+        :type connect_to: str
+        :param bind_addr: the address to publish the signals on.
+        :type bind_addr: str
+        :rtype: zmq.Socket
+        """
+        context = zmq.Context()
+        socket = context.socket(zmq.PUB)
+
+        socket.setsockopt(zmq.LINGER, 0)  # Terminate early
+        if connect_to is None:
+            if uses_curve(bind_addr):
+                # Start an authenticator for this context.
+                start_authenticator(context)
+            bind_server(socket, bind_addr, get_frontend_certificates)
+        else:
+            logger.debug("Connecting to signals forwarder...")
+            connect_client(socket, connect_to, get_frontend_certificates)
+
+        return socket
+
     def __getattribute__(self, name):
         """
         This allows the user to do:
@@ -69,42 +111,132 @@ class Signaler(object):
 
     def signal(self, signal, data=None):
         """
-        Sends a signal to the signaling server.
+        Publishes a signal to the subscribers.
 
         :param signal: the signal to send.
         :type signal: str
+        :param data: the data to send along the signal. Binary values
+                     (bytearray, memoryview, buffer) are sent as separate
+                     frames without being copied.
+        :type data: object
         """
         if signal not in SIGNALS:
             raise Exception("Unknown signal: '{0}'".format(signal))
 
+        recording = getattr(self._recording, 'signals', None)
+        if recording is not None:
+            recording.append((signal, data))
+
+        trace = None
+        trace_id = getattr(self._tracing, 'trace_id', None)
+        if trace_id is not None and self._trace_log is not None:
+            trace = {
+                'id': trace_id,
+                'span': 'signal-{0}'.format(next(self._spans)),
+            }
+
+        request_data, buffers = self._serialize(signal, data, trace)
+
+        self._metrics.increment('signals.' + signal)
+
+        # queue the call in order to handle the request in a thread safe way.
+        self._signal_queue.put(
+            (signal, request_data, buffers, time.time(), trace), key=signal)
+
+    def _serialize(self, signal, data, trace):
+        """
+        Serialize a signal to publish it.
+
+        :param signal: the signal name.
+        :type signal: str
+        :param data: the data sent along the signal.
+        :type data: object
+        :param trace: the trace id and span of the signal, None if it is not
+                      traced.
+        :type trace: dict
+
+        :return: the serialized signal and its binary data.
+        :rtype: tuple(str, list)
+        """
+        data, buffers = extract_buffers(data)
         request = {
             'signal': signal,
             'data': data,
         }
+        if trace is not None:
+            request['trace'] = trace
 
         try:
-            request_json = zmq.utils.jsonapi.dumps(request)
+            return self._codec.dumps(request), buffers
         except Exception as e:
-            msg = ("Error serializing request into JSON.\n"
-                   "Exception: {0} Data: {1}")
-            msg = msg.format(e, request)
+            msg = ("Error serializing request into {0}.\n"
+                   "Exception: {1} Data: {2}")
+            msg = msg.format(self._codec.name, e, request)
             logger.critical(msg)
             raise
 
-        # queue the call in order to handle the request in a thread safe way.
-        self._signal_queue.put(request_json)
+    @contextlib.contextmanager
+    def record(self, signals):
+        """
+        Add to `signals` the signals sent by the current thread while in the
+        context, as (signal, data) tuples. The signals are published as
+        usual.
+
+        :param signals: the list to add the signals to.
+        :type signals: list
+        """
+        previous = getattr(self._recording, 'signals', None)
+        self._recording.signals = signals
+        try:
+            yield signals
+        finally:
+            self._recording.signals = previous
+
+    @contextlib.contextmanager
+    def tracing(self, trace_id):
+        """
+        Make the signals sent by the current thread while in the context
+        part of the given trace, see the `tracing` module.
+
+        :param trace_id: the trace id, None to not trace the signals.
+        :type trace_id: str
+        """
+        previous = getattr(self._tracing, 'trace_id', None)
+        self._tracing.trace_id = trace_id
+        try:
+            yield
+        finally:
+            self._tracing.trace_id = previous
 
     def _worker(self):
         """
         Worker loop that processes the Queue of pending requests to do.
+
+        All the signals queued while the previous ones were being published
+        are drained at once, consecutive signals with the same name are
+        published together in a single multipart message.
         """
         while self._do_work.is_set():
-            try:
-                request = self._signal_queue.get(block=False)
-                self._send_request(request)
-            except Queue.Empty:
-                pass
-            time.sleep(0.01)
+            batch = [self._signal_queue.get()]
+            while True:
+                try:
+                    batch.append(self._signal_queue.get(block=False))
+                except Queue.Empty:
+                    break
+
+            # `stop` queues a None to wake up the worker.
+            batch = [request for request in batch if request is not None]
+
+            # split the batch in runs of the same signal, keeping the order.
+            run = []
+            for request in batch:
+                if run and run[0][0] != request[0]:
+                    self._send_request(run)
+                    run = []
+                run.append(request)
+
+            if run:
+                self._send_request(run)
 
         logger.debug("Signaler thread stopped.")
 
@@ -120,41 +252,67 @@ class Signaler(object):
         Stop the Signaler worker.
         """
         self._do_work.clear()
+        self._signal_queue.put(None, force=True)
+
+    def queue_stats(self):
+        """
+        Return the size of the signals queue and how many signals were
+        dropped or coalesced for each signal name.
+
+        :rtype: dict
+        """
+        return self._signal_queue.stats()
+
+    def metrics(self):
+        """
+        Return the signals sent and the time they waited to be published,
+        per signal, and the queue depth.
+
+        :rtype: dict
+        """
+        return self._metrics.snapshot()
 
     def _send_request(self, request):
         """
-        Send the given request to the server.
-        This is used from a thread safe loop in order to avoid sending a
-        request without receiving a response from a previous one.
+        Publish the given batch of signals, all of them with the same name.
+        This is fire and forget, there is no reply from the subscribers.
 
-        :param request: the request to send.
-        :type request: str
+        :param request: the signals to send, (signal, data, buffers,
+                        queued_at, trace) tuples.
+        :type request: list of tuple
         """
-        logger.debug("Signaling '{0}'".format(request))
-        self._socket.send(request)
+        signal = request[0][0]
+        logger.debug("Publishing {0} '{1}' signals.".format(
+            len(request), signal))
 
-        poll = zmq.Poller()
-        poll.register(self._socket, zmq.POLLIN)
+        self._publish(signal, request)
 
-        reply = None
-        tries = 0
+        now = time.time()
+        for _, _, _, queued_at, trace in request:
+            self._metrics.observe('publish_delay.' + signal, now - queued_at)
+            if trace is not None:
+                self._trace_log.write(trace['id'], trace['span'],
+                                      {'signal': queued_at, 'published': now},
+                                      name=signal)
 
-        while True:
-            socks = dict(poll.poll(self.POLL_TIMEOUT))
-            if socks.get(self._socket) == zmq.POLLIN:
-                reply = self._socket.recv()
-                break
+    def _publish(self, signal, request):
+        """
+        Write a batch of signals to the socket.
 
-            tries += 1
-            if tries < self.POLL_TRIES:
-                logger.warning('Retrying receive... {0}/{1}'.format(
-                    tries, self.POLL_TRIES))
-            else:
-                break
+        The message frames are: the signal name (the subscription topic),
+        the name of the codec used, the amount of binary frames of each
+        signal (space separated) and then, for each signal, its serialized
+        data followed by its binary frames.
 
-        if reply is None:
-            msg = "Timeout error contacting backend."
-            logger.critical(msg)
-        else:
-            msg = "Received reply for '{0}' -> '{1}'".format(request, reply)
-            logger.debug(msg)
+        :param signal: the name of the signals.
+        :type signal: str
+        :param request: the signals to send, see `_send_request`.
+        :type request: list of tuple
+        """
+        counts = ' '.join(str(len(item[2])) for item in request)
+        frames = [signal, self._codec.name, counts]
+        for _, data, buffers, _, _ in request:
+            frames.append(data)
+            frames.extend(buffers)
+
+        self._socket.send_multipart(frames, copy=False)
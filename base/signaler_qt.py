@@ -1,15 +1,15 @@
 #!/usr/bin/env python
 # encoding: utf-8
+import collections
 import threading
 import time
 
 from PySide import QtCore
 
-import zmq
-from zmq.auth.thread import ThreadAuthenticator
-
 from api import SIGNALS
-from certificates import get_frontend_certificates
+from signal_receiver import SignalReceiver
+from streams import STREAM_SIGNALS, chunk_stream
+from tracing import get_trace_log
 from utils import get_log_handler
 
 logger = get_log_handler(__name__)
@@ -17,99 +17,174 @@ logger = get_log_handler(__name__)
 
 class SignalerQt(QtCore.QObject):
     """
-    Signaling server.
-    Receives signals from the signaling client and emit Qt signals for the GUI.
+    Signals subscriber for the GUI.
+    Receives the signals published by the backend and emit Qt signals for the
+    GUI. Only the signals defined as Qt signals in the subclass are
+    subscribed to.
+
+    The received signals are collected and emitted in the GUI thread in one
+    batch per FRAME_INTERVAL, so a burst of signals does not flood the Qt
+    event loop. For the signals listed in COALESCED_SIGNALS only the latest
+    value received during the interval is emitted.
+
+    The chunks of the streamed results (see `streams`) are never coalesced,
+    and a credit is granted for each one once it is emitted, so a stream
+    goes at the pace of the GUI.
     """
-    PORT = "5667"
-    BIND_ADDR = "tcp://127.0.0.1:%s" % PORT
+    # how often the collected signals are emitted in the GUI thread.
+    FRAME_INTERVAL = 16  # ms
 
-    def __init__(self):
-        QtCore.QObject.__init__(self)
+    # signals for which only the latest value of each batch is emitted.
+    COALESCED_SIGNALS = ()
 
-        # Note: we use a plain thread instead of a QThread since works better.
-        # The signaler was not responding on OSX if the worker loop was run in
-        # a QThread.
-        self._worker_thread = threading.Thread(target=self._run)
-        self._do_work = threading.Event()
+    # internal, tells the GUI thread that there are signals to emit.
+    _batch_ready = QtCore.Signal()
 
-    def start(self):
+    def __init__(self, server=None, signaler=None, backend_proxy=None):
         """
-        Start the worker thread for the signaler server.
+        :param server: the address of the signals publisher, the
+                       SignalReceiver's default if None.
+        :type server: str
+        :param signaler: the signaler of a backend running in direct mode in
+                         this process, to get the signals from it instead of
+                         subscribing to `server`. See `direct`.
+        :type signaler: DirectSignaler
+        :param backend_proxy: the proxy used to grant the credits of the
+                              streams, if None no credits are granted and
+                              the streams stall after STREAM_WINDOW chunks.
+        :type backend_proxy: BackendProxy
         """
-        self._do_work.set()
-        self._worker_thread.start()
+        QtCore.QObject.__init__(self)
+
+        signals = [signal for signal in SIGNALS if hasattr(self, signal)]
 
-    def _run(self):
+        # Note: the receiver uses a plain thread instead of a QThread since
+        # works better. The signaler was not responding on OSX if the worker
+        # loop was run in a QThread.
+        if signaler is not None:
+            from direct import DirectReceiver
+            self._receiver = DirectReceiver(signaler, self._process_signal,
+                                            signals, with_trace=True)
+        else:
+            self._receiver = SignalReceiver(self._process_signal, signals,
+                                            with_trace=True, server=server)
+        self._trace_log = get_trace_log()
+        self._backend_proxy = backend_proxy
+
+        # signals waiting to be emitted, as (signal, data, trace) tuples, and
+        # the position of the coalesced ones in the list.
+        self._pending = []
+        self._pending_index = {}
+        self._flush_scheduled = False
+        self._pending_lock = threading.Lock()
+
+        # we are emitted from the receiver thread, so this is a queued
+        # connection and the slot runs in the GUI thread.
+        self._batch_ready.connect(self._schedule_flush)
+
+    def start(self):
         """
-        Start a loop to process the ZMQ requests from the signaler client.
+        Start the worker thread for the signals receiver.
         """
-        logger.debug("Running SignalerQt loop")
-        context = zmq.Context()
-        socket = context.socket(zmq.REP)
-
-        # Start an authenticator for this context.
-        auth = ThreadAuthenticator(context)
-        auth.start()
-        auth.allow('127.0.0.1')
-
-        # Tell authenticator to use the certificate in a directory
-        auth.configure_curve(domain='*', location=zmq.auth.CURVE_ALLOW_ANY)
-        public, secret = get_frontend_certificates()
-        socket.curve_publickey = public
-        socket.curve_secretkey = secret
-        socket.curve_server = True  # must come before bind
-
-        socket.bind(self.BIND_ADDR)
-
-        while self._do_work.is_set():
-            # Wait for next request from client
-            try:
-                request = socket.recv(zmq.NOBLOCK)
-                logger.debug("Received request: '{0}'".format(request))
-                socket.send("OK")
-                self._process_request(request)
-            except zmq.ZMQError as e:
-                if e.errno != zmq.EAGAIN:
-                    raise
-            time.sleep(0.01)
-
-        logger.debug("SignalerQt thread stopped.")
+        self._receiver.start()
 
     def stop(self):
         """
-        Stop the SignalerQt blocking loop.
+        Stop the signals receiver blocking loop.
         """
-        self._do_work.clear()
+        self._receiver.stop()
 
-    def _process_request(self, request_json):
+    def _process_signal(self, signal, data, trace=None):
         """
-        Process a request and call the according method with the given
-        parameters.
-
-        :param request_json: a json specification of a request.
-        :type request_json: str
+        Collect a received signal to be emitted in the next batch.
+        This is run in the receiver thread.
+
+        :param signal: the signal name.
+        :type signal: str
+        :param data: the data sent along the signal.
+        :type data: object
+        :param trace: the trace id and span of the signal, None if it is not
+                      traced.
+        :type trace: dict
         """
-        try:
-            request = zmq.utils.jsonapi.loads(request_json)
-            signal = request['signal']
-            data = request['data']
-        except Exception as e:
-            msg = "Malformed JSON data in Signaler request '{0}'. Exc: {1!r}"
-            msg = msg.format(request_json, e)
-            logger.critical(msg)
-            raise
-
         if signal not in SIGNALS:
             logger.error("Unknown signal received, '{0}'".format(signal))
             return
 
+        with self._pending_lock:
+            index = self._pending_index.get(signal)
+            if index is not None:
+                # latest value wins
+                self._pending[index] = (signal, data, trace)
+            else:
+                if (signal in self.COALESCED_SIGNALS and
+                        signal not in STREAM_SIGNALS):
+                    self._pending_index[signal] = len(self._pending)
+                self._pending.append((signal, data, trace))
+
+            # only the first signal of a batch needs to notify the GUI.
+            notify = not self._flush_scheduled
+            self._flush_scheduled = True
+
+        if notify:
+            self._batch_ready.emit()
+
+    def _schedule_flush(self):
+        """
+        Emit the collected signals after FRAME_INTERVAL, so the ones that
+        arrive meanwhile are emitted in the same batch.
+        This is run in the GUI thread.
+        """
+        QtCore.QTimer.singleShot(self.FRAME_INTERVAL, self._flush)
+
+    def _flush(self):
+        """
+        Emit the Qt signals for the collected signals, in order.
+        This is run in the GUI thread.
+        """
+        with self._pending_lock:
+            batch = self._pending
+            self._pending = []
+            self._pending_index = {}
+            self._flush_scheduled = False
+
+        logger.debug("Emitting {0} signals.".format(len(batch)))
+        credits = collections.Counter()
+        for signal, data, trace in batch:
+            stream_id = chunk_stream(signal, data)
+            if stream_id is not None:
+                credits[stream_id] += 1
+
+            if trace is None:
+                self._emit(signal, data)
+                continue
+
+            emitted_at = time.time()
+            self._emit(signal, data)
+            self._trace_log.write(trace['id'], trace['span'],
+                                  {'emitted': emitted_at,
+                                   'handled': time.time()})
+
+        if self._backend_proxy is not None:
+            for stream_id, amount in credits.items():
+                self._backend_proxy.stream_credit(stream=stream_id,
+                                                  credits=amount)
+
+    def _emit(self, signal, data):
+        """
+        Emit the Qt signal for a received signal.
+
+        :param signal: the signal name.
+        :type signal: str
+        :param data: the data sent along the signal.
+        :type data: object
+        """
         try:
             qt_signal = getattr(self, signal)
         except Exception:
             logger.warning("Signal not implemented, '{0}'".format(signal))
             return
 
-        logger.debug("Emitting '{0}'".format(signal))
         if data is None:
             qt_signal.emit()
         else:
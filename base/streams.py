@@ -0,0 +1,158 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Streamed results with credit based flow control.
+
+The API methods listed in `api.STREAMS` can be generators, each chunk they
+yield is sent to the frontend, in order, as a signal:
+
+    {'stream': stream_id, 'seq': 0, 'chunk': chunk}
+    {'stream': stream_id, 'seq': 1, 'chunk': chunk}
+    ...
+    {'stream': stream_id, 'seq': n, 'end': True}
+
+The last signal has no chunk, it tells that the stream finished. If the
+method failed, or the stream stalled, it has an 'error' message too.
+
+A chunk is only sent when the consumer has a credit for it. Each stream
+starts with STREAM_WINDOW credits and the consumer grants more, through the
+reserved 'stream_credit' API method, as it handles the chunks. This way a
+fast method can not flood the signals queue, the SignalerQt nor the memory;
+it waits in its thread until it gets a credit, for up to STREAM_TIMEOUT.
+
+The stream id is the id of the request that started it, so behind a Broker
+the credits reach the worker running the stream, see `broker.Broker`.
+
+Note: the consumer has to grant the credits, the SignalerQt does it once the
+chunks are emitted if it is given a BackendProxy.
+"""
+import threading
+import time
+
+from api import STREAMS
+
+# the signals used to send the chunks.
+STREAM_SIGNALS = frozenset(STREAMS.values())
+
+
+def chunk_stream(signal, data):
+    """
+    Return the stream a received chunk belongs to, so a credit can be
+    granted for it.
+
+    :param signal: the signal name.
+    :type signal: str
+    :param data: the data sent along the signal.
+    :type data: object
+
+    :return: the stream id, None if the signal is not a chunk (the end of a
+             stream is not a chunk, it needs no credit).
+    :rtype: str
+    """
+    if signal not in STREAM_SIGNALS or not isinstance(data, dict):
+        return None
+    if data.get('end'):
+        return None
+    return data.get('stream')
+
+
+class StreamCredits(object):
+    """
+    Thread safe credits of the running streams.
+    """
+    def __init__(self, window):
+        """
+        :param window: the credits each stream starts with.
+        :type window: int
+        """
+        self._window = window
+        self._credits = {}
+        self._changed = threading.Condition()
+
+    def open(self, stream_id):
+        """
+        Start counting the credits of a new stream.
+
+        :param stream_id: the stream id.
+        :type stream_id: str
+        """
+        with self._changed:
+            self._credits[stream_id] = self._window
+
+    def close(self, stream_id):
+        """
+        Forget a finished stream, later credits for it are ignored.
+
+        :param stream_id: the stream id.
+        :type stream_id: str
+        """
+        with self._changed:
+            self._credits.pop(stream_id, None)
+
+    def acquire(self, stream_id, timeout, token=None):
+        """
+        Take a credit of a stream, waiting for the consumer to grant one if
+        needed.
+
+        :param stream_id: the stream id.
+        :type stream_id: str
+        :param timeout: the maximum time to wait, in seconds.
+        :type timeout: float
+        :param token: the cancel token of the stream call, the wait stops as
+                      soon as it is cancelled or expires, see `interrupt`.
+        :type token: CancelToken
+
+        :return: whether a credit was taken in time.
+        :rtype: bool
+
+        :raise CallCancelled: if the call was cancelled or expired.
+        """
+        deadline = time.time() + timeout
+        with self._changed:
+            while True:
+                if token is not None:
+                    token.raise_if_cancelled()
+                if self._credits.get(stream_id, 0) > 0:
+                    break
+                remaining = deadline - time.time()
+                if remaining <= 0 or stream_id not in self._credits:
+                    return False
+                if token is not None and token.remaining() is not None:
+                    remaining = min(remaining, token.remaining())
+                self._changed.wait(remaining)
+
+            self._credits[stream_id] -= 1
+            return True
+
+    def grant(self, stream, credits=1):
+        """
+        Give more credits to a stream.
+        This is the reserved 'stream_credit' API method, hence the argument
+        names.
+
+        :param stream: the stream id.
+        :type stream: str
+        :param credits: the amount of credits to give.
+        :type credits: int
+        """
+        with self._changed:
+            if stream in self._credits:
+                self._credits[stream] += credits
+                self._changed.notify_all()
+
+    def interrupt(self):
+        """
+        Wake up the streams waiting for credits, so the ones whose call was
+        cancelled stop.
+        """
+        with self._changed:
+            self._changed.notify_all()
+
+    def stats(self):
+        """
+        Return the credits left of each running stream.
+
+        :rtype: dict
+        """
+        with self._changed:
+            return dict(self._credits)
@@ -0,0 +1,267 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+End-to-end request tracing, used to find out where the time of a call goes.
+
+Each call made through the BackendProxy gets a trace id that travels along
+the request, and along every signal the API method emits. The components
+stamp the time at which the call (or signal) goes through each hop and
+append it to a trace log, one JSON record per line:
+
+    {"trace": id, "span": span, "name": name, "hops": {hop: time, ...}}
+
+The `call` span holds the hops of the request, each signal gets its own span.
+A span is stamped by several processes, so its hops are spread over several
+records that are merged by `read_traces`.
+
+Call hops:
+    call        BackendProxy: the call is queued in `_call_queue`.
+    sent        BackendProxy: the request is written to the socket.
+    received    Backend: the request is read from the socket.
+    dispatched  Backend: the request is processed in the reactor.
+    started     Backend: the API method starts running in its thread.
+    finished    Backend: the API method finished.
+    result      BackendProxy: the result is received (futures only).
+
+Signal hops:
+    signal      Signaler: the signal is queued in `_signal_queue`.
+    published   Signaler: the signal is written to the socket.
+    delivered   SignalReceiver: the signal is read from the socket.
+    emitted     SignalerQt: the Qt signal is emitted in the GUI thread.
+    handled     SignalerQt: the connected slots returned.
+
+Note: the hops are stamped with `time.time()` in each process, the stages
+that cross processes are only meaningful when they run on the same host.
+"""
+import atexit
+import binascii
+import collections
+import json
+import os
+import threading
+
+from api import TRACE_FILE
+from utils import get_log_handler
+
+logger = get_log_handler(__name__)
+
+# span of the hops of the request itself.
+CALL_SPAN = 'call'
+
+# stages of the latency breakdown, (stage, from hop, to hop).
+STAGES = (
+    ('call_queue', 'call', 'sent'),
+    ('request_transport', 'sent', 'received'),
+    ('backend_dispatch', 'received', 'dispatched'),
+    ('executor_queue', 'dispatched', 'started'),
+    ('method', 'started', 'finished'),
+    ('reply', 'finished', 'result'),
+    ('until_signal', 'started', 'signal'),
+    ('signal_queue', 'signal', 'published'),
+    ('signal_transport', 'published', 'delivered'),
+    ('qt_batching', 'delivered', 'emitted'),
+    ('qt_slots', 'emitted', 'handled'),
+    ('total_result', 'call', 'result'),
+    ('total_signal', 'call', 'handled'),
+)
+
+# time between writes of the queued records.
+FLUSH_INTERVAL = 1  # secs
+
+
+def new_trace_id():
+    """
+    Return a new trace id, unique across processes.
+
+    :rtype: str
+    """
+    return binascii.hexlify(os.urandom(8))
+
+
+class TraceLog(object):
+    """
+    Append only log of trace records.
+
+    The records are queued and written in batches by a background thread, so
+    stamping a hop only costs a `deque.append`. Each batch is written with a
+    single `write` on a file opened in append mode, so several processes can
+    share the same file.
+    """
+    def __init__(self, path, interval=FLUSH_INTERVAL):
+        """
+        :param path: the file path.
+        :type path: str
+        :param interval: the time between writes, in seconds.
+        :type interval: float
+        """
+        self.pid = os.getpid()
+        self._path = path
+        self._interval = interval
+        self._records = collections.deque()
+        self._write_lock = threading.Lock()
+
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+
+    def start(self):
+        """
+        Start writing the records.
+        """
+        self._thread.start()
+        atexit.register(self.flush)
+
+    def stop(self):
+        """
+        Stop the writer thread, the queued records are written first.
+        """
+        self._stopped.set()
+        self.flush()
+
+    def write(self, trace_id, span, hops, name=None):
+        """
+        Queue a trace record.
+        This can be called from any thread.
+
+        :param trace_id: the trace id.
+        :type trace_id: str
+        :param span: the span the hops belong to.
+        :type span: str
+        :param hops: the time of each hop, as given by time.time(). It must
+                     not be changed after this call.
+        :type hops: dict
+        :param name: the API method or signal name, if known.
+        :type name: str
+        """
+        self._records.append((trace_id, span, name, hops))
+
+    def flush(self):
+        """
+        Write the queued records.
+        """
+        lines = []
+        while True:
+            try:
+                trace_id, span, name, hops = self._records.popleft()
+            except IndexError:
+                break
+            record = {'trace': trace_id, 'span': span, 'hops': hops}
+            if name is not None:
+                record['name'] = name
+            lines.append(json.dumps(record) + '\n')
+
+        if not lines:
+            return
+
+        with self._write_lock:
+            fd = os.open(self._path, os.O_WRONLY | os.O_CREAT | os.O_APPEND,
+                         0o600)
+            try:
+                os.write(fd, ''.join(lines))
+            finally:
+                os.close(fd)
+
+    def _run(self):
+        """
+        Write loop.
+        """
+        while not self._stopped.wait(self._interval):
+            try:
+                self.flush()
+            except Exception as e:
+                logger.error("Cannot write traces to '{0}': {1!r}".format(
+                    self._path, e))
+
+
+_trace_log = None
+_trace_log_lock = threading.Lock()
+
+
+def get_trace_log():
+    """
+    Return the trace log of the current process, shared by all its
+    components.
+
+    :return: the trace log, None if the tracing is disabled (TRACE_FILE).
+    :rtype: TraceLog
+    """
+    global _trace_log
+    if TRACE_FILE is None:
+        return None
+
+    with _trace_log_lock:
+        # a forked process needs its own writer thread.
+        if _trace_log is None or _trace_log.pid != os.getpid():
+            _trace_log = TraceLog(TRACE_FILE)
+            _trace_log.start()
+    return _trace_log
+
+
+def read_traces(path):
+    """
+    Read a trace log and merge the records of each span.
+
+    :param path: the file path.
+    :type path: str
+
+    :return: the spans of each trace, {trace_id: {span: {'name': name,
+             'hops': {hop: time}}}}.
+    :rtype: dict
+    """
+    traces = collections.defaultdict(dict)
+    with open(path) as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+                trace_id, span = record['trace'], record['span']
+                hops = record['hops']
+            except (ValueError, KeyError) as e:
+                logger.warning("Malformed trace record: {0!r}".format(e))
+                continue
+
+            merged = traces[trace_id].setdefault(span,
+                                                 {'name': None, 'hops': {}})
+            merged['hops'].update(hops)
+            if record.get('name') is not None:
+                merged['name'] = record['name']
+
+    return dict(traces)
+
+
+def stage_latencies(traces):
+    """
+    Return the latency of each stage for every call and signal traced.
+
+    The signal spans are measured along with the hops of their call, so the
+    stages between them (e.g. from the call to the signal handled) are
+    available too.
+
+    :param traces: the merged traces, as returned by `read_traces`.
+    :type traces: dict
+
+    :return: the latencies, in seconds, of each stage, by the API method of
+             the call, {method: {stage: [latency, ...]}}.
+    :rtype: dict
+    """
+    latencies = collections.defaultdict(lambda: collections.defaultdict(list))
+    for spans in traces.values():
+        call = spans.get(CALL_SPAN, {'name': None, 'hops': {}})
+        method = call['name'] or '?'
+
+        timelines = [call['hops']]
+        for span, signal in spans.items():
+            if span != CALL_SPAN:
+                hops = dict(call['hops'])
+                hops.pop('result', None)  # measured with the call already
+                hops.update(signal['hops'])
+                timelines.append(hops)
+
+        for index, hops in enumerate(timelines):
+            for stage, start, end in STAGES:
+                if start in hops and end in hops:
+                    if index and start in call['hops'] and \
+                            end in call['hops']:
+                        continue  # a call stage, measured once
+                    latencies[method][stage].append(hops[end] - hops[start])
+
+    return latencies
@@ -0,0 +1,175 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Endpoints of the sockets between the frontend and the backend, and how they
+are secured.
+
+The transport is chosen with `api.TRANSPORT`:
+    "tcp": the sockets listen on the loopback interface and the messages are
+        encrypted and authenticated with CURVE. With other addresses, this
+        is the one to use for remote deployments.
+    "ipc": the sockets are unix domain sockets in `api.IPC_DIR`, a directory
+        only the user running the app can access, so the filesystem
+        permissions take the place of CURVE. Both sides must run on the same
+        host, the messages skip the encryption and the TCP stack.
+
+Whether a socket uses CURVE is decided by its address, so the components can
+also be given their endpoints one by one, e.g. `Backend(bind_addr=...)`.
+"""
+import os
+import stat
+
+import zmq
+from zmq.auth.thread import ThreadAuthenticator
+
+from api import IPC_DIR, TRANSPORT
+
+# endpoint names
+BACKEND = 'backend'
+HEARTBEAT = 'heartbeat'
+SIGNALS = 'signals'
+WORKERS = 'workers'  # used by the broker
+SIGNALS_WORKERS = 'signals-workers'  # used by the broker
+
+# the port of each endpoint on the tcp transport.
+PORTS = {
+    BACKEND: 5556,
+    WORKERS: 5557,
+    HEARTBEAT: 5558,
+    SIGNALS: 5667,
+    SIGNALS_WORKERS: 5668,
+}
+
+
+def bind_address(name, transport=TRANSPORT):
+    """
+    Return the address a server binds for an endpoint.
+
+    :param name: the endpoint name.
+    :type name: str
+    :param transport: the transport, 'tcp' or 'ipc'.
+    :type transport: str
+    :rtype: str
+
+    :raise ValueError: if the transport is unknown.
+    """
+    if transport == 'tcp':
+        return "tcp://127.0.0.1:{0}".format(PORTS[name])
+    if transport == 'ipc':
+        return "ipc://{0}/{1}.sock".format(IPC_DIR, name)
+    raise ValueError("Unknown transport: '{0}'".format(transport))
+
+
+def connect_address(name, transport=TRANSPORT):
+    """
+    Return the address a client connects to for an endpoint.
+
+    :param name: the endpoint name.
+    :type name: str
+    :param transport: the transport, 'tcp' or 'ipc'.
+    :type transport: str
+    :rtype: str
+
+    :raise ValueError: if the transport is unknown.
+    """
+    if transport == 'tcp':
+        return "tcp://localhost:{0}".format(PORTS[name])
+    return bind_address(name, transport)
+
+
+def uses_curve(address):
+    """
+    Return whether the socket at `address` is secured with CURVE, only the
+    tcp ones are.
+
+    :param address: the socket address.
+    :type address: str
+    :rtype: bool
+    """
+    return address.startswith('tcp://')
+
+
+def start_authenticator(context):
+    """
+    Start the authenticator for the CURVE servers of a context, any client
+    from the loopback interface that knows the server key is allowed.
+
+    :param context: the zmq context.
+    :type context: zmq.Context
+
+    :rtype: zmq.auth.thread.ThreadAuthenticator
+    """
+    auth = ThreadAuthenticator(context)
+    auth.start()
+    auth.allow('127.0.0.1')
+
+    # Tell authenticator to use the certificate in a directory
+    auth.configure_curve(domain='*', location=zmq.auth.CURVE_ALLOW_ANY)
+    return auth
+
+
+def bind_server(socket, address, server_keys):
+    """
+    Secure a server socket as its address needs it and bind it.
+
+    :param socket: the socket to bind.
+    :type socket: zmq.Socket
+    :param address: the address to bind.
+    :type address: str
+    :param server_keys: returns the server's public and secret keys, it is
+                        only called for CURVE sockets.
+    :type server_keys: callable
+    """
+    if uses_curve(address):
+        public, secret = server_keys()
+        socket.curve_publickey = public
+        socket.curve_secretkey = secret
+        socket.curve_server = True  # must come before bind
+    elif address.startswith('ipc://'):
+        _prepare_ipc_dir(address)
+
+    socket.bind(address)
+
+
+def connect_client(socket, address, server_keys):
+    """
+    Secure a client socket as its address needs it and connect it.
+    A new CURVE keypair is used on each connection.
+
+    :param socket: the socket to connect.
+    :type socket: zmq.Socket
+    :param address: the address to connect to.
+    :type address: str
+    :param server_keys: returns the server's public and secret keys, it is
+                        only called for CURVE sockets.
+    :type server_keys: callable
+    """
+    if uses_curve(address):
+        client_keys = zmq.curve_keypair()
+        socket.curve_publickey = client_keys[0]
+        socket.curve_secretkey = client_keys[1]
+
+        # The client must know the server's public key to make a CURVE
+        # connection.
+        public, _ = server_keys()
+        socket.curve_serverkey = public
+
+    socket.connect(address)
+
+
+def _prepare_ipc_dir(address):
+    """
+    Create the directory of an ipc socket, if needed, and make it only
+    accessible by the current user.
+
+    :param address: the ipc address.
+    :type address: str
+    """
+    directory = os.path.dirname(address[len('ipc://'):])
+    if not directory:
+        return
+
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    # set permissions to: 0700 (U:rwx G:--- O:---)
+    os.chmod(directory, stat.S_IRUSR | stat.S_IWUSR | stat.S_IXUSR)
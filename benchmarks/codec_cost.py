@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Measure the encode/decode cost of each available codec for different message
+sizes.
+
+Run it from the repository root so the `base` package is found:
+    python -m benchmarks.codec_cost
+"""
+import timeit
+
+from base.codec import available_codecs, get_codec
+
+# approximate payload sizes, in bytes.
+SIZES = (64, 1024, 64 * 1024, 1024 * 1024)
+
+
+def make_request(size):
+    """
+    Return a request like the ones sent by the BackendProxy with a payload
+    of about `size` bytes, half text and half numbers.
+
+    :param size: the approximate payload size.
+    :type size: int
+    :rtype: dict
+    """
+    text = u'x' * (size // 2)
+    numbers = list(range(size // 2 // 8))
+    return {
+        'api_method': 'blocking_method',
+        'arguments': {'data': text, 'numbers': numbers},
+    }
+
+
+def measure(codec, request, number):
+    """
+    Return the average encode and decode time in microseconds.
+
+    :param codec: the codec to measure.
+    :type codec: object
+    :param request: the data to encode.
+    :type request: dict
+    :param number: how many times to repeat each operation.
+    :type number: int
+    :rtype: tuple(float, float, int)
+    """
+    data = codec.dumps(request)
+    encode = timeit.timeit(lambda: codec.dumps(request), number=number)
+    decode = timeit.timeit(lambda: codec.loads(data), number=number)
+    return encode / number * 1e6, decode / number * 1e6, len(data)
+
+
+if __name__ == '__main__':
+    header = "{0:>8} {1:>10} {2:>10} {3:>12} {4:>12}"
+    row = "{0:>8} {1:>10} {2:>10} {3:>12.1f} {4:>12.1f}"
+    print(header.format('codec', 'size', 'encoded', 'encode (us)',
+                        'decode (us)'))
+
+    for name in sorted(available_codecs()):
+        codec = get_codec(name)
+        for size in SIZES:
+            number = max(10, 100000 // size)
+            request = make_request(size)
+            encode, decode, encoded = measure(codec, request, number)
+            print(row.format(name, size, encoded, encode, decode))
@@ -0,0 +1,215 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Measure the full BackendProxy -> Backend -> Signaler -> subscriber path,
+without the GUI.
+
+A backend is started in another process, the calls are made through a
+BackendProxy and the signals are received with a SignalReceiver, the Qt-free
+stand-in for SignalerQt. For each payload size and concurrency the given mix
+of API calls is run and the round-trip latency (until the call result is
+received), the calls/second and the signals/second are reported.
+
+Every call carries an opaque argument of the payload size, which the backend
+drops before running the method, see `BenchmarkBackend`.
+
+Run it from the repository root so the `api` and `base` modules are found:
+    python -m benchmarks.end_to_end [--calls N] [--concurrency 1,8]
+        [--payload 16,4096] [--mix add=4,blocking_method=1]
+"""
+import argparse
+import multiprocessing
+import random
+import signal
+import threading
+import time
+
+from api import API
+from base.backend_proxy import BackendProxy
+from base.certificates import generate_certificates
+from base.signal_receiver import SignalReceiver
+from benchmarks.stats import percentile
+from demo_backend import DemoBackend
+
+# the arguments of each API method.
+ARGUMENTS = {
+    "add": {'a': 2, 'b': 2},
+    "reset": {},
+    "get_stored_data": {},
+    "blocking_method": {'data': u'x', 'delay': 0},
+    "twice_01": {},
+    "twice_02": {},
+    "count_primes": {'limit': 1000},
+}
+
+# the opaque argument added to every call, sized to the payload.
+PAYLOAD_ARGUMENT = 'payload'
+
+# time to wait for the result of a call.
+CALL_TIMEOUT = 30  # secs
+
+
+def parse_mix(text):
+    """
+    Parse a mix of calls, e.g. 'add=4,blocking_method=1'.
+
+    :return: the methods and their weights.
+    :rtype: list of tuple(str, int)
+    """
+    mix = []
+    for item in text.split(','):
+        method, _, weight = item.partition('=')
+        if method not in API or method not in ARGUMENTS:
+            raise ValueError("Unsupported API method: '{0}'".format(method))
+        mix.append((method, int(weight or 1)))
+    return mix
+
+
+class BenchmarkBackend(DemoBackend):
+    """
+    DemoBackend that drops the opaque payload argument of the calls before
+    running them, once it travelled the whole path.
+    """
+    def _process_call(self, api_method, kwargs, *args, **kw):
+        if kwargs and PAYLOAD_ARGUMENT in kwargs:
+            kwargs = dict(kwargs)
+            del kwargs[PAYLOAD_ARGUMENT]
+        super(BenchmarkBackend, self)._process_call(
+            api_method, kwargs or None, *args, **kw)
+
+
+def run_backend():
+    """
+    Run a BenchmarkBackend.
+    """
+    # Ensure that the application quits using CTRL-C
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+
+    BenchmarkBackend().run()
+
+
+class SignalCounter(object):
+    """
+    Counts the signals received by a SignalReceiver.
+    """
+    def __init__(self):
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def __call__(self, signal, data):
+        with self._lock:
+            self.count += 1
+
+
+def run_round(proxy, signals, mix, calls, concurrency, payload):
+    """
+    Make `calls` calls from `concurrency` threads, each one waiting for the
+    result of its previous call.
+
+    :return: the sorted latencies (secs), the elapsed time (secs) and the
+             amount of signals received meanwhile.
+    :rtype: tuple(list, float, int)
+    """
+    methods = []
+    for method, weight in mix:
+        methods.extend([method] * weight)
+
+    padding = u'x' * payload
+
+    latencies = []
+    errors = []
+    lock = threading.Lock()
+    remaining = [calls]
+
+    def client():
+        while True:
+            with lock:
+                if remaining[0] <= 0:
+                    return
+                remaining[0] -= 1
+
+            method = random.choice(methods)
+            kwargs = dict(ARGUMENTS[method])
+            kwargs[PAYLOAD_ARGUMENT] = padding
+            start = time.time()
+            future = getattr(proxy, method)(_future=True, **kwargs)
+            try:
+                future.result(CALL_TIMEOUT)
+            except Exception as e:
+                errors.append(e)
+                continue
+            with lock:
+                latencies.append(time.time() - start)
+
+    threads = [threading.Thread(target=client) for _ in xrange(concurrency)]
+    signals_before = signals.count
+    start = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.time() - start
+
+    if errors:
+        print("  {0} calls failed, e.g. {1!r}".format(len(errors), errors[0]))
+
+    return sorted(latencies), elapsed, signals.count - signals_before
+
+
+def run_benchmark(mix, calls, concurrencies, payloads):
+    """
+    Run a round for each payload size and concurrency and print the results.
+    """
+    signals = SignalCounter()
+    receiver = SignalReceiver(signals)
+    receiver.start()
+
+    proxy = BackendProxy()
+    # warm up: wait for the connection and for the subscription to be ready.
+    while not proxy.online:
+        time.sleep(0.1)
+    run_round(proxy, signals, mix, 10, 1, min(payloads))
+
+    print("{0:>8} {1:>6} {2:>10} {3:>10} {4:>10} {5:>10}".format(
+        "payload", "conc", "calls/s", "p50 ms", "p99 ms", "signals/s"))
+    try:
+        for payload in payloads:
+            for concurrency in concurrencies:
+                latencies, elapsed, received = run_round(
+                    proxy, signals, mix, calls, concurrency, payload)
+                print("{0:>8} {1:>6} {2:>10.1f} {3:>10.2f} {4:>10.2f} "
+                      "{5:>10.1f}".format(
+                          payload, concurrency, len(latencies) / elapsed,
+                          percentile(latencies, 0.5) * 1000,
+                          percentile(latencies, 0.99) * 1000,
+                          received / elapsed))
+    finally:
+        proxy.stop()
+        receiver.stop()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--calls', type=int, default=1000,
+                        help='amount of calls of each round')
+    parser.add_argument('--concurrency', default='1,8',
+                        help='comma separated amounts of concurrent callers')
+    parser.add_argument('--payload', default='16,4096',
+                        help='comma separated payload sizes, in bytes')
+    parser.add_argument('--mix', default='add=4,blocking_method=1',
+                        help='API methods to call and their weights')
+    args = parser.parse_args()
+
+    generate_certificates()
+
+    backend_process = multiprocessing.Process(target=run_backend)
+    backend_process.start()
+
+    try:
+        run_benchmark(parse_mix(args.mix), args.calls,
+                      [int(c) for c in args.concurrency.split(',')],
+                      [int(p) for p in args.payload.split(',')])
+    finally:
+        backend_process.join(10)
+        if backend_process.is_alive():
+            backend_process.terminate()
@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Measure how many calls per second the BackendProxy can push to a running
+backend.
+
+Run it from the repository root so the `api` and `base` modules are found:
+    python -m benchmarks.proxy_throughput [calls]
+"""
+import multiprocessing
+import sys
+import threading
+import time
+
+from base.backend_proxy import BackendProxy
+from base.certificates import generate_certificates
+from base.protocol import RESULT
+from demo_backend import run_backend
+
+
+class CountingBackendProxy(BackendProxy):
+    """
+    BackendProxy that notifies when the results of a given amount of measured
+    calls got back, see `measure`.
+    """
+    def __init__(self, expected):
+        self._expected = expected
+        self._measured = set()
+        self._replies = 0
+        self.done = threading.Event()
+        BackendProxy.__init__(self)
+
+    def measure(self):
+        """
+        Start counting the results of the calls made from now on.
+        """
+        self._replies = 0
+        self._measured = set()
+        self.done.clear()
+
+    def _new_request_id(self, follows=None):
+        request_id = BackendProxy._new_request_id(self, follows)
+        self._measured.add(request_id)
+        return request_id
+
+    def _process_reply(self, request_id, kind, body):
+        BackendProxy._process_reply(self, request_id, kind, body)
+        if kind == RESULT and request_id in self._measured:
+            self._replies += 1
+            if self._replies >= self._expected:
+                self.done.set()
+
+
+def run_benchmark(calls):
+    """
+    Queue `calls` burst calls to the backend and return the calls/second rate.
+
+    :param calls: the amount of calls to make, at most CALL_QUEUE_SIZE so
+                  none is dropped.
+    :type calls: int
+    :rtype: float
+    """
+    proxy = CountingBackendProxy(calls)
+
+    # warm up: wait for the connection and the first ping to go through.
+    while not proxy.online:
+        time.sleep(0.1)
+    proxy.measure()
+
+    start = time.time()
+    for i in xrange(calls):
+        proxy.add(a=i, b=i, _future=True)
+    proxy.done.wait()
+    elapsed = time.time() - start
+
+    proxy.stop()
+    return calls / elapsed
+
+
+if __name__ == '__main__':
+    calls = 1000
+    if len(sys.argv) > 1:
+        calls = int(sys.argv[1])
+
+    generate_certificates()
+
+    backend_process = multiprocessing.Process(target=run_backend)
+    backend_process.start()
+
+    try:
+        rate = run_benchmark(calls)
+        print("{0} calls in burst: {1:.1f} calls/second".format(calls, rate))
+    finally:
+        backend_process.join(10)
+        if backend_process.is_alive():
+            backend_process.terminate()
@@ -0,0 +1,21 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Statistics shared by the benchmark reports, so they all agree.
+"""
+
+
+def percentile(values, fraction):
+    """
+    Return the value at the given fraction of the sorted values, NaN if
+    there are none.
+
+    :param values: the sorted values.
+    :type values: list
+    :param fraction: the percentile, between 0 and 1.
+    :type fraction: float
+    """
+    if not values:
+        return float('nan')
+    index = min(len(values) - 1, int(round(fraction * (len(values) - 1))))
+    return values[index]
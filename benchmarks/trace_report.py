@@ -0,0 +1,56 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Turn a trace log into a per stage latency breakdown.
+
+Set `TRACE_FILE` in `api.py`, run the app (or a benchmark) and then run this
+from the repository root so the `api` and `base` modules are found:
+    python -m benchmarks.trace_report trace.log [--method add]
+
+For each API method, the amount of samples and the mean, p50 and p99 latency
+of each stage (see `base.tracing.STAGES`) are reported, e.g. the time spent
+in the BackendProxy call queue, on the wire, waiting for a thread, running
+the method, in the Signaler queue or waiting for the Qt emission.
+"""
+import argparse
+
+from base.tracing import STAGES, read_traces, stage_latencies
+from benchmarks.stats import percentile
+
+
+def print_breakdown(method, stages):
+    """
+    Print the latency breakdown of an API method.
+
+    :param method: the method name.
+    :type method: str
+    :param stages: the latencies (secs) of each stage.
+    :type stages: dict
+    """
+    print("{0}:".format(method))
+    print("  {0:<18} {1:>8} {2:>10} {3:>10} {4:>10}".format(
+        "stage", "count", "mean ms", "p50 ms", "p99 ms"))
+    for stage, _, _ in STAGES:
+        latencies = sorted(stages.get(stage, ()))
+        if not latencies:
+            continue
+        print("  {0:<18} {1:>8} {2:>10.2f} {3:>10.2f} {4:>10.2f}".format(
+            stage, len(latencies),
+            sum(latencies) / len(latencies) * 1000,
+            percentile(latencies, 0.5) * 1000,
+            percentile(latencies, 0.99) * 1000))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('path', help='the trace log to read')
+    parser.add_argument('--method', action='append',
+                        help='only report the given API methods')
+    args = parser.parse_args()
+
+    traces = read_traces(args.path)
+    print("{0} traces read.".format(len(traces)))
+    for method, stages in sorted(stage_latencies(traces).items()):
+        if args.method and method not in args.method:
+            continue
+        print_breakdown(method, stages)
@@ -11,7 +11,7 @@ from utils import get_log_handler
 logger = get_log_handler(__name__)
 
 from base.backend_proxy import BackendProxy
-from demo_backend import run_backend
+from demo_backend import run_backends
 from demo_signaler_qt import DemoSignalerQt
 
 
@@ -20,26 +20,47 @@ class DemoWidget(QtGui.QWidget):
     Demo class that creates a GUI with some buttons to do some test
     communication with the backend.
     """
-    def __init__(self):
+    def __init__(self, backend=None):
+        """
+        :param backend: a backend running in direct mode in this process, to
+                        use it instead of the one in the backend process.
+        :type backend: DirectEngine
+        """
         QtGui.QWidget.__init__(self)
+        self._blocking_call = None
 
-        self._backend_proxy = BackendProxy()
+        if backend is not None:
+            from base.direct import DirectBackendProxy
+            self._backend_proxy = DirectBackendProxy(backend)
+        else:
+            self._backend_proxy = BackendProxy()
 
         self.init_gui()
-        self._setup_signaler()
+        self._setup_signaler(backend)
 
-    def _setup_signaler(self):
+    def _setup_signaler(self, backend=None):
         """
         Setup the SignalerQt instance to use, connect to signals and run
         blocking loop in a thread.
+
+        :param backend: a backend running in direct mode in this process.
+        :type backend: DirectEngine
         """
-        self._signaler_qt = signaler = DemoSignalerQt()
+        if backend is not None:
+            signaler = DemoSignalerQt(signaler=backend.signaler,
+                                      backend_proxy=self._backend_proxy)
+        else:
+            signaler = DemoSignalerQt(backend_proxy=self._backend_proxy)
+        self._signaler_qt = signaler
 
         # Connect signals
         signaler.add_result.connect(self._on_add_result)
         signaler.reset_ok.connect(self._on_reset_ok)
         signaler.stored_data.connect(self._on_stored_data)
         signaler.blocking_method_ok.connect(self._on_blocking_method_ok)
+        signaler.blocking_method_progress.connect(
+            self._on_blocking_method_progress)
+        signaler.count_primes_result.connect(self._on_count_primes_result)
 
         # we run the signaler server in a thread since has a blocking loop
         self._signaler_qt.start()
@@ -54,6 +75,8 @@ class DemoWidget(QtGui.QWidget):
         pb_test3 = QtGui.QPushButton('Giveme stored data')
         pb_test4 = QtGui.QPushButton('Blocking method')
         pb_test5 = QtGui.QPushButton('Signal twice, threaded')
+        pb_test6 = QtGui.QPushButton('Count primes, CPU bound')
+        pb_test7 = QtGui.QPushButton('Cancel blocking method')
 
         # connect buttons with demo actions
         pb_test1.clicked.connect(self._call_reset)
@@ -64,6 +87,9 @@ class DemoWidget(QtGui.QWidget):
         pb_test5.clicked.connect(self._call_twice_01)
         pb_test5.clicked.connect(self._call_twice_02)
 
+        pb_test6.clicked.connect(self._call_count_primes)
+        pb_test7.clicked.connect(self._cancel_block_call)
+
         # define layout
         box = QtGui.QGridLayout()
         box.addWidget(pb_test1, 0, 0)
@@ -71,10 +97,14 @@ class DemoWidget(QtGui.QWidget):
         box.addWidget(pb_test3, 0, 2)
         box.addWidget(pb_test4, 0, 3)
         box.addWidget(pb_test5, 0, 4)
+        box.addWidget(pb_test6, 0, 5)
+        box.addWidget(pb_test7, 0, 6)
 
         # add label
         self.lbl_backend_status = QtGui.QLabel('Backend status: ...')
         box.addWidget(self.lbl_backend_status, 1, 0)
+        self.lbl_blocking_progress = QtGui.QLabel('Blocking method: ...')
+        box.addWidget(self.lbl_blocking_progress, 1, 1, 1, 2)
 
         self.setLayout(box)
 
@@ -127,7 +157,13 @@ class DemoWidget(QtGui.QWidget):
 
     def _call_block_call(self):
         logger.debug("calling: blocking_method")
-        self._backend_proxy.blocking_method(data=u'bláḩ', delay=19)
+        self._blocking_call = self._backend_proxy.blocking_method(
+            data=u'bláḩ', delay=19, _future=True)
+
+    def _cancel_block_call(self):
+        if self._blocking_call is not None:
+            logger.debug("cancelling: blocking_method")
+            self._blocking_call.cancel()
 
     def _call_twice_01(self):
         logger.debug("calling: twice_01")
@@ -137,6 +173,10 @@ class DemoWidget(QtGui.QWidget):
         logger.debug("calling: twice_02")
         self._backend_proxy.twice_02()
 
+    def _call_count_primes(self):
+        logger.debug("calling: count_primes(200000)")
+        self._backend_proxy.count_primes(limit=200000)
+
     ####################
     # Backend signals handlers
 
@@ -158,16 +198,43 @@ class DemoWidget(QtGui.QWidget):
         QtGui.QMessageBox.information(
             self, "Information", 'blocking_method_ok received.')
 
+    def _on_blocking_method_progress(self, data):
+        if data.get('end'):
+            msg = 'Blocking method: done'
+            if data.get('error'):
+                msg = 'Blocking method: failed, {0}'.format(data['error'])
+        else:
+            msg = 'Blocking method: {0} secs'.format(data['chunk'])
+        self.lbl_blocking_progress.setText(msg)
+
+    def _on_count_primes_result(self, data):
+        QtGui.QMessageBox.information(
+            self, "Information",
+            'count_primes_result received.\nData: {0}'.format(data))
 
-def run_app(should_run_backend=False):
+
+def run_app(should_run_backend=False, workers=1, in_process=False):
     """
     Run the app and start the backend if specified.
 
     :param should_run_backend: whether we should run the backend or not.
     :type should_run_backend: bool
+    :param workers: the amount of backend processes to run.
+    :type workers: int
+    :param in_process: whether to run the backend in this process, in direct
+                       mode, instead.
+    :type in_process: bool
     """
+    backend = None
+    if in_process:
+        # created before the GUI and any thread, see with_direct.
+        from base.direct import with_direct
+        from demo_backend import DemoBackend
+        backend = with_direct(DemoBackend)()
+        backend.start()
+
     app = QtGui.QApplication(sys.argv)
-    demo = DemoWidget()
+    demo = DemoWidget(backend)
     demo.show()
 
     # Ensure that the application quits using CTRL-C
@@ -175,7 +242,8 @@ def run_app(should_run_backend=False):
 
     if should_run_backend:
         import multiprocessing
-        backend_process = multiprocessing.Process(target=run_backend)
+        backend_process = multiprocessing.Process(target=run_backends,
+                                                  args=(workers,))
         backend_process.start()
 
     sys.exit(app.exec_())
@@ -189,8 +257,14 @@ if __name__ == '__main__':
     terminal. E.g.:
         python app.py --no-backend
         python backend.py
+
+    With `--in-process` the Backend runs in the app process, without sockets.
     """
     should_run_backend = True
+    in_process = False
     if len(sys.argv) > 1 and sys.argv[1] == '--no-backend':
         should_run_backend = False
-    run_app(should_run_backend=should_run_backend)
+    if len(sys.argv) > 1 and sys.argv[1] == '--in-process':
+        should_run_backend = False
+        in_process = True
+    run_app(should_run_backend=should_run_backend, in_process=in_process)
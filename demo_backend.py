@@ -22,39 +22,49 @@ class DemoBackend(Backend):
         Signal a reset_ok signal.
         Helper to test the signaling system with a simple request/reply.
         """
+        self.invalidate_cache("get_stored_data")
         self._signaler.signal(self._signaler.reset_ok)
 
     def add(self, a, b):
         """
-        This adds two parameters and signals the result.
+        This adds two parameters, signals and returns the result.
 
         :param a: first operand
         :type a: int
         :param b: second operand
         :type b: int
+        :rtype: int
         """
         self._signaler.signal(self._signaler.add_result, a+b)
+        return a + b
 
     def get_stored_data(self):
         """
-        Signal back some test data.
+        Signal back and return some test data.
         """
         self._signaler.signal(self._signaler.stored_data, 'Lorem Data')
+        return 'Lorem Data'
 
-    def blocking_method(self, data, delay):
+    def blocking_method(self, data, delay, cancel_token):
         """
-        This method blocks for `delay` seconds.
+        This method blocks for `delay` seconds, streaming the seconds elapsed
+        as its progress. It stops early if the call is cancelled.
 
         :param data: some data
         :type data: unicode
         :param delay: this indicates how much time we need to wait until return
         :type delay: int
+        :param cancel_token: tells whether the call was cancelled.
+        :type cancel_token: base.cancellation.CancelToken
+        :rtype: generator of int
         """
         assert isinstance(data, unicode)  # ensure parameter type
         logger.debug("blocking method start")
         logger.debug("data: {0!r} - delay:{1}".format(data, delay))
-        import time
-        time.sleep(delay)  # simulate some work
+        for second in xrange(delay):
+            cancel_token.wait(1)  # simulate some work
+            cancel_token.raise_if_cancelled()
+            yield second + 1
         logger.debug("blocking method end")
         self._signaler.signal(self._signaler.blocking_method_ok)
 
@@ -64,14 +74,69 @@ class DemoBackend(Backend):
     def twice_02(self):
         self._signaler.signal(self._signaler.twice_signal)
 
+    def count_primes(self, limit):
+        """
+        Count the prime numbers below `limit`, signals and returns the count.
+        This method is CPU bound, it runs in the backend's process pool.
+
+        :param limit: the upper bound, not included.
+        :type limit: int
+        :rtype: int
+        """
+        count = 0
+        for n in xrange(2, limit):
+            if all(n % d for d in xrange(2, int(n ** 0.5) + 1)):
+                count += 1
 
-def run_backend():
+        self._signaler.signal(self._signaler.count_primes_result, count)
+        return count
+
+
+def run_backend(connect_to=None, signals_connect_to=None):
+    """
+    Run a DemoBackend.
+
+    :param connect_to: the address of a Broker to connect to as a worker,
+                       None to serve the clients directly.
+    :type connect_to: str
+    :param signals_connect_to: the address of a Broker to publish the
+                               signals through, None to publish directly.
+    :type signals_connect_to: str
+    """
     # Ensure that the application quits using CTRL-C
     signal.signal(signal.SIGINT, signal.SIG_DFL)
 
-    backend = DemoBackend()
+    backend = DemoBackend(connect_to=connect_to,
+                          signals_connect_to=signals_connect_to)
     backend.run()
 
 
+def run_backends(workers):
+    """
+    Run the backend side, in the current process, using `workers` backend
+    processes.
+    With more than one worker, a Broker is run in front of them.
+
+    :param workers: the amount of backend processes to use.
+    :type workers: int
+    """
+    if workers <= 1:
+        run_backend()
+        return
+
+    import multiprocessing
+    from base.broker import Broker, run_broker
+
+    processes = []
+    for i in range(workers):
+        worker = multiprocessing.Process(
+            target=run_backend,
+            args=(Broker.WORKERS_ADDR, Broker.SIGNALS_WORKERS_ADDR))
+        worker.start()
+        processes.append(worker)
+
+    run_broker(processes)
+
+
 if __name__ == '__main__':
     run_backend()
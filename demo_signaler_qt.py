@@ -15,6 +15,14 @@ class DemoSignalerQt(SignalerQt):
     reset_ok = QtCore.Signal()
     stored_data = QtCore.Signal(object)
     blocking_method_ok = QtCore.Signal()
+    blocking_method_progress = QtCore.Signal(object)
     twice_signal = QtCore.Signal()
+    count_primes_result = QtCore.Signal(object)
     # end list of possible Qt signals to emit.
     ###########################################################################
+
+    # only the latest value of these signals is emitted on each batch.
+    COALESCED_SIGNALS = (
+        "add_result",
+        "twice_signal",
+    )
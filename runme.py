@@ -2,23 +2,32 @@
 # encoding: utf-8
 """
 This small app is used to start the GUI and the Backend in different process.
+
+Use `--workers N` to run N backend processes behind a load balancing broker.
 """
+import argparse
 import multiprocessing
 import signal
 
 from base.certificates import generate_certificates
 from demo_app import run_app
-from demo_backend import run_backend
+from demo_backend import run_backends
 
 
 if __name__ == '__main__':
     # Ensure that the application quits using CTRL-C
     signal.signal(signal.SIGINT, signal.SIG_DFL)
 
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--workers', type=int, default=1,
+                        help='amount of backend processes to run')
+    args = parser.parse_args()
+
     generate_certificates()
 
     gui_process = multiprocessing.Process(target=run_app)
     gui_process.start()
 
-    backend_process = multiprocessing.Process(target=run_backend)
+    backend_process = multiprocessing.Process(target=run_backends,
+                                              args=(args.workers,))
     backend_process.start()